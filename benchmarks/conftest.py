@@ -0,0 +1,58 @@
+""" Benchmark fixtures
+
+The target is a throwaway directory tree on tmpfs (if available) and
+:any:`env.ROOTCMD` is ``env``, so the benchmarks need no root privileges. The
+target's ``root`` user and group map to the current user, so that changing
+the owner to ``root`` works in-process.
+"""
+import pytest
+
+import os
+import pathlib
+import shutil
+import tempfile
+
+from fai import env
+
+NUM_FILES = 200
+NUM_CLASSES = 20
+
+
+def _tmpdir() -> str:
+    shm = '/dev/shm'
+    if os.access(shm, os.W_OK):
+        return tempfile.mkdtemp(prefix='pyfai-bench-', dir=shm)
+    return tempfile.mkdtemp(prefix='pyfai-bench-')
+
+
+@pytest.fixture(scope='session')
+def bench_root():
+    root = pathlib.Path(_tmpdir())
+    target = root / 'target'
+    (target / 'etc').mkdir(parents=True)
+    (target / 'etc/passwd'
+     ).write_text(f'root:x:{os.getuid()}:{os.getgid()}:root:/root:/bin/sh\n')
+    (target / 'etc/group').write_text(f'root:x:{os.getgid()}:\n')
+
+    classes = ['DEFAULT'] + [f'CLASS{i}' for i in range(1, NUM_CLASSES)]
+    files = root / 'config/files'
+    for i in range(NUM_FILES):
+        source = files / f'etc/bench/file{i}.conf'
+        source.mkdir(parents=True)
+        # every file has variants for half of the classes
+        for c in classes[i % 2::2]:
+            (source / c).write_text(f'{c} variant of file {i}\n' * 20)
+    (root / 'log').mkdir()
+    yield root, classes
+    shutil.rmtree(root)
+
+
+@pytest.fixture
+def bench_env(bench_root, monkeypatch):
+    root, classes = bench_root
+    monkeypatch.setattr(env, 'target', root / 'target')
+    monkeypatch.setattr(env, 'ROOTCMD', ['env'])
+    monkeypatch.setattr(env, 'CONFIG_SPACE', root / 'config')
+    monkeypatch.setattr(env, 'LOGDIR', root / 'log')
+    monkeypatch.setattr(env, 'classes', classes)
+    return root / 'target'
@@ -0,0 +1,97 @@
+import pytest
+
+import shutil
+
+from fai import files
+
+NUM_PATHS = 1000
+NUM_DIRS = 200
+
+PATHS = [
+    files.TargetPath(f'/srv/bench/dir{i % 10}/file{i}')
+    for i in range(NUM_PATHS)
+]
+
+
+def test_resolve(benchmark, bench_env):
+    benchmark(lambda: [files.resolve(p) for p in PATHS])
+
+
+def test_resolve_many(benchmark, bench_env):
+    benchmark(files.resolve_many, PATHS)
+
+
+def test_unresolve(benchmark, bench_env):
+    resolved = files.resolve_many(PATHS)
+    benchmark(lambda: [files.unresolve(p) for p in resolved])
+
+
+def test_unresolve_many(benchmark, bench_env):
+    resolved = files.resolve_many(PATHS)
+    benchmark(files.unresolve_many, resolved)
+
+
+@pytest.fixture
+def bench_files(bench_env):
+    for path in files.resolve_many(PATHS):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.touch()
+    yield
+    shutil.rmtree(bench_env / 'srv')
+
+
+def test_chmod(benchmark, bench_files):
+
+    def chmod():
+        for path in PATHS:
+            files.chmod(path, mode=0o640)
+
+    benchmark(chmod)
+
+
+def test_chmod_batch(benchmark, bench_files):
+
+    def chmod():
+        with files.batch():
+            for path in PATHS:
+                files.chmod(path, mode=0o640)
+
+    benchmark(chmod)
+
+
+def test_mkdir(benchmark, bench_env):
+    dirs = [files.TargetPath(f'/srv/mkdir/dir{i}') for i in range(NUM_DIRS)]
+
+    def mkdir():
+        for path in dirs:
+            files.mkdir(path)
+
+    benchmark.pedantic(mkdir,
+                       setup=lambda: shutil.rmtree(bench_env / 'srv', True),
+                       rounds=20)
+
+
+FCOPY_DIR = files.TargetPath('/etc/bench')
+
+
+def test_fcopy_native(benchmark, bench_env):
+
+    def cleanup():
+        shutil.rmtree(bench_env / 'etc/bench', True)
+        (bench_env / 'etc/bench').mkdir()
+
+    benchmark.pedantic(files.fcopy,
+                       args=(FCOPY_DIR, ),
+                       kwargs={
+                           'recursively': True,
+                           'native': True
+                       },
+                       setup=cleanup,
+                       rounds=10)
+
+
+def test_fcopy_native_unchanged(benchmark, bench_env):
+    (bench_env / 'etc/bench').mkdir(exist_ok=True)
+    files.fcopy(FCOPY_DIR, recursively=True, native=True)
+    changed = benchmark(files.fcopy, FCOPY_DIR, recursively=True, native=True)
+    assert not any(changed.values())
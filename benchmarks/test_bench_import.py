@@ -0,0 +1,36 @@
+import os
+import subprocess
+import sys
+
+
+def test_import(benchmark, bench_env):
+    environ = dict(os.environ,
+                   FAI=str(bench_env),
+                   target=str(bench_env),
+                   ROOTCMD='env',
+                   FAI_ACTION='install',
+                   LOGDIR=str(bench_env))
+    benchmark.pedantic(subprocess.run,
+                       args=([sys.executable, '-c', 'import fai'], ),
+                       kwargs={
+                           'env': environ,
+                           'check': True
+                       },
+                       rounds=20)
+
+
+def test_import_api(benchmark, bench_env):
+    environ = dict(os.environ,
+                   FAI=str(bench_env),
+                   target=str(bench_env),
+                   ROOTCMD='env',
+                   FAI_ACTION='install',
+                   LOGDIR=str(bench_env))
+    benchmark.pedantic(
+        subprocess.run,
+        args=([sys.executable, '-c', 'from fai import fcopy, run, target'], ),
+        kwargs={
+            'env': environ,
+            'check': True
+        },
+        rounds=20)
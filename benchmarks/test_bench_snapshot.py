@@ -0,0 +1,30 @@
+import pytest
+
+import shutil
+
+from fai import files, snapshot
+
+NUM_PATHS = 5000
+
+
+@pytest.fixture
+def bench_tree(bench_env):
+    paths = [
+        files.TargetPath(f'/srv/tree/dir{i % 50}/sub{i % 7}/file{i}')
+        for i in range(NUM_PATHS)
+    ]
+    for path in files.resolve_many(paths):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(path.name)
+    yield
+    shutil.rmtree(bench_env / 'srv')
+
+
+def test_take(benchmark, bench_tree):
+    benchmark(snapshot.take)
+
+
+def test_diff(benchmark, bench_tree):
+    before = snapshot.take(hash_files=True)
+    after = snapshot.take(previous=before)
+    benchmark(snapshot.diff, before, after)
@@ -0,0 +1,14 @@
+from fai import subprocess
+
+
+def test_run_installer(benchmark, bench_env):
+    benchmark(subprocess.run_installer, ['true'])
+
+
+def test_run(benchmark, bench_env):
+    benchmark(subprocess.run, ['true'])
+
+
+def test_run_worker(benchmark, bench_env):
+    with subprocess.Worker():
+        benchmark(subprocess.run, ['true'])
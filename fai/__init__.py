@@ -14,7 +14,11 @@
     * :any:`fai.files.resolve`
     * :any:`fai.files.unresolve`
     * :any:`fai.files.fcopy`
+
+    Submodules and re-exported elements are only imported on first access,
+    so that ``import fai`` is cheap for short-lived scripts.
 """
+import sys
 
 __version__ = None
 """ Package version
@@ -25,7 +29,54 @@ try:
 except ImportError:
     pass
 
-# pylint: disable=wrong-import-position
-from .env import *
-from .subprocess import run, run_installer
-from .files import InstallerPath, TargetPath, resolve, unresolve, fcopy
+_EXPORTS = {
+    **{
+        name: 'env'
+        for name in (
+            'classes',
+            'CONFIG_SPACE',
+            'target',
+            'ROOTCMD',
+            'ACTION',
+            'LOGDIR',
+            'Action',
+            'ClassSet',
+            'FaiContext',
+            'is_online',
+            'current',
+            'use',
+        )
+    },
+    'run': 'subprocess',
+    'run_installer': 'subprocess',
+    'InstallerPath': 'files',
+    'TargetPath': 'files',
+    'resolve': 'files',
+    'unresolve': 'files',
+    'fcopy': 'files',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def _import(name: str):
+    # like importlib.import_module, but without importing importlib
+    __import__(f'{__name__}.{name}')
+    return sys.modules[f'{__name__}.{name}']
+
+
+def __getattr__(name: str):
+    module = _EXPORTS.get(name)
+    if module is not None:
+        return getattr(_import(module), name)
+    if not name.startswith('__'):
+        try:
+            return _import(name)
+        except ModuleNotFoundError as e:
+            if e.name != f'{__name__}.{name}':
+                raise
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_EXPORTS))
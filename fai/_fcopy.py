@@ -0,0 +1,155 @@
+""" Config Space File Index
+    =======================
+
+    Index of the class variants in ``$FAI/files`` used by the native
+    :any:`fai.files.fcopy` engine.
+
+    In the config space, each file to install is represented by a directory
+    of the same path below ``files/``, which contains one variant per class::
+
+        files/etc/motd/DEFAULT
+        files/etc/motd/WEBSERVER
+
+    The index maps each such target path to its class variants. It is built
+    with a single walk over the config space and cached in memory and in
+    :any:`env.LOGDIR`, so that it is shared by all scripts of a FAI run. The
+    cache is keyed by the mtimes of all directories in the config space and
+    thus rebuilt whenever files are added or removed.
+"""
+from __future__ import annotations
+from typing import Dict, Iterator, List, NamedTuple, Optional
+import json
+import os
+import pathlib
+import threading
+
+from . import env
+
+SPECIAL_FILES = frozenset(['file-modes', 'postinst'])
+"""Names of files in a source directory that are not class variants
+
+Entries with any of these files are handled by `fcopy(8)`.
+"""
+
+CACHE_FILE = 'pyfai-fcopy-index.json'
+"""Name of the index cache file in :any:`env.LOGDIR`"""
+
+
+class Entry(NamedTuple):
+    """Index entry of a single target file"""
+    variants: List[str]
+    """class names with a variant of the file"""
+    special: bool
+    """whether the source directory contains :any:`SPECIAL_FILES`"""
+
+
+class Index:
+    """Index of the class variants below a ``files`` directory
+
+    :param root: ``files`` directory in the config space
+    :param dirs: mtime (in ns) of each directory below
+        :any:`root <Index.params.root>` by relative path
+    :param entries: index entries by absolute target path
+    """
+
+    def __init__(self, root: pathlib.Path, dirs: Dict[str, int],
+                 entries: Dict[str, Entry]):
+        self.root = root
+        self.dirs = dirs
+        self.entries = entries
+
+    @classmethod
+    def scan(cls, root: pathlib.Path) -> Index:
+        """Build index by walking the config space"""
+        dirs = {}
+        entries = {}
+        for dirpath, _, filenames in os.walk(root):
+            rel = os.path.relpath(dirpath, root)
+            dirs[rel] = os.stat(dirpath).st_mtime_ns
+            if not filenames:
+                continue
+            variants = sorted(f for f in filenames if f not in SPECIAL_FILES)
+            special = len(variants) != len(filenames)
+            target = '/' if rel == '.' else '/' + rel
+            entries[target] = Entry(variants, special)
+        return cls(root, dirs, entries)
+
+    def is_current(self) -> bool:
+        """Check if the config space is unchanged since indexing"""
+        if not self.dirs:
+            return False
+        try:
+            return all(
+                os.stat(os.path.join(self.root, rel)).st_mtime_ns == mtime
+                for rel, mtime in self.dirs.items())
+        except OSError:
+            return False
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Optional[Index]:
+        """Load index from a cache file
+
+        :return: loaded index or :any:`None` if the cache is unreadable
+        """
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+            return cls(pathlib.Path(data['root']), data['dirs'], {
+                target: Entry(*entry)
+                for target, entry in data['entries'].items()
+            })
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, path: pathlib.Path):
+        """Save index atomically to a cache file"""
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(
+                {
+                    'root': str(self.root),
+                    'dirs': self.dirs,
+                    'entries': self.entries,
+                }, f)
+        os.replace(tmp, path)
+
+    def find(self, target: str, recursively: bool = False) -> Iterator[str]:
+        """Find indexed target paths
+
+        :param target: absolute target path
+        :param recursively: also find all paths below
+            :any:`target <Index.find.params.target>`
+        """
+        if target in self.entries:
+            yield target
+        if recursively:
+            prefix = target.rstrip('/') + '/'
+            yield from sorted(t for t in self.entries if t.startswith(prefix))
+
+
+_lock = threading.Lock()
+_indexes: Dict[pathlib.Path, Index] = {}
+
+
+def get_index() -> Index:
+    """Get an up-to-date index of ``$FAI/files``
+
+    The index is taken from memory or from the cache file in
+    :any:`env.LOGDIR` if still current, and rebuilt otherwise.
+    """
+    ctx = env.current()
+    root = ctx.CONFIG_SPACE / 'files'
+    cache = ctx.LOGDIR / CACHE_FILE if ctx.LOGDIR is not None else None
+    with _lock:
+        index = _indexes.get(root)
+        if index is None or not index.is_current():
+            index = Index.load(cache) if cache is not None else None
+            if index is None or index.root != root or not index.is_current():
+                index = Index.scan(root)
+                if cache is not None:
+                    try:
+                        index.save(cache)
+                    except OSError:
+                        pass  # cache is just an optimization
+        _indexes[root] = index
+        return index
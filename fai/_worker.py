@@ -0,0 +1,87 @@
+""" Command Worker
+    ==============
+
+    This script is run inside the target system by
+    :any:`fai.subprocess.Worker`. It reads one JSON request per line from
+    stdin, runs the requested command, and writes one JSON response per line
+    to stdout.
+
+    It is executed by the target's Python interpreter, so it must neither
+    import anything from :py:mod:`fai` nor use syntax newer than Python 3.5.
+"""
+import base64
+import json
+import subprocess
+import sys
+
+_STREAMS = {
+    'pipe': subprocess.PIPE,
+    'devnull': subprocess.DEVNULL,
+    'stdout': subprocess.STDOUT,
+    'inherit': None,
+}
+
+
+def _encode(data):
+    if data is None:
+        return None
+    return base64.b64encode(data).decode('ascii')
+
+
+def handle(request):
+    """Run a single request and return the response"""
+    stdin = request.get('input')
+    if stdin is not None:
+        stdin = base64.b64decode(stdin)
+    try:
+        result = subprocess.run(
+            request['args'],
+            check=False,  # the caller checks the returncode
+            input=stdin,
+            # never pass on our stdin: it is the request pipe
+            stdin=subprocess.DEVNULL if stdin is None else None,
+            stdout=_STREAMS[request['stdout']],
+            stderr=_STREAMS[request['stderr']],
+            env=request.get('env'),
+            timeout=request.get('timeout'),
+        )
+    except subprocess.TimeoutExpired as e:
+        return {
+            'timeout': True,
+            'stdout': _encode(e.output),
+            'stderr': _encode(e.stderr),
+        }
+    except OSError as e:
+        # mimic the exit codes of a shell/chroot(8) failing to run a command
+        # no f-string: the target's Python may be older than 3.6
+        message = request['args'][0] + ': ' + e.strerror + '\n'
+        stderr = None
+        if request['stderr'] == 'pipe':
+            stderr = _encode(message.encode())
+        else:
+            sys.stderr.write(message)
+        return {
+            'returncode': 127 if isinstance(e, FileNotFoundError) else 126,
+            'stdout': _encode(b'') if request['stdout'] == 'pipe' else None,
+            'stderr': stderr,
+        }
+    return {
+        'returncode': result.returncode,
+        'stdout': _encode(result.stdout),
+        'stderr': _encode(result.stderr),
+    }
+
+
+def main():
+    """Serve requests until stdin is closed"""
+    while True:
+        line = sys.stdin.buffer.readline()
+        if not line:
+            break
+        response = handle(json.loads(line.decode()))
+        sys.stdout.buffer.write(json.dumps(response).encode() + b'\n')
+        sys.stdout.buffer.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,404 @@
+""" Accounts
+    ========
+
+    Declarative provisioning of users and groups in the target system.
+
+    Instead of running ``groupadd``, ``useradd``, and ``usermod`` once per
+    account in the target, :any:`provision` reads ``/etc/passwd``,
+    ``/etc/group``, ``/etc/shadow``, and ``/etc/gshadow`` once, applies all
+    declared accounts in memory, and writes each changed file once. The
+    files are locked like by the shadow tools (``/etc/.pwd.lock``) and
+    replaced atomically, keeping their owner and mode::
+
+        accounts.provision(
+            groups=[accounts.Group('developers')],
+            users=[
+                accounts.User('alice', groups=('developers', 'sudo')),
+                accounts.User('prometheus', system=True),
+            ],
+        )
+
+    Provisioning is additive: accounts and group memberships that are not
+    declared are kept. Home directories are not created.
+"""
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import contextlib
+import dataclasses
+import fcntl
+import os
+import re
+import time
+
+from . import files
+
+PASSWD = files.TargetPath('/etc/passwd')
+GROUP = files.TargetPath('/etc/group')
+SHADOW = files.TargetPath('/etc/shadow')
+GSHADOW = files.TargetPath('/etc/gshadow')
+LOCK_FILE = files.TargetPath('/etc/.pwd.lock')
+"""Lock file of the account databases (see ``lckpwdf(3)``)"""
+
+LOGIN_DEFS = files.TargetPath('/etc/login.defs')
+
+_NAME = re.compile(r'[a-z_][a-z0-9_-]*\$?\Z')
+"""Valid user and group names like for ``useradd``/``groupadd``"""
+
+_NAME_MAX = 32
+
+_ID_DEFAULTS = {
+    'UID_MIN': 1000,
+    'UID_MAX': 60000,
+    'SYS_UID_MIN': 100,
+    'SYS_UID_MAX': 999,
+    'GID_MIN': 1000,
+    'GID_MAX': 60000,
+    'SYS_GID_MIN': 100,
+    'SYS_GID_MAX': 999,
+}
+
+
+@dataclasses.dataclass(frozen=True)
+class Group:
+    """ Declared group
+
+    :any:`None` values are taken from the existing group or allocated.
+    """
+    name: str
+    gid: Optional[int] = None
+    system: bool = False
+    """allocate the ID from the system group range"""
+    members: Tuple[str, ...] = ()
+    """users added as members"""
+
+
+@dataclasses.dataclass(frozen=True)
+class User:
+    """ Declared user
+
+    :any:`None` values are taken from the existing user or set to defaults
+    for new users.
+    """
+    name: str
+    uid: Optional[int] = None
+    group: Optional[str] = None
+    """primary group (default: a new group named like the user)"""
+    groups: Tuple[str, ...] = ()
+    """supplementary groups the user is added to"""
+    gecos: Optional[str] = None
+    home: Optional[str] = None
+    """home directory (default: ``/home/<name>``, ``/nonexistent`` for system
+    users)"""
+    shell: Optional[str] = None
+    """login shell (default: ``/bin/sh``, ``/usr/sbin/nologin`` for system
+    users)"""
+    password: Optional[str] = None
+    """hashed password for ``/etc/shadow`` (default: ``!``, i.e., locked)"""
+    system: bool = False
+    """allocate the IDs from the system ranges"""
+
+
+class _Table:
+    """ Colon-separated account database file
+
+    :param path: database file in the target system
+    :param required: raise :any:`FileNotFoundError` if the file is missing
+        instead of leaving it alone
+
+    Lines are kept in order; comments and NIS entries are passed through.
+    """
+
+    def __init__(self, path: files.TargetPath, required: bool = False):
+        self.path = path
+        self.changed = False
+        self._installer_path = files.resolve(path)
+        self._rows: List[List[str]] = []
+        self._index: Dict[str, int] = {}
+        try:
+            with open(self._installer_path,
+                      encoding='utf-8',
+                      errors='surrogateescape') as f:
+                for line in f:
+                    line = line.rstrip('\n')
+                    if not line or line[0] in '#+-':
+                        self._rows.append([line])
+                        continue
+                    fields = line.split(':')
+                    self._index.setdefault(fields[0], len(self._rows))
+                    self._rows.append(fields)
+            self.exists = True
+        except FileNotFoundError:
+            if required:
+                raise
+            self.exists = False
+
+    def __iter__(self):
+        for i in self._index.values():
+            yield self._rows[i]
+
+    def get(self, name: str) -> Optional[List[str]]:
+        """Get the fields of an entry
+
+        :param name: name of the account
+        :return: a copy of the fields or :any:`None` if there is no entry
+        """
+        i = self._index.get(name)
+        return list(self._rows[i]) if i is not None else None
+
+    def set(self, fields: List[str]):
+        """Add or replace an entry
+
+        :param fields: fields of the entry, starting with the account name
+        """
+        i = self._index.get(fields[0])
+        if i is None:
+            self._index[fields[0]] = len(self._rows)
+            self._rows.append(fields)
+        elif self._rows[i] != fields:
+            self._rows[i] = fields
+        else:
+            return
+        self.changed = True
+
+    def save(self):
+        """Replace the file atomically if it changed"""
+        if not self.exists or not self.changed:
+            return
+        path = self._installer_path
+        stat = os.stat(path)
+        tmp = path.with_name(f'+{path.name}.{os.getpid()}')
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC,
+                     0o600)
+        try:
+            os.fchown(fd, stat.st_uid, stat.st_gid)
+            os.fchmod(fd, stat.st_mode & 0o7777)
+            with open(fd,
+                      'w',
+                      encoding='utf-8',
+                      errors='surrogateescape',
+                      closefd=False) as f:
+                for fields in self._rows:
+                    f.write(':'.join(fields) + '\n')
+            os.fsync(fd)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+        self.changed = False
+
+
+@contextlib.contextmanager
+def _locked():
+    """Hold the lock of the account databases like ``lckpwdf(3)``"""
+    fd = os.open(files.resolve(LOCK_FILE),
+                 os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600)
+    try:
+        fcntl.lockf(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        os.close(fd)
+
+
+def _login_defs() -> Dict[str, int]:
+    """Read the ID ranges from the target's ``login.defs``"""
+    result = dict(_ID_DEFAULTS)
+    try:
+        with open(files.resolve(LOGIN_DEFS), encoding='utf-8') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) >= 2 and fields[0] in result and \
+                        fields[1].isdigit():
+                    result[fields[0]] = int(fields[1])
+    except FileNotFoundError:
+        pass
+    return result
+
+
+class _Allocator:
+    """ID allocation within the ranges of ``login.defs``"""
+
+    def __init__(self, kind: str, used: Set[int], defs: Dict[str, int]):
+        self.used = used
+        self._range = (defs[f'{kind}_MIN'], defs[f'{kind}_MAX'])
+        self._sys_range = (defs[f'SYS_{kind}_MIN'], defs[f'SYS_{kind}_MAX'])
+
+    def allocate(self, system: bool, preferred: Optional[int] = None) -> int:
+        """Allocate a free ID
+
+        :param system: allocate from the top of the system range instead of
+            the bottom of the normal range
+        :param preferred: ID to take if free and in range
+        :raise ValueError: if the range is exhausted
+        """
+        low, high = self._sys_range if system else self._range
+        if preferred is not None and low <= preferred <= high and \
+                preferred not in self.used:
+            candidates = iter([preferred])
+        elif system:
+            candidates = iter(range(high, low - 1, -1))
+        else:
+            candidates = iter(range(low, high + 1))
+        for i in candidates:
+            if i not in self.used:
+                self.used.add(i)
+                return i
+        raise ValueError(f'no free ID in {low}-{high}')
+
+
+def _check_name(name: str, kind: str):
+    if len(name) > _NAME_MAX or not _NAME.match(name):
+        raise ValueError(f'invalid {kind} name: {name!r}')
+
+
+def _check(users: List[User], groups: List[Group]):
+    """Validate declarations before anything is changed
+
+    :raise ValueError: on invalid names or fields that would corrupt the
+        databases
+    """
+    for g in groups:
+        _check_name(g.name, 'group')
+        for member in g.members:
+            _check_name(member, 'user')
+    for u in users:
+        _check_name(u.name, 'user')
+        for name in ((u.group, ) if u.group is not None else ()) + u.groups:
+            _check_name(name, 'group')
+        for field in ('gecos', 'home', 'shell', 'password'):
+            value = getattr(u, field)
+            if value is not None and (':' in value or '\n' in value):
+                raise ValueError(
+                    f'invalid {field} of user {u.name}: {value!r}')
+
+
+def provision(users: Iterable[User] = (),
+              groups: Iterable[Group] = ()) -> List[files.TargetPath]:
+    """Create or update users and groups in the target system
+
+    :param users: declared users
+    :param groups: declared groups
+    :return: changed database files
+    :raise ValueError: if a name is invalid (like for ``useradd``), a field
+        contains ``:`` or a line break, an ID conflicts with an existing
+        account, an ID range is exhausted, or a referenced group or group
+        member is neither existing nor declared
+    :raise FileNotFoundError: if ``/etc/passwd`` or ``/etc/group`` is missing
+        in the target
+
+    Groups are applied before users. New users get a primary group of the
+    same name unless :any:`User.group` is set, with the user's ID as group
+    ID if free. Supplementary groups (:any:`User.groups` and
+    :any:`Group.members`) are only added, never removed.
+
+    Nothing is written if any declaration is invalid.
+    """
+    users = list(users)
+    groups = list(groups)
+    _check(users, groups)
+    with _locked():
+        passwd, shadow = _Table(PASSWD, required=True), _Table(SHADOW)
+        group, gshadow = _Table(GROUP, required=True), _Table(GSHADOW)
+        defs = _login_defs()
+        uids = _Allocator('UID', {int(r[2])
+                                  for r in passwd if _is_id(r, 2)}, defs)
+        gids = _Allocator('GID', {int(r[2])
+                                  for r in group if _is_id(r, 2)}, defs)
+        today = str(int(time.time()) // 86400)
+
+        def ensure_group(name: str,
+                         gid: Optional[int],
+                         system: bool,
+                         preferred: Optional[int] = None) -> int:
+            row = group.get(name)
+            if row is not None:
+                if gid is not None and int(row[2]) != gid:
+                    raise ValueError(f'group {name} exists with GID {row[2]}')
+                return int(row[2])
+            if gid is None:
+                gid = gids.allocate(system, preferred)
+            elif gid in gids.used:
+                raise ValueError(f'GID {gid} of group {name} is in use')
+            gids.used.add(gid)
+            group.set([name, 'x', str(gid), ''])
+            if gshadow.exists:
+                gshadow.set([name, '!', '', ''])
+            return gid
+
+        def add_member(name: str, user: str):
+            for table, field in ((group, 3), (gshadow, 3)):
+                row = table.get(name)
+                if row is None:
+                    if table is group:
+                        raise ValueError(f'group {name} does not exist')
+                    continue
+                while len(row) <= field:
+                    row.append('')
+                members = [m for m in row[field].split(',') if m]
+                if user not in members:
+                    row[field] = ','.join(members + [user])
+                    table.set(row)
+
+        for g in groups:
+            ensure_group(g.name, g.gid, g.system)
+
+        for u in users:
+            row = passwd.get(u.name)
+            if row is not None and u.uid is not None and int(row[2]) != u.uid:
+                raise ValueError(f'user {u.name} exists with UID {row[2]}')
+            if row is None:
+                if u.uid is None:
+                    uid = uids.allocate(u.system)
+                elif u.uid in uids.used:
+                    raise ValueError(f'UID {u.uid} of user {u.name} is in use')
+                else:
+                    uid = u.uid
+                    uids.used.add(uid)
+                row = [
+                    u.name, 'x',
+                    str(uid), '', '',
+                    '/nonexistent' if u.system else f'/home/{u.name}',
+                    '/usr/sbin/nologin' if u.system else '/bin/sh'
+                ]
+                if u.group is None:
+                    row[3] = str(ensure_group(u.name, None, u.system, uid))
+            if u.group is not None:
+                grow = group.get(u.group)
+                if grow is None:
+                    raise ValueError(f'group {u.group} does not exist')
+                row[3] = grow[2]
+            for i, value in ((4, u.gecos), (5, u.home), (6, u.shell)):
+                if value is not None:
+                    row[i] = value
+            passwd.set(row)
+
+            if shadow.exists:
+                srow = shadow.get(u.name)
+                if srow is None:
+                    srow = [u.name, '!', today, '0', '99999', '7', '', '', '']
+                if u.password is not None and srow[1] != u.password:
+                    srow[1] = u.password
+                    srow[2] = today
+                shadow.set(srow)
+
+            for name in u.groups:
+                add_member(name, u.name)
+
+        for g in groups:
+            for member in g.members:
+                if passwd.get(member) is None:
+                    raise ValueError(
+                        f'member {member} of group {g.name} does not exist')
+                add_member(g.name, member)
+
+        changed = []
+        for table in (passwd, shadow, group, gshadow):
+            if table.exists and table.changed:
+                table.save()
+                changed.append(table.path)
+        return changed
+
+
+def _is_id(row: List[str], field: int) -> bool:
+    return len(row) > field and row[field].isdigit()
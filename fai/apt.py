@@ -0,0 +1,209 @@
+""" Package Transactions
+    ====================
+
+    Collect debconf answers and package requests of a script and apply them
+    together::
+
+        with apt.Transaction() as t:
+            t.preseed('tzdata', 'tzdata/Areas', 'select', 'Europe')
+            t.install('openssh-server', 'chrony')
+            t.purge('nano')
+            t.hold('linux-image-amd64')
+
+    Instead of one ``debconf-set-selections`` and one ``apt-get`` process per
+    request (each with a chroot, a load of the apt cache, and a cycle of the
+    dpkg lock), the answers are fed to a single ``debconf-set-selections``
+    and all packages are installed and removed by a single ``apt-get``
+    transaction. Its output is copied to :any:`env.LOGDIR` if set.
+
+    Requests are deduplicated and checked for conflicts while they are
+    queued, and requests already fulfilled according to the dpkg status
+    database (see :py:mod:`fai.packages`) are dropped, so that nothing is run
+    at all if there is nothing to do.
+"""
+from __future__ import annotations
+from typing import Dict, List, Sequence, Tuple
+from subprocess import STDOUT
+import os
+import re
+
+from . import env, packages, subprocess
+
+APT_GET = ('apt-get', '-y', '-o', 'Dpkg::Options::=--force-confdef', '-o',
+           'Dpkg::Options::=--force-confold')
+"""Command to install and remove packages"""
+
+_ACTIONS = {'install': '', 'remove': '-', 'purge': '_'}
+
+
+def _name(spec: str) -> str:
+    """Strip the version or release from a package specification"""
+    return re.split('[=/]', spec, 1)[0]
+
+
+class Transaction:
+    """ Queue of debconf answers and package requests
+
+    Used as context manager, the transaction is committed when the context
+    is left without exception.
+
+    :raise ValueError: when a request conflicts with an earlier request
+    """
+
+    def __init__(self):
+        self._preseeds: Dict[Tuple[str, str], Tuple[str, str]] = {}
+        self._actions: Dict[str, Tuple[str, str]] = {}
+        self._holds: Dict[str, bool] = {}
+
+    def preseed(self, owner: str, question: str, type_: str, value: str):
+        """Queue a debconf answer
+
+        :param owner: package owning the question (e.g. ``tzdata``)
+        :param question: name of the question (e.g. ``tzdata/Areas``)
+        :param type_: type of the question (e.g. ``select``)
+        :param value: answer
+        """
+        answer = (type_, value)
+        old = self._preseeds.setdefault((owner, question), answer)
+        if old != answer:
+            raise ValueError(f'conflicting answers for {question}: '
+                             f'{" ".join(old)!r} and {" ".join(answer)!r}')
+
+    def _queue(self, action: str, specs: Sequence[str]):
+        for spec in specs:
+            name = _name(spec)
+            old = self._actions.setdefault(name, (action, spec))
+            if old == (action, spec):
+                continue
+            if {old[0], action} == {'remove', 'purge'}:
+                self._actions[name] = ('purge', name)
+            else:
+                raise ValueError(f'conflicting requests for {name}: '
+                                 f'{old[0]} {old[1]} and {action} {spec}')
+
+    def install(self, *specs: str):
+        """Queue packages for installation
+
+        :param specs: package names, optionally with ``:arch``, ``=version``,
+            or ``/release``
+        """
+        self._queue('install', specs)
+
+    def remove(self, *names: str):
+        """Queue packages for removal (keeping their configuration)
+
+        :param names: package names, optionally with ``:arch``
+        """
+        self._queue('remove', names)
+
+    def purge(self, *names: str):
+        """Queue packages for removal including their configuration
+
+        :param names: package names, optionally with ``:arch``
+        """
+        self._queue('purge', names)
+
+    def _mark(self, names: Sequence[str], hold: bool):
+        for name in names:
+            if self._holds.setdefault(name, hold) != hold:
+                raise ValueError(f'conflicting requests for {name}: '
+                                 'hold and unhold')
+
+    def hold(self, *names: str):
+        """Queue packages to be held at their version
+
+        :param names: package names, optionally with ``:arch``
+
+        Packages are held after the installation, so they can be installed
+        or upgraded in the same transaction.
+        """
+        self._mark(names, True)
+
+    def unhold(self, *names: str):
+        """Queue packages to be released from hold
+
+        :param names: package names, optionally with ``:arch``
+
+        Packages are released before the installation.
+        """
+        self._mark(names, False)
+
+    def _pending(self, status: packages.Status) -> List[str]:
+        """Get the arguments for ``apt-get install`` that change anything"""
+        args = []
+        for name, (action, spec) in self._actions.items():
+            package = status.get(name)
+            if action == 'install':
+                if spec == name and package is not None and \
+                        package.is_installed:
+                    continue
+            elif action == 'remove':
+                if package is None or not package.is_installed:
+                    continue
+            elif package is None or package.state == 'not-installed':
+                continue
+            args.append(spec + _ACTIONS[action])
+        return args
+
+    def commit(self, *, options: Sequence[str] = ()) -> bool:
+        """Apply all queued requests
+
+        :param options: additional options for ``apt-get``
+        :return: whether any command was run
+        :raise subprocess.CalledProcessError: if a command fails
+
+        The requests are applied in this order, each with at most one
+        command in the target system:
+
+        1. debconf answers
+        2. :any:`unhold`
+        3. :any:`install`, :any:`remove`, and :any:`purge`
+        4. :any:`hold`
+        """
+        status = packages.status()
+        marks: Dict[bool, List[str]] = {True: [], False: []}
+        for name, hold in self._holds.items():
+            package = status.get(name)
+            held = package is not None and package.status.startswith('hold ')
+            if held != hold:
+                marks[hold].append(name)
+        args = self._pending(status)
+
+        if self._preseeds:
+            subprocess.run(
+                ['debconf-set-selections'],
+                input=''.join(
+                    f'{owner} {question} {type_} {value}\n'
+                    for (owner, question), (type_,
+                                            value) in self._preseeds.items()),
+                universal_newlines=True,
+                check=True)
+        if marks[False]:
+            subprocess.run(['apt-mark', 'unhold', '--', *marks[False]],
+                           check=True)
+        if args:
+            with subprocess.run_stream(
+                [*APT_GET, *options, 'install', '--', *args],
+                    tee=env.current().LOGDIR is not None,
+                    stderr=STDOUT,
+                    env={
+                        **os.environ, 'DEBIAN_FRONTEND': 'noninteractive'
+                    }) as stream:
+                for _ in stream:
+                    pass
+        if marks[True]:
+            subprocess.run(['apt-mark', 'hold', '--', *marks[True]],
+                           check=True)
+
+        ran = bool(self._preseeds or marks[False] or args or marks[True])
+        self._preseeds.clear()
+        self._actions.clear()
+        self._holds.clear()
+        return ran
+
+    def __enter__(self) -> Transaction:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
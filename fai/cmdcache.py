@@ -0,0 +1,330 @@
+""" Command Cache
+    =============
+
+    Many commands run by customization scripts are pure queries (e.g.,
+    ``dpkg --print-architecture`` or ``systemd-detect-virt``), which are
+    repeated by every script of a FAI run. With ``cache=True``,
+    :any:`fai.subprocess.run` and :any:`fai.subprocess.run_installer` store
+    the result of such a command in a cache file (:any:`CACHE_FILE` in
+    :any:`env.LOGDIR`), which is shared by all scripts of the run. Later calls
+    of the same command return the stored result without running it again::
+
+        arch = run(['dpkg', '--print-architecture'], cache=True).stdout
+
+    Entries are keyed by the command line (including :any:`env.ROOTCMD`), the
+    target, the arguments affecting the output (e.g., ``env``, ``input``,
+    ``universal_newlines``), and, without ``env`` argument, the locale and
+    ``$PATH`` of the environment. They are dropped
+
+    * when one of the files passed as ``watch`` changed (by mtime, size or
+      inode) or appeared or disappeared,
+    * explicitly by :any:`clear`, or
+    * when more than :any:`MAX_ENTRIES` commands are cached, least recently
+      used first.
+
+    Output not captured by the caller (``stdout=None`` or ``stderr=None``,
+    i.e., inherited) is captured and stored as well, and written to
+    :py:data:`sys.stdout` or :py:data:`sys.stderr` on every call, so a cached
+    command prints the same as when it is run.
+
+    Without :any:`env.LOGDIR`, results are only cached within the process.
+    Only use the cache for commands without side effects whose output does
+    not change during the run unless one of the watched files changes.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Sequence
+import atexit
+import base64
+import fcntl
+import json
+import os
+import pathlib
+import subprocess
+import sys
+import threading
+import time
+
+from . import env
+
+CACHE_FILE = 'pyfai-command-cache.json'
+"""Name of the cache file in :any:`env.LOGDIR`"""
+
+MAX_ENTRIES = 512
+"""Maximum number of cached commands"""
+
+_ENVIRON_KEYS = ('LC_ALL', 'LC_MESSAGES', 'LC_CTYPE', 'LANG', 'PATH')
+
+
+def _key(argv: Sequence[str], kwargs: Dict[str, Any]) -> str:
+    """Build the cache key of a command
+
+    :raise ValueError: if the command's arguments cannot be cached
+    """
+    # pylint: disable=import-outside-toplevel; fai.subprocess imports this module
+    from .subprocess import _WORKER_KWARGS, _WORKER_STREAMS
+    unsupported = set(kwargs) - _WORKER_KWARGS - {'cwd'}
+    if unsupported:
+        raise ValueError('cannot cache command with argument(s) ' +
+                         ', '.join(sorted(unsupported)))
+    try:
+        streams = [
+            _WORKER_STREAMS[kwargs.get('stdout')],
+            _WORKER_STREAMS[kwargs.get('stderr')]
+        ]
+    except (KeyError, TypeError):
+        raise ValueError('cannot cache command with custom stdout/stderr') \
+            from None
+    stdin = kwargs.get('input')
+    if isinstance(stdin, bytes):
+        stdin = _encode(stdin)
+    environ = kwargs.get('env')
+    if environ is None:
+        environ = {k: os.environ.get(k) for k in _ENVIRON_KEYS}
+    target = env.current().target
+    return json.dumps(
+        [
+            [str(a) for a in argv],
+            str(target) if target is not None else None,
+            sorted(environ.items()),
+            str(kwargs['cwd']) if kwargs.get('cwd') is not None else None,
+            stdin,
+            streams,
+            bool(kwargs.get('universal_newlines') or kwargs.get('text')),
+            kwargs.get('encoding'),
+            kwargs.get('errors'),
+        ],
+        default=str,
+    )
+
+
+def _encode(data):
+    if isinstance(data, bytes):
+        return {'b64': base64.b64encode(data).decode('ascii')}
+    return data
+
+
+def _decode(data):
+    if isinstance(data, dict):
+        return base64.b64decode(data['b64'])
+    return data
+
+
+def _replay(output, stream):
+    """Write output of a command that was not captured by the caller"""
+    if output:
+        stream.flush()
+        if isinstance(output, bytes):
+            stream.buffer.write(output)
+        else:
+            stream.write(output)
+        stream.flush()
+
+
+def _stat(path: pathlib.Path) -> Optional[List[int]]:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size, stat.st_ino]
+
+
+def _evict(entries: Dict[str, dict]):
+    """Drop the least recently used entries beyond :any:`MAX_ENTRIES`"""
+    if len(entries) > MAX_ENTRIES:
+        lru = sorted(entries, key=lambda k: entries[k]['used'])
+        for key in lru[:len(entries) - MAX_ENTRIES]:
+            del entries[key]
+
+
+class _Cache:
+    """Cache entries of one cache file, shared with other processes
+
+    :param path: cache file or :any:`None` to keep entries in memory only
+    """
+
+    def __init__(self, path: Optional[pathlib.Path]):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries: Dict[str, dict] = {}
+        self._loaded = None
+        self._used = set()
+
+    def _read(self) -> Dict[str, dict]:
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                entries = json.load(f)
+            if isinstance(entries, dict):
+                return entries
+        except (OSError, ValueError):
+            pass  # a broken cache only means that commands are run again
+        return {}
+
+    def _refresh(self):
+        """Reload the cache file if another process changed it"""
+        if self.path is None:
+            return
+        stat = _stat(self.path)
+        if stat != self._loaded:
+            self._entries = self._read()
+            self._loaded = stat
+
+    def _write(self, update):
+        """Update the cache file under an exclusive lock
+
+        :param update: function to modify the entries read from the file
+        """
+        if self.path is None:
+            update(self._entries)
+            _evict(self._entries)
+            return
+        lock = self.path.with_name(f'.{self.path.name}.lock')
+        try:
+            fd = os.open(lock, os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        except OSError:
+            # e.g., read-only log directory
+            update(self._entries)
+            _evict(self._entries)
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            entries = self._read()
+            for key in self._used:
+                if key in entries and key in self._entries:
+                    entries[key]['used'] = self._entries[key]['used']
+            self._used.clear()
+            update(entries)
+            _evict(entries)
+            tmp = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.path)
+            self._entries = entries
+            self._loaded = _stat(self.path)
+        finally:
+            os.close(fd)
+
+    def lookup(self, key: str) -> Optional[dict]:
+        """Get a valid entry"""
+        with self._lock:
+            self._refresh()
+            entry = self._entries.get(key)
+            if entry is None or any(
+                    _stat(pathlib.Path(path)) != stat
+                    for path, stat in entry['watch']):
+                return None
+            entry['used'] = time.time()
+            self._used.add(key)
+            return entry
+
+    def store(self, key: str, entry: dict):
+        """Add an entry"""
+        with self._lock:
+            self._write(lambda entries: entries.__setitem__(key, entry))
+
+    def clear(self, command: Optional[Sequence[str]]):
+        """Remove all entries or the ones of a command"""
+
+        def remove(entries):
+            for key in list(entries):
+                if command is None or entries[key]['command'] == command:
+                    del entries[key]
+
+        with self._lock:
+            self._write(remove)
+
+    def save(self):
+        """Save the usage times of entries found in the cache"""
+        with self._lock:
+            if self._used:
+                self._write(lambda entries: None)
+
+
+_caches: Dict[Optional[pathlib.Path], _Cache] = {}
+_caches_lock = threading.Lock()
+
+
+def _for_logdir() -> _Cache:
+    logdir = env.current().LOGDIR
+    path = logdir / CACHE_FILE if logdir is not None else None
+    with _caches_lock:
+        cache = _caches.get(path)
+        if cache is None:
+            cache = _caches[path] = _Cache(path)
+        return cache
+
+
+def run(
+    argv: Sequence[str],
+    kwargs: Dict[str, Any],
+    runner,
+    *,
+    command: Optional[Sequence[str]] = None,
+    watch: Iterable[pathlib.Path] = ()
+) -> subprocess.CompletedProcess:
+    """Run a command through the cache
+
+    :param argv: complete command line
+    :param kwargs: arguments like for :any:`python:subprocess.run`, including
+        ``check``
+    :param runner: function to run the command with the given arguments
+        (with ``check`` disabled) if it is not cached
+    :param command: command as passed by the caller (e.g., without
+        :any:`env.ROOTCMD`; default: ``argv``)
+    :param watch: files in the installer system the result depends on
+    :return: process result
+    :raise ValueError: if the arguments cannot be cached
+    :raise subprocess.CalledProcessError: when command is ``check``\\ ed and
+        exits with error
+    """
+    key = _key(argv, kwargs)
+    cache = _for_logdir()
+    entry = cache.lookup(key)
+    if entry is None:
+        # stat before running: changes while running invalidate the entry
+        watched = [[str(p), _stat(p)] for p in watch]
+        run_kwargs = dict(kwargs, check=False)
+        for name in ('stdout', 'stderr'):
+            if kwargs.get(name) is None:
+                run_kwargs[name] = subprocess.PIPE
+        result = runner(run_kwargs)
+        entry = {
+            'command': [str(a) for a in (command or argv)],
+            'watch': watched,
+            'returncode': result.returncode,
+            'stdout': _encode(result.stdout),
+            'stderr': _encode(result.stderr),
+            'used': time.time(),
+        }
+        cache.store(key, entry)
+    stdout, stderr = _decode(entry['stdout']), _decode(entry['stderr'])
+    # inherited output is replayed instead of returned
+    if kwargs.get('stdout') is None:
+        _replay(stdout, sys.stdout)
+        stdout = None
+    if kwargs.get('stderr') is None:
+        _replay(stderr, sys.stderr)
+        stderr = None
+    result = subprocess.CompletedProcess(list(argv), entry['returncode'],
+                                         stdout, stderr)
+    if kwargs.get('check'):
+        result.check_returncode()
+    return result
+
+
+def clear(command: Optional[Sequence[str]] = None):
+    """Drop cached commands
+
+    :param command: only drop the results of this command (as passed to
+        :any:`fai.subprocess.run` or :any:`fai.subprocess.run_installer`;
+        default: drop all)
+    """
+    _for_logdir().clear([str(a)
+                         for a in command] if command is not None else None)
+
+
+@atexit.register
+def _save_all():
+    for cache in list(_caches.values()):
+        try:
+            cache.save()
+        except OSError:
+            pass  # the cache is just an optimization
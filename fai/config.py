@@ -0,0 +1,160 @@
+""" Config Space Data
+    =================
+
+    Cached access to per-class data in the config space
+    (:any:`env.CONFIG_SPACE`), e.g., class variables and package lists::
+
+        from fai import config
+
+        timezone = config.variables().get('TIMEZONE', 'UTC')
+        for package_list in config.package_config():
+            print(package_list.method, package_list.packages)
+
+    Each file is parsed only once per process and only parsed again if it
+    changed (by mtime, size or inode), so repeated lookups from many places
+    of a script are cheap. Files of several classes are combined in the
+    order of :any:`env.classes`, i.e., the class with the highest priority
+    comes last.
+"""
+from __future__ import annotations
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+import os
+import pathlib
+import re
+import threading
+
+from . import env
+
+_VARIABLE = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+
+_lock = threading.Lock()
+_cache: Dict[Tuple[pathlib.Path, Callable], Tuple[tuple, Any]] = {}
+
+
+def load(path: pathlib.Path, parser: Callable[[pathlib.Path], Any]) -> Any:
+    """Parse a file unless already parsed
+
+    :param path: file in the installer system
+    :param parser: function parsing the file
+    :return: result of :any:`parser <load.params.parser>`, shared by all
+        callers (do not modify)
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    with _lock:
+        cached_key, value = _cache.get((path, parser), (None, None))
+        if key != cached_key:
+            value = parser(path)
+            _cache[(path, parser)] = (key, value)
+        return value
+
+
+def _list_dir(path: pathlib.Path) -> List[str]:
+    return os.listdir(path)
+
+
+def class_files(directory: str, suffix: str = '') -> List[pathlib.Path]:
+    """Find the files of the defined classes in a config space directory
+
+    :param directory: directory relative to :any:`env.CONFIG_SPACE`, e.g.
+        ``class`` or ``package_config``
+    :param suffix: suffix of the files after the class name, e.g. ``.var``
+    :return: existing files in ascending class priority
+    """
+    ctx = env.current()
+    path = ctx.CONFIG_SPACE / directory
+    try:
+        names = load(path, _list_dir)
+    except FileNotFoundError:
+        return []
+    candidates = (n[:len(n) - len(suffix)] for n in names
+                  if n.endswith(suffix))
+    return [path / (c + suffix) for c in ctx.classes.ordered(candidates)]
+
+
+def parse_variables(path: pathlib.Path) -> Dict[str, str]:
+    """Read the variable assignments of a shell fragment
+
+    :param path: file like ``class/DEFAULT.var``
+    :return: values by variable name
+
+    Only plain (optionally ``export``\\ ed) assignments are read. Values are
+    unquoted but not expanded; other shell code is ignored.
+    """
+    import shlex  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    result = {}
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError:
+                continue  # e.g. a multi-line string
+            if words[:1] == ['export']:
+                words = words[1:]
+            if len(words) != 1:
+                continue
+            name, sep, value = words[0].partition('=')
+            if sep and _VARIABLE.match(name):
+                result[name] = value
+    return result
+
+
+def variables() -> Dict[str, str]:
+    """Get the class variables
+
+    :return: values by variable name from all ``class/*.var`` files of the
+        defined classes; files of classes with higher priority override
+    """
+    result = {}
+    for path in class_files('class', '.var'):
+        result.update(load(path, parse_variables))
+    return result
+
+
+class PackageList(NamedTuple):
+    """Section of a ``package_config`` file"""
+    method: str
+    """installation method, e.g. ``install`` or ``aptitude``"""
+    classes: Tuple[str, ...]
+    """classes of which one must be defined for the section to apply (if
+    any)"""
+    packages: Tuple[str, ...]
+
+
+def parse_package_config(path: pathlib.Path) -> List[PackageList]:
+    """Read a ``package_config`` file
+
+    :param path: file like ``package_config/DEFAULT``
+    :return: all sections of the file
+    """
+    result = []
+    method, classes, packages = None, (), []
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            words = line.split('#', 1)[0].split()
+            if words[:1] == ['PACKAGES']:
+                if method is not None:
+                    result.append(PackageList(method, classes,
+                                              tuple(packages)))
+                method, classes, packages = (words[1] if len(words) > 1 else
+                                             'install'), tuple(words[2:]), []
+            elif method is not None:
+                packages.extend(words)
+    if method is not None:
+        result.append(PackageList(method, classes, tuple(packages)))
+    return result
+
+
+def package_config() -> List[PackageList]:
+    """Get the package lists
+
+    :return: sections of all ``package_config`` files of the defined classes
+        that apply, in ascending class priority
+    """
+    defined = env.current().classes
+    return [
+        package_list for path in class_files('package_config')
+        for package_list in load(path, parse_package_config)
+        if not package_list.classes or any(c in defined
+                                           for c in package_list.classes)
+    ]
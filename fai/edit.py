@@ -0,0 +1,251 @@
+""" Editing Config Files
+    ====================
+
+    Apply several edits to a file in the target system in a single pass.
+
+    Edits are queued on an :any:`Editor` and applied together when the
+    editor is closed (or when :any:`Editor.apply` is called). The file is
+    read line by line and streamed into a temporary file, which atomically
+    replaces the original only if the content changed::
+
+        with edit.Editor(TargetPath('/etc/ssh/sshd_config')) as e:
+            e.set('PermitRootLogin', 'no', separator=' ')
+            e.set('PasswordAuthentication', 'no', separator=' ')
+            e.replace(r'^#?(X11Forwarding) .*', r'\\1 no')
+            e.block('sftp', ['Match Group sftp', '  ForceCommand internal-sftp'])
+
+    This replaces one ``sed -i`` process and one rewrite of the file per edit.
+"""
+from __future__ import annotations
+from typing import (Deque, Dict, Iterable, List, Optional, Pattern, Sequence,
+                    Tuple, Union)
+import collections
+import os
+import re
+import tempfile
+
+from . import files
+
+BLOCK_BEGIN = '# BEGIN PYFAI MANAGED BLOCK {name}'
+"""Format of the first line of a managed block"""
+
+BLOCK_END = '# END PYFAI MANAGED BLOCK {name}'
+"""Format of the last line of a managed block"""
+
+
+class Editor:
+    """ Queue of edits to a file in the target system
+
+    :param path: file to edit
+    :param create: create the file if it does not exist (with mode
+        ``0o644``)
+
+    The edits are applied in order of the categories below, and in the order
+    they were queued within each category:
+
+    1. :any:`replace` of regular expressions in each line
+    2. :any:`set` of key/value pairs
+    3. :any:`ensure_line`
+    4. :any:`block`
+
+    Lines, keys, and blocks not found in the file are appended at its end.
+
+    Used as context manager, the edits are applied when the context is left
+    without exception.
+    """
+
+    def __init__(self, path: files.TargetPath, *, create: bool = False):
+        self.path = path
+        self.create = create
+        self._replacements: List[Tuple[Pattern, str, int]] = []
+        self._keys: Dict[str, Tuple[Pattern, str]] = {}
+        self._lines: Dict[str, bool] = {}
+        self._blocks: Dict[str, Optional[List[str]]] = {}
+
+    def replace(self,
+                pattern: Union[str, Pattern],
+                repl: str,
+                count: int = 0) -> Editor:
+        """Replace a regular expression in each line
+
+        :param pattern: regular expression (matched without line break)
+        :param repl: replacement like for :any:`re.sub`
+        :param count: maximum number of replacements per line (default: all)
+        """
+        self._replacements.append((re.compile(pattern), repl, count))
+        return self
+
+    def set(self,
+            key: str,
+            value: Optional[str],
+            *,
+            separator: str = '=') -> Editor:
+        """Set the value of a key
+
+        :param key: key (e.g., ``GRUB_TIMEOUT`` or ``PermitRootLogin``)
+        :param value: new value or :any:`None` to remove the key
+        :param separator: separator between key and value; surrounding
+            whitespace is optional when matching lines
+
+        The first line setting the key is replaced, further lines setting it
+        are removed. Commented lines are left alone.
+        """
+        sep = separator.strip()
+        if sep:
+            pattern = re.compile(rf'\s*{re.escape(key)}\s*{re.escape(sep)}')
+        else:
+            pattern = re.compile(rf'\s*{re.escape(key)}(\s|$)')
+        line = None if value is None else f'{key}{separator}{value}'
+        self._keys[key] = (pattern, line)
+        return self
+
+    def ensure_line(self, line: str, present: bool = True) -> Editor:
+        """Make sure that a line is present or absent
+
+        :param line: complete line (compared without surrounding whitespace)
+        :param present: whether the line should be present or removed
+        """
+        self._lines[line.strip()] = present
+        return self
+
+    def block(self, name: str,
+              lines: Optional[Union[str, Sequence[str]]]) -> Editor:
+        """Set the content of a managed block
+
+        :param name: name of the block, unique within the file
+        :param lines: content of the block or :any:`None` to remove it
+
+        A managed block is enclosed by marker lines (see :any:`BLOCK_BEGIN`
+        and :any:`BLOCK_END`), so it can be found and replaced again.
+        """
+        if isinstance(lines, str):
+            lines = lines.splitlines()
+        self._blocks[name] = None if lines is None else [
+            BLOCK_BEGIN.format(name=name),
+            *lines,
+            BLOCK_END.format(name=name),
+        ]
+        return self
+
+    def _edit(self, lines: Iterable[str]) -> Iterable[str]:
+        """Apply the edits to a stream of lines (without line breaks)"""
+        keys_done = set()
+        lines_found = set()
+        begins = {BLOCK_BEGIN.format(name=n): n for n in self._blocks}
+        blocks_done = set()
+        block_name = block_end = None
+        for line in lines:
+            if block_end is not None:
+                # replace the old block once it was read completely
+                if line == block_end:
+                    if block_name not in blocks_done and \
+                            self._blocks[block_name] is not None:
+                        yield from self._blocks[block_name]
+                    blocks_done.add(block_name)
+                    block_name = block_end = None
+                continue
+            block_name = begins.get(line)
+            if block_name is not None:
+                block_end = BLOCK_END.format(name=block_name)
+                continue
+            for pattern, repl, count in self._replacements:
+                line = pattern.sub(repl, line, count)
+            for key, (pattern, new) in self._keys.items():
+                if pattern.match(line):
+                    if key not in keys_done and new is not None:
+                        yield new
+                    keys_done.add(key)
+                    break
+            else:
+                stripped = line.strip()
+                present = self._lines.get(stripped)
+                if present is None or present:
+                    lines_found.add(stripped)
+                    yield line
+        if block_end is not None:
+            raise ValueError(f'managed block {block_name} has no end marker')
+        for key, (_, new) in self._keys.items():
+            if key not in keys_done and new is not None:
+                yield new
+        for line, present in self._lines.items():
+            if present and line not in lines_found:
+                yield line
+        for name, block in self._blocks.items():
+            if name not in blocks_done and block is not None:
+                yield from block
+
+    def apply(self) -> bool:
+        """Apply all queued edits
+
+        :return: whether the file was changed
+        :raise FileNotFoundError: if the file does not exist and
+            :any:`create <Editor.params.create>` is not set
+        :raise ValueError: if a managed block of a queued :any:`block` edit
+            has no end marker (the file is left untouched)
+        """
+        path = files.resolve(self.path)
+        try:
+            src = open(  # pylint: disable=consider-using-with; closed in finally
+                path,
+                encoding='utf-8',
+                errors='surrogateescape',
+                newline='')
+            stat = os.fstat(src.fileno())
+        except FileNotFoundError:
+            if not self.create:
+                raise
+            src, stat = None, None
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix=f'.{path.name}.')
+        try:
+            # compare output and input while streaming: the output can never
+            # be ahead of the input except for appended lines
+            consumed: Deque[str] = collections.deque()
+
+            def read():
+                if src is not None:
+                    for line in src:
+                        line = line.rstrip('\n')
+                        consumed.append(line)
+                        yield line
+
+            changed = src is None
+            with open(fd,
+                      'w',
+                      encoding='utf-8',
+                      errors='surrogateescape',
+                      newline='') as dst:
+                for line in self._edit(read()):
+                    dst.write(line + '\n')
+                    if not consumed or consumed.popleft() != line:
+                        changed = True
+                changed = changed or bool(consumed)
+                if changed:
+                    if stat is not None:
+                        os.fchown(dst.fileno(), stat.st_uid, stat.st_gid)
+                        os.fchmod(dst.fileno(), stat.st_mode & 0o7777)
+                    else:
+                        os.fchmod(dst.fileno(), 0o644)
+                    dst.flush()
+                    os.fsync(dst.fileno())
+            if changed:
+                os.replace(tmp, path)
+            else:
+                os.unlink(tmp)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        finally:
+            if src is not None:
+                src.close()
+        self._replacements.clear()
+        self._keys.clear()
+        self._lines.clear()
+        self._blocks.clear()
+        return changed
+
+    def __enter__(self) -> Editor:
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.apply()
@@ -11,36 +11,139 @@
         Many functions in the :py:mod:`fai` package depend on correct
         environment settings defined here. If you want to run your scripts
         without a full FAI process, make sure to define them properly.
+
+    All functions in :py:mod:`fai` take these settings from the
+    :any:`current` :any:`FaiContext`. Unless a context is activated with
+    :any:`use`, it reflects the module variables defined here. Contexts make
+    it possible to work on several targets in one process, e.g., to prepare
+    multiple chroots in parallel on a thread pool::
+
+        contexts = [
+            env.current().replace(target=t, ROOTCMD=['chroot', t])
+            for t in targets
+        ]
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            for ctx in contexts:
+                pool.submit(ctx.run, prepare_chroot)
+
+    The module variables are read from the environment on first access.
+    Variables assigned before (e.g., ``env.target = pathlib.Path('/mnt')`` in
+    a script run outside of FAI) keep their values.
 """
-from typing import Mapping, Optional, Sequence, Union
+from __future__ import annotations
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Mapping,
+                    Optional, Sequence, Union)
+import collections.abc
+import contextlib
+import contextvars
 import enum
 import os
 import pathlib
-import shlex
 import sys
-import warnings
+
+
+class ClassSet(collections.abc.Sequence):
+    """ Ordered set of FAI classes
+
+    :param names: class names in ascending priority
+
+    Behaves like the sequence of class names, but also answers membership
+    and priority questions in constant time, so that class variants can be
+    selected without scanning the list::
+
+        variant = env.classes.select(os.listdir(source_dir))
+
+    Like in FAI, a class listed later has a higher priority. If a class is
+    listed more than once, its last position counts.
+    """
+
+    def __init__(self, names: Iterable[str] = ()):
+        self._classes = tuple(names)
+        self._ranks: Dict[str, int] = {
+            c: i
+            for i, c in enumerate(self._classes)
+        }
+
+    def __getitem__(self, index):
+        return self._classes[index]
+
+    def __len__(self) -> int:
+        return len(self._classes)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._classes)
+
+    def __contains__(self, name: object) -> bool:
+        return name in self._ranks
+
+    def __eq__(self, other: object) -> bool:
+        if isinstance(other, ClassSet):
+            return self._classes == other._classes
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return self._classes == tuple(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self._classes)
+
+    def __repr__(self) -> str:
+        return f'ClassSet({list(self._classes)!r})'
+
+    def rank(self, name: str) -> Optional[int]:
+        """Get the priority of a class
+
+        :param name: class name
+        :return: position of the class (higher wins) or :any:`None` if the
+            class is not defined
+        """
+        return self._ranks.get(name)
+
+    def select(self, candidates: Iterable[str]) -> Optional[str]:
+        """Find the candidate with the highest priority
+
+        :param candidates: class names, e.g., of the variants of a file
+        :return: the defined candidate with the highest priority or
+            :any:`None` if no candidate is defined
+        """
+        best, best_rank = None, -1
+        for name in candidates:
+            rank = self._ranks.get(name, -1)
+            if rank > best_rank:
+                best, best_rank = name, rank
+        return best
+
+    def ordered(self, candidates: Iterable[str]) -> List[str]:
+        """Sort candidates by priority
+
+        :param candidates: class names
+        :return: the defined candidates in ascending priority, i.e., in the
+            order FAI applies them
+        """
+        return sorted((c for c in set(candidates) if c in self._ranks),
+                      key=self._ranks.__getitem__)
+
 
 # pylint: disable-next=invalid-name; naming like FAI env var
-classes: Sequence[str] = []
+classes: ClassSet
 """FAI classes (``$classes``)
 
 :meta hide-value:
 """
 
-CONFIG_SPACE: pathlib.Path = None
+CONFIG_SPACE: pathlib.Path
 """FAI config space (``$FAI``)
 
 :meta hide-value:
 """
 
 # pylint: disable-next=invalid-name; naming like FAI env var
-target: pathlib.Path = None
+target: pathlib.Path
 """FAI Installation target (``$target``)
 
 :meta hide-value:
 """
 
-ROOTCMD: Sequence[str] = []
+ROOTCMD: Sequence[str]
 """Chroot command (``$ROOTCMD``)
 
 The value from the environment is splitted with :any:`shlex.split` and can
@@ -56,7 +159,7 @@ def is_online() -> bool:
     Some tasks such as starting a service are only possible when FAI is run
     within the target system (i.e. FAI is doing a softupdate).
     """
-    return target is not None and target == pathlib.Path('/')
+    return current().is_online()
 
 
 class Action(enum.Enum):
@@ -75,7 +178,7 @@ class Action(enum.Enum):
     softupdate = enum.auto()  #: :meta hide-value:
 
 
-ACTION: Union[Action, str] = None
+ACTION: Union[Action, str]
 """FAI action (``$FAI_ACTION``)
 
 Well-known actions are mapped to elements of :any:`Action`. If running a custom
@@ -84,54 +187,220 @@ action, this is simply a :any:`str`.
 :meta hide-value:
 """
 
-LOGDIR: pathlib.Path = None
+LOGDIR: pathlib.Path
 """FAI log directory (``$LOGDIR``)
 
 :meta hide-value:
 """
 
 
-def _load_env(env: Mapping = os.environ):  # pylint: disable=dangerous-default-value
+class FaiContext:
+    """ Snapshot of the FAI environment
 
-    def read_path(varname: str) -> Optional[pathlib.Path]:
-        value = env.get(varname)
-        if value is not None:
-            return pathlib.Path(value)
-        return None
+    Attributes have the same meaning as the module variables of the same
+    name. :any:`classes <FaiContext.classes>` given as another sequence are
+    converted to a :any:`ClassSet`.
 
-    # pylint: disable=global-statement; we need to update the global vars here
+    Contexts are immutable, so they can be shared between threads and
+    :py:mod:`asyncio` tasks. Use :any:`replace` to derive a context with
+    different values.
+    """
+    # pylint: disable=invalid-name,redefined-outer-name; naming like FAI env vars
+
+    classes: ClassSet
+    CONFIG_SPACE: Optional[pathlib.Path]
+    target: Optional[pathlib.Path]
+    ROOTCMD: Sequence[str]
+    ACTION: Union['Action', str, None]
+    LOGDIR: Optional[pathlib.Path]
+
+    __slots__ = ('classes', 'CONFIG_SPACE', 'target', 'ROOTCMD', 'ACTION',
+                 'LOGDIR')
+
+    def __init__(self,
+                 classes: Iterable[str] = ClassSet(),
+                 CONFIG_SPACE: Optional[pathlib.Path] = None,
+                 target: Optional[pathlib.Path] = None,
+                 ROOTCMD: Sequence[str] = (),
+                 ACTION: Union['Action', str, None] = None,
+                 LOGDIR: Optional[pathlib.Path] = None):
+        if not isinstance(classes, ClassSet):
+            classes = ClassSet(classes)
+        values = (classes, CONFIG_SPACE, target, ROOTCMD, ACTION, LOGDIR)
+        for name, value in zip(self.__slots__, values):
+            object.__setattr__(self, name, value)
+
+    def _values(self) -> tuple:
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __setattr__(self, name: str, value):
+        raise AttributeError(f'cannot assign to field {name!r}')
+
+    def __delattr__(self, name: str):
+        raise AttributeError(f'cannot delete field {name!r}')
+
+    def __eq__(self, other: object) -> bool:
+        if other.__class__ is self.__class__:
+            return self._values() == other._values()
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        return hash(self._values())
+
+    def __repr__(self) -> str:
+        fields = ', '.join(f'{name}={getattr(self, name)!r}'
+                           for name in self.__slots__)
+        return f'{self.__class__.__name__}({fields})'
+
+    def __reduce__(self):
+        return self.__class__, self._values()
+
+    def replace(self, **changes) -> 'FaiContext':
+        """Derive a context with different values
+
+        :param changes: attributes to change
+        :return: a new context with the other attributes of this one
+        :raise TypeError: if an attribute does not exist
+
+        Example::
+
+            ctx = env.current().replace(target=t, ROOTCMD=['chroot', t])
+        """
+        values = dict(zip(self.__slots__, self._values()))
+        values.update(changes)
+        return self.__class__(**values)
+
+    @classmethod
+    def from_environ(cls, environ: Mapping = os.environ) -> 'FaiContext':  # pylint: disable=dangerous-default-value
+        """Read context from FAI environment variables
+
+        :param environ: environment variables
+        """
+
+        def read_path(varname: str) -> Optional[pathlib.Path]:
+            value = environ.get(varname)
+            if value is not None:
+                return pathlib.Path(value)
+            return None
+
+        import shlex  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+        action = environ.get('FAI_ACTION')
+        if action is not None and hasattr(Action, action):
+            action = Action[action]
+        return cls(
+            classes=ClassSet(str(environ.get('classes', '')).split()),
+            CONFIG_SPACE=read_path('FAI'),
+            target=read_path('target'),
+            ROOTCMD=shlex.split(environ.get('ROOTCMD', '')),
+            ACTION=action,
+            LOGDIR=read_path('LOGDIR'),
+        )
+
+    def is_online(self) -> bool:
+        """Check if system installed/updated by FAI is online
+
+        See :any:`env.is_online <fai.env.is_online>`.
+        """
+        return self.target is not None and self.target == pathlib.Path('/')
+
+    def run(self, func: Callable, *args, **kwargs) -> Any:
+        """Call a function with this context activated
+
+        :param func: function to call
+        :param args: positional arguments for ``func``
+        :param kwargs: keyword arguments for ``func``
+        :return: return value of ``func``
+
+        Handy to submit work for a specific target to a thread pool, since
+        threads do not inherit the context of their creator.
+        """
+        with use(self):
+            return func(*args, **kwargs)
+
+
+_context: contextvars.ContextVar = contextvars.ContextVar('fai_context',
+                                                          default=None)
+_globals_context = (None, None)
+
+
+def current() -> FaiContext:
+    """Get the current context
 
-    global classes  # pylint: disable=invalid-name; naming like FAI env var
-    classes = str(env.get('classes', '')).split()
+    :return: the context activated by :any:`use` in the current thread or
+        :py:mod:`asyncio` task, or a context reflecting the module variables
+        otherwise
+    """
+    ctx = _context.get()
+    if ctx is not None:
+        return ctx
+    if not _loaded:
+        _load_env()
+    # reuse the context of the module variables as long as they are unchanged
+    global _globals_context  # pylint: disable=global-statement; cache
+    variables = globals()
+    values = tuple(variables[name] for name in _FIELDS)
+    cached_values, ctx = _globals_context
+    if cached_values is None or any(a is not b
+                                    for a, b in zip(values, cached_values)):
+        ctx = FaiContext(*values)
+        _globals_context = (values, ctx)
+    return ctx
+
+
+@contextlib.contextmanager
+def use(ctx: FaiContext):
+    """Activate a context in the current thread or :py:mod:`asyncio` task
+
+    :param ctx: context to activate
+
+    Example::
+
+        with env.use(FaiContext.from_environ(other_env)):
+            fai.files.fcopy(TargetPath('/etc/motd'))
+    """
+    token = _context.set(ctx)
+    try:
+        yield ctx
+    finally:
+        _context.reset(token)
 
-    global CONFIG_SPACE
-    CONFIG_SPACE = read_path('FAI')
 
-    global target  # pylint: disable=invalid-name; naming like FAI env var
-    target = read_path('target')
+_FIELDS = FaiContext.__slots__
+_VARIABLES = frozenset(_FIELDS)
+_loaded = False  # pylint: disable=invalid-name; reassigned on first load
 
-    global ROOTCMD
-    ROOTCMD = shlex.split(env.get('ROOTCMD', ''))
 
-    global ACTION
-    ACTION = env.get('FAI_ACTION')
-    if ACTION is not None and hasattr(Action, ACTION):
-        ACTION = Action[ACTION]
+def __getattr__(name: str):
+    if name in _VARIABLES and not _loaded:
+        _load_env()
+        return globals()[name]
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
 
-    global LOGDIR
-    LOGDIR = read_path('LOGDIR')
+
+def _load_env(env: Mapping = os.environ):  # pylint: disable=dangerous-default-value
+    ctx = FaiContext.from_environ(env)
+
+    # pylint: disable=global-statement; we need to update the global vars here
+    global _loaded
+
+    # variables assigned before the first read (e.g., in scripts run outside
+    # of FAI) take precedence over the environment
+    variables = globals()
+    assigned = frozenset() if _loaded else _VARIABLES.intersection(variables)
+    _loaded = True
+    for name in _VARIABLES - assigned:
+        variables[name] = getattr(ctx, name)
 
     if not all([
-            CONFIG_SPACE,
-            target,
+            variables['CONFIG_SPACE'],
+            variables['target'],
             #ROOTCMD, # $ROOTCMD can be empty
-            ACTION,
-            LOGDIR,
+            variables['ACTION'],
+            variables['LOGDIR'],
     ]) and 'sphinx' not in sys.modules and 'pytest' not in sys.modules:
+        import warnings  # pylint: disable=import-outside-toplevel; deferred for faster startup
         warnings.warn((
             "FAI environment variables not defined: Are you running in FAI? "
             "For testing, set $FAI, $target, $ROOTCMD, $FAI_ACTION, and $LOGDIR."
         ))
-
-
-_load_env()
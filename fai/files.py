@@ -25,10 +25,23 @@
     :any:`resolve()` and :any:`unresolve()`.
 """
 from __future__ import annotations
-from typing import Sequence
+from typing import (TYPE_CHECKING, Callable, Dict, Iterable, Iterator, List,
+                    Optional, Sequence, Tuple)
+import collections
+import contextlib
+import contextvars
+import errno
+import fcntl
+import functools
+import os
 import pathlib
+import threading
+from stat import S_ISDIR, S_ISLNK, S_ISREG
 
-from . import env, subprocess
+from . import env, subprocess, trace
+
+if TYPE_CHECKING:
+    from .manifest import Manifest
 
 InstallerPath: type = pathlib.PosixPath
 """Physical path in the installer system"""
@@ -41,16 +54,20 @@ TargetPath: type = pathlib.PurePosixPath
 _tp_root = TargetPath('/')
 
 
+@trace.traced('resolve')
 def resolve(target_path: TargetPath) -> InstallerPath:
     """Resolve a path in the target system
 
     :param target_path: pure path in the target system
     :return: absolute path in the installer system within :any:`env.target`
     """
+    target = env.current().target
     if target_path.is_absolute():
         target_path = target_path.relative_to(_tp_root)
-    result = env.target / target_path
-    assert env.target in result.parents
+    result = target / target_path
+    # cheaper than checking result.parents
+    assert len(result.parts) > len(target.parts)
+    assert result.parts[:len(target.parts)] == target.parts
     assert result.is_absolute()
     return result
 
@@ -62,11 +79,147 @@ def unresolve(installer_path: InstallerPath) -> TargetPath:
     :return: absolute path in target system
     :raise ValueError: if :any:`installer_path` not within :any:`env.target`
     """
-    result = _tp_root / installer_path.relative_to(env.target)
+    result = _tp_root / installer_path.relative_to(env.current().target)
     assert result.is_absolute()
     return result
 
 
+def resolve_many(target_paths: Iterable[TargetPath]) -> List[InstallerPath]:
+    """Resolve many paths in the target system
+
+    :param target_paths: pure paths in the target system
+    :return: absolute paths in the installer system within :any:`env.target`
+
+    Like :any:`resolve`, but cheaper per path.
+    """
+    prefix = str(env.current().target).rstrip('/') + '/'
+    result = []
+    for target_path in target_paths:
+        relative = str(target_path).lstrip('/')
+        assert relative and relative != '.'
+        result.append(InstallerPath(prefix + relative))
+    return result
+
+
+def unresolve_many(
+        installer_paths: Iterable[InstallerPath]) -> List[TargetPath]:
+    """Find the target paths for many resolved paths
+
+    :param installer_paths: resolved paths
+    :return: absolute paths in target system
+    :raise ValueError: if any path is not within :any:`env.target`
+
+    Like :any:`unresolve`, but cheaper per path.
+    """
+    target = str(env.current().target).rstrip('/')
+    result = []
+    for installer_path in installer_paths:
+        path = str(installer_path)
+        if path != target and not path.startswith(target + '/'):
+            raise ValueError(f'{path!r} is not in {target or "/"!r}')
+        result.append(TargetPath(path[len(target):] or '/'))
+    return result
+
+
+class _IdIndex:
+    """Name to ID index of a passwd(5)-like database file in the target
+
+    The database file is parsed once per target and re-parsed only if it
+    changed (by mtime, size or inode).
+    """
+
+    def __init__(self, name: str):
+        self._name = name
+        self._cache: Dict[pathlib.Path, Tuple[tuple, Dict[str, int]]] = {}
+
+    def lookup(self, name: str) -> Optional[int]:
+        """Look up the ID of a name
+
+        :param name: user or group name
+        :return: numeric ID or :any:`None` if not found in the database
+        """
+        target = env.current().target
+        if target is None:
+            return None
+        path = target / 'etc' / self._name
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+        cached_key, ids = self._cache.get(path, (None, None))
+        if key != cached_key:
+            ids = {}
+            with open(path, encoding='utf-8', errors='surrogateescape') as f:
+                for line in f:
+                    fields = line.split(':', 3)
+                    if len(fields) >= 3 and fields[2].isdigit():
+                        ids.setdefault(fields[0], int(fields[2]))
+            self._cache[path] = (key, ids)
+        result = ids.get(name)
+        if result is None and name.isdigit():
+            result = int(name)
+        return result
+
+
+_passwd = _IdIndex('passwd')
+_group = _IdIndex('group')
+
+
+def _lookup_owner(user: str, group: str) -> Optional[Tuple[int, int]]:
+    """Find numeric owner and group from the target's local databases
+
+    :return: ``(uid, gid)`` or :any:`None` if any name is unknown locally
+    """
+    uid = _passwd.lookup(user)
+    if uid is None:
+        return None
+    gid = _group.lookup(group)
+    if gid is None:
+        return None
+    return uid, gid
+
+
+_MAX_SYMLINKS = 40
+"""Symlinks followed in one path before giving up (like Linux)"""
+
+
+def _realpath(path: TargetPath) -> TargetPath:
+    """Resolve symlinks like in the target system
+
+    :param path: path in the target system
+    :return: absolute path without symlinks in the target system (missing
+        components are kept as they are)
+    :raise OSError: on symlink loops
+
+    Absolute links are relative to :any:`env.target`, and ``..`` never goes
+    above it, so the result cannot point out of the target.
+    """
+    target = env.current().target
+    parts = list(reversed((_tp_root / path).parts))
+    result = _tp_root
+    links = 0
+    while parts:
+        part = parts.pop()
+        if part == '/':
+            result = _tp_root
+            continue
+        if part == '..':
+            result = result.parent
+            continue
+        try:
+            link = os.readlink(target / (result / part).relative_to(_tp_root))
+        except OSError:
+            result /= part  # no symlink (or missing)
+            continue
+        links += 1
+        if links > _MAX_SYMLINKS:
+            raise OSError(errno.ELOOP, os.strerror(errno.ELOOP), str(path))
+        parts.extend(reversed(TargetPath(link).parts))
+    return result
+
+
+@trace.traced('chmod')
 def chmod(path: TargetPath,
           *,
           mode: int = 0o644,
@@ -80,15 +233,35 @@ def chmod(path: TargetPath,
     :param group: desired file group
     :raises FileNotFoundError: if :any:`path <chmod.params.path>` does not exist
 
+    Names are looked up in the target's ``/etc/passwd`` and ``/etc/group``.
+    Only names unknown there (e.g., from NSS/LDAP) are resolved by running
+    ``chown`` in the target.
+
+    Symlinks are followed like in the target system, so a link never makes
+    this change a file outside of :any:`env.target`.
+
+    Within a :any:`batch`, the operation is only recorded.
+
     This function is idempotent.
     """
     assert not user.startswith('-')
     assert not group.startswith('-')
-    resolve(path).chmod(mode)
-    # we need to run this in the target to resolve user names correctly
-    subprocess.run(['chown', f'{user}:{group}', str(path)])
+    plan = _plan.get()
+    if plan is not None:
+        plan.chmod(path, mode=mode, user=user, group=group)
+        return
+    installer_path = resolve(_realpath(path))
+    # chown first: it may clear setuid/setgid bits
+    owner = _lookup_owner(user, group)
+    if owner is not None:
+        os.chown(installer_path, *owner, follow_symlinks=False)
+    else:
+        # we need to run this in the target to resolve user names correctly
+        subprocess.run(['chown', f'{user}:{group}', str(path)])
+    installer_path.chmod(mode)
 
 
+@trace.traced('mkdir')
 def mkdir(path: TargetPath,
           *,
           mode: int = 0o755,
@@ -105,12 +278,442 @@ def mkdir(path: TargetPath,
     Parent directories are created with default mode/owner/group if they do not
     exist.
 
+    Within a :any:`batch`, the operation is only recorded.
+
     This function is idempotent.
     """
-    resolve(path).mkdir(mode=mode, parents=True, exist_ok=True)
+    plan = _plan.get()
+    if plan is not None:
+        plan.mkdir(path, mode=mode, user=user, group=group)
+        return
+    resolve(_realpath(path)).mkdir(mode=mode, parents=True, exist_ok=True)
     chmod(path, mode=mode, user=user, group=group)
 
 
+_FICLONE = 0x40049409
+"""``ioctl`` request to reflink a file (``FICLONE`` from ``linux/fs.h``)"""
+
+_COPY_FALLBACK_ERRNOS = frozenset([
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTTY,
+    errno.EBADF,
+])
+
+_PROGRESS_CHUNK = 1 << 26
+"""Bytes copied at once if progress is reported"""
+
+
+def _copy_data(src_fd: int,
+               dst_fd: int,
+               progress: Optional[Callable[[int], None]] = None):
+    """Copy file contents in the kernel if possible
+
+    Tries a reflink first. Sparse files are copied extent by extent (see
+    :any:`_copy_sparse`). Otherwise, tries :any:`os.copy_file_range` (Python
+    3.8+), then :any:`os.sendfile`. Only falls back to copying through
+    userspace buffers if neither is supported.
+
+    :param progress: called with the number of bytes processed since the
+        last call
+    """
+    try:
+        fcntl.ioctl(dst_fd, _FICLONE, src_fd)
+        if progress is not None:
+            progress(os.fstat(src_fd).st_size)
+        return
+    except OSError as e:
+        if e.errno not in _COPY_FALLBACK_ERRNOS:
+            raise
+
+    stat = os.fstat(src_fd)
+    if stat.st_blocks * 512 < stat.st_size and hasattr(os, 'SEEK_DATA'):
+        try:
+            extents = list(_data_extents(src_fd, stat.st_size))
+        except OSError as e:
+            if e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+        else:
+            _copy_sparse(src_fd, dst_fd, stat.st_size, extents, progress)
+            return
+
+    chunk = 1 << 30 if progress is None else _PROGRESS_CHUNK
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while True:
+                n = os.copy_file_range(src_fd, dst_fd, chunk)
+                if not n:
+                    return
+                copied += n
+                if progress is not None:
+                    progress(n)
+        except OSError as e:
+            if copied or e.errno not in _COPY_FALLBACK_ERRNOS:
+                raise
+
+    try:
+        while True:
+            n = os.sendfile(dst_fd, src_fd, copied, chunk)
+            if not n:
+                return
+            copied += n
+            if progress is not None:
+                progress(n)
+    except OSError as e:
+        if copied or e.errno not in _COPY_FALLBACK_ERRNOS:
+            raise
+
+    while True:
+        data = os.read(src_fd, 1 << 20)
+        if not data:
+            return
+        os.write(dst_fd, data)
+        if progress is not None:
+            progress(len(data))
+
+
+def _data_extents(fd: int, size: int) -> Iterator[Tuple[int, int]]:
+    """Find the data extents of a file with ``SEEK_DATA``/``SEEK_HOLE``
+
+    :return: offset and length of each extent
+    """
+    pos = 0
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, os.SEEK_DATA)
+        except OSError as e:
+            if e.errno == errno.ENXIO:
+                return  # only a hole is left
+            raise
+        pos = os.lseek(fd, start, os.SEEK_HOLE)
+        yield start, pos - start
+
+
+def _copy_sparse(src_fd: int, dst_fd: int, size: int,
+                 extents: Sequence[Tuple[int, int]],
+                 progress: Optional[Callable[[int], None]]):
+    """Copy only the data extents of a file, keeping holes in the copy"""
+    chunk = 1 << 30 if progress is None else _PROGRESS_CHUNK
+    use_copy_file_range = hasattr(os, 'copy_file_range')
+    done = 0
+    for start, length in extents:
+        if progress is not None and start > done:
+            progress(start - done)  # skipped hole
+        offset, end = start, start + length
+        while offset < end:
+            n = min(chunk, end - offset)
+            if use_copy_file_range:
+                try:
+                    n = os.copy_file_range(src_fd, dst_fd, n, offset, offset)
+                except OSError as e:
+                    if e.errno not in _COPY_FALLBACK_ERRNOS:
+                        raise
+                    use_copy_file_range = False
+                    continue
+            else:
+                n = os.pwrite(dst_fd, os.pread(src_fd, min(n, 1 << 20),
+                                               offset), offset)
+            if not n:
+                break  # truncated concurrently
+            offset += n
+            if progress is not None:
+                progress(n)
+        done = end
+    os.ftruncate(dst_fd, size)
+    if progress is not None and size > done:
+        progress(size - done)
+
+
+_pending_renames: contextvars.ContextVar = contextvars.ContextVar(
+    'fai_files_pending_renames', default=None)
+
+
+@contextlib.contextmanager
+def deferred_sync():
+    """Batch the syncs of :any:`install`
+
+    Within this context, :any:`install` only writes the temporary files.
+    When the context is left without exception, all files are synced, then
+    renamed to their destinations, and each affected directory is synced
+    only once. On exception, the temporary files are removed and no
+    destination is changed.
+
+    Example::
+
+        with deferred_sync():
+            for name in firmware_blobs:
+                install(blob_dir / name, TargetPath('/lib/firmware') / name)
+    """
+    pending: List[Tuple[str, InstallerPath]] = []
+    token = _pending_renames.set(pending)
+    try:
+        yield
+    except BaseException:
+        for tmp, _ in pending:
+            os.unlink(tmp)
+        raise
+    finally:
+        _pending_renames.reset(token)
+    for tmp, _ in pending:
+        fd = os.open(tmp, os.O_RDONLY | os.O_CLOEXEC)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+    for tmp, dst in pending:
+        os.replace(tmp, dst)
+    for directory in {dst.parent for _, dst in pending}:
+        _fsync_dir(directory)
+
+
+def _fsync_dir(directory: InstallerPath):
+    fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+@trace.traced('install')
+def install(src: InstallerPath,
+            dst: TargetPath,
+            *,
+            mode: int = 0o644,
+            user: str = 'root',
+            group: str = 'root',
+            backup: Optional[str] = None,
+            progress: Optional[Callable[[int], None]] = None) -> bool:
+    """Install a file into the target atomically
+
+    :param src: file in the installer system
+    :param dst: destination in the target system
+    :param mode: desired file mode
+    :param user: desired file owner
+    :param group: desired file group
+    :param backup: if set, keep a replaced destination as hard link with
+        this suffix (e.g., ``'.pre_fcopy'``)
+    :param progress: called with the number of bytes copied since the last
+        call (holes of sparse files count as copied)
+    :return: whether the destination was changed
+
+    The file is copied to a temporary file next to
+    :any:`dst <install.params.dst>` without passing the data through Python
+    (by reflink, :any:`os.copy_file_range`, or :any:`os.sendfile`). Holes of
+    sparse files (e.g., disk images) are found with ``SEEK_DATA`` and
+    ``SEEK_HOLE`` and skipped, so the destination stays sparse. Owner and
+    mode are set on the open file before it is synced and atomically renamed
+    to its destination, so the destination is never half-written or has
+    wrong permissions. Missing parent directories are created with default
+    mode/owner/group. Symlinks in the parent directories are followed like
+    in the target system, so nothing is written outside of
+    :any:`env.target`.
+
+    Nothing is written if the destination already has the same content,
+    mode, and owner. To detect this cheaply, installed files are recorded in
+    the target's :py:mod:`manifest <fai.manifest>`; files are only hashed
+    if the destination has the size of the source but was not installed
+    from it by this function. Owners only known to the
+    target's NSS are always set with ``chown`` in the target and do not
+    count as change.
+
+    Use :any:`deferred_sync` to batch the syncs of many files.
+
+    This function is idempotent.
+    """
+    from . import manifest as _manifest  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+    assert not user.startswith('-')
+    assert not group.startswith('-')
+    dst = _tp_root / dst
+    # parents are resolved like in the target (see chmod); dst itself is
+    # replaced, not followed
+    dst_path = resolve(_realpath(dst.parent) / dst.name)
+    manifest = _manifest.for_target()
+    src_stat = os.stat(src)
+    source = _manifest.source_id(src, src_stat)
+    owner = _lookup_owner(user, group)
+
+    stat, digest = _stat_if_same(dst, dst_path, src, src_stat, manifest)
+    if stat is not None:
+        changed = stat.st_mode & 0o7777 != mode
+        if owner is not None:
+            changed |= (stat.st_uid, stat.st_gid) != owner
+            if changed:
+                os.chown(dst_path, *owner)
+        else:
+            subprocess.run(['chown', f'{user}:{group}', str(dst)])
+        if changed or owner is None:
+            os.chmod(dst_path, mode)
+            stat = os.stat(dst_path)
+        manifest.record(dst, stat, digest, source)
+        return changed
+
+    dst_path.parent.mkdir(parents=True, exist_ok=True)
+    import tempfile  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+    fd, tmp = tempfile.mkstemp(prefix=f'.{dst_path.name}.',
+                               dir=dst_path.parent)
+    try:
+        try:
+            with open(src, 'rb') as f:
+                _copy_data(f.fileno(), fd, progress)
+            # chown first: it may clear setuid/setgid bits
+            if owner is not None:
+                os.fchown(fd, *owner)
+            os.fchmod(fd, mode)
+            if owner is None:
+                # we need to run this in the target to resolve user names
+                subprocess.run([
+                    'chown', f'{user}:{group}',
+                    str(unresolve(InstallerPath(tmp)))
+                ])
+                os.fchmod(fd, mode)
+            pending = _pending_renames.get()
+            if pending is None:
+                os.fsync(fd)
+            stat = os.fstat(fd)
+        finally:
+            os.close(fd)
+        if backup is not None and dst_path.is_file():
+            _link_backup(dst_path, backup)
+        if pending is not None:
+            pending.append((tmp, dst_path))
+        else:
+            os.replace(tmp, dst_path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    manifest.record(dst, stat, digest, source)
+    if pending is None:
+        _fsync_dir(dst_path.parent)
+    return True
+
+
+def install_many(
+    jobs: Iterable[Tuple[InstallerPath, TargetPath]],
+    *,
+    mode: int = 0o644,
+    user: str = 'root',
+    group: str = 'root',
+    backup: Optional[str] = None,
+    workers: Optional[int] = None,
+    progress: Optional[Callable[[int, int], None]] = None
+) -> Dict[TargetPath, bool]:
+    """Install many files into the target concurrently
+
+    :param jobs: pairs of source file and destination like for
+        :any:`install`
+    :param mode: desired file mode
+    :param user: desired file owner
+    :param group: desired file group
+    :param backup: suffix of backup links like for :any:`install`
+    :param workers: number of files installed in parallel (default: like
+        :any:`concurrent.futures.ThreadPoolExecutor`)
+    :param progress: called with the number of bytes done and the total
+        number of bytes of all sources whenever a chunk was copied
+        (serialized, but from worker threads)
+    :return: whether each destination was changed
+
+    The files are installed with :any:`install` on a thread pool, which
+    pays off for large files such as disk images, VM images, or database
+    seeds. Files that are already up to date count as done at once.
+
+    Example::
+
+        files.install_many(
+            [(image_dir / n, TargetPath('/var/lib/libvirt/images') / n)
+             for n in images],
+            progress=lambda done, total: print(f'{done * 100 // total}%'))
+    """
+    import concurrent.futures  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    jobs = list(jobs)
+    sizes = [os.stat(src).st_size for src, _ in jobs]
+    total = sum(sizes)
+    done = 0
+    lock = threading.Lock()
+
+    def report(n: int):
+        nonlocal done
+        with lock:
+            done += n
+            progress(done, total)
+
+    def install_job(src: InstallerPath, dst: TargetPath, size: int) -> bool:
+        reported = 0
+
+        def job_progress(n: int):
+            nonlocal reported
+            reported += n
+            report(n)
+
+        changed = install(src,
+                          dst,
+                          mode=mode,
+                          user=user,
+                          group=group,
+                          backup=backup,
+                          progress=job_progress if progress else None)
+        if progress is not None and size > reported:
+            report(size - reported)
+        return changed
+
+    ctx = env.current()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        changed = list(
+            pool.map(functools.partial(ctx.run,
+                                       install_job), (src for src, _ in jobs),
+                     (dst for _, dst in jobs), sizes))
+    return {_tp_root / dst: c for (_, dst), c in zip(jobs, changed)}
+
+
+def _stat_if_same(
+        dst: TargetPath, dst_path: InstallerPath, src: InstallerPath,
+        src_stat: os.stat_result,
+        manifest: Manifest) -> Tuple[Optional[os.stat_result], Optional[str]]:
+    """Check if an installed file has the content of a source file
+
+    Files are only hashed if they have the same size and the manifest cannot
+    tell whether they have the same content.
+
+    :return: status of the installed file if it has the source's content,
+        and the source's digest if known
+    """
+    from . import manifest as _manifest  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+    digest = manifest.cached_source_digest(src, src_stat)
+    try:
+        stat = os.lstat(dst_path)
+    except FileNotFoundError:
+        return None, digest
+    if not S_ISREG(stat.st_mode) or stat.st_size != src_stat.st_size:
+        return None, digest
+    entry = manifest.lookup(dst)
+    if entry is not None and entry.matches(stat):
+        if entry.source == _manifest.source_id(src, src_stat):
+            return stat, entry.digest if entry.digest is not None else digest
+        if entry.digest is not None:
+            digest = manifest.source_digest(src)
+            return stat if entry.digest == digest else None, digest
+    # not installed by us or changed since: compare contents
+    digest = manifest.source_digest(src)
+    if _manifest.file_digest(dst_path) == digest:
+        return stat, digest
+    return None, digest
+
+
+def _link_backup(path: InstallerPath, suffix: str):
+    backup = path.with_name(path.name + suffix)
+    try:
+        backup.unlink()
+    except FileNotFoundError:
+        pass
+    os.link(path, backup)
+
+
+@trace.traced('fcopy')
 def fcopy(
     *args: Sequence[TargetPath],
     recursively: bool = False,
@@ -120,7 +723,8 @@ def fcopy(
     remove_backup: bool = True,
     delete_orphan: bool = True,
     ignore_warnings: bool = True,
-):
+    native: bool = False,
+) -> Optional[Dict[TargetPath, bool]]:
     """ Run `fcopy(8)`_
 
     :param args: paths of files to install
@@ -131,9 +735,54 @@ def fcopy(
     :param remove_backup: remove ``*.pre_fcopy`` backup files (``-B``)
     :param delete_orphan: delete target files when no class applies (``-d``)
     :param ignore_warnings: ignore warnings when no class applies (``-i``)
+    :param native: use the native Python engine instead of `fcopy(8)`_
+    :return: with :any:`native <fcopy.params.native>` engine: whether each
+        file was changed (files handled by `fcopy(8)`_ always count as
+        changed)
+    :raise FileNotFoundError: if no class applies and not
+        :any:`ignore_warnings <fcopy.params.ignore_warnings>` (native engine
+        only)
+
+    The native engine looks up the class variants of all files in one cached
+    index of the config space, which is shared by all scripts via
+    :any:`env.LOGDIR`, and installs them in parallel in the current process
+    with :any:`install`. The variant of the last class in
+    :any:`env.classes` wins. Files with a ``postinst`` script or
+    ``file-modes`` in their source directory are still handled by
+    `fcopy(8)`_.
+
+    Within a :any:`batch`, the operation is only recorded and :any:`None` is
+    returned.
 
     .. _`fcopy(8)`: https://fai-project.org/doc/man/fcopy.html
     """
+    plan = _plan.get()
+    if plan is not None:
+        plan.fcopy(args,
+                   recursively=recursively,
+                   user=user,
+                   group=group,
+                   mode=mode,
+                   remove_backup=remove_backup,
+                   delete_orphan=delete_orphan,
+                   ignore_warnings=ignore_warnings,
+                   native=native)
+        return None
+    changed = None
+    if native:
+        changed = _fcopy_native(args,
+                                recursively=recursively,
+                                user=user,
+                                group=group,
+                                mode=mode,
+                                remove_backup=remove_backup,
+                                delete_orphan=delete_orphan,
+                                ignore_warnings=ignore_warnings)
+        args = [path for path, c in changed.items() if c is None]
+        if not args:
+            return changed
+        changed.update((path, True) for path in args)
+        recursively = False
     arg_map = {
         '-B': remove_backup,
         '-d': delete_orphan,
@@ -147,3 +796,457 @@ def fcopy(
             fargs.append(option_name)
     fargs.extend(str(p) for p in args)
     subprocess.run_installer(fargs)
+    return changed
+
+
+def _fcopy_native(paths: Sequence[TargetPath], *, recursively: bool, user: str,
+                  group: str, mode: int, remove_backup: bool,
+                  delete_orphan: bool,
+                  ignore_warnings: bool) -> Dict[TargetPath, Optional[bool]]:
+    """Install files with the native fcopy engine
+
+    :return: whether each file was changed, :any:`None` for files to be
+        handled by `fcopy(8)`
+    """
+    # pylint: disable=import-outside-toplevel; deferred for faster startup
+    from . import _fcopy
+    from . import manifest as _manifest
+
+    ctx = env.current()
+    index = _fcopy.get_index()
+    jobs = []
+    result: Dict[TargetPath, Optional[bool]] = {}
+    for path in paths:
+        found = list(index.find(str(_tp_root / path), recursively))
+        if not found and not ignore_warnings:
+            raise FileNotFoundError(f'fcopy: no source files for {path}')
+        # without a source directory, the target file is left alone
+        for target_path in found:
+            entry = index.entries[target_path]
+            if entry.special:
+                result[TargetPath(target_path)] = None
+                continue
+            variant = ctx.classes.select(entry.variants)
+            if variant is None and not ignore_warnings:
+                raise FileNotFoundError(
+                    f'fcopy: no class applies to {target_path}')
+            source = None
+            if variant is not None:
+                source = index.root / target_path.lstrip('/') / variant
+            jobs.append((source, TargetPath(target_path)))
+
+    def install_job(job: Tuple[Optional[InstallerPath], TargetPath]) -> bool:
+        source, target_path = job
+        if source is not None:
+            return install(source,
+                           target_path,
+                           mode=mode,
+                           user=user,
+                           group=group,
+                           backup=None if remove_backup else '.pre_fcopy')
+        if not delete_orphan:
+            return False
+        _manifest.for_target().forget(target_path)
+        try:
+            resolve(_realpath(target_path.parent) / target_path.name).unlink()
+        except FileNotFoundError:
+            return False
+        return True
+
+    if len(jobs) > 1:
+        import concurrent.futures  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        with concurrent.futures.ThreadPoolExecutor() as pool:
+            changed = list(
+                pool.map(functools.partial(ctx.run, install_job), jobs))
+    else:
+        changed = [install_job(job) for job in jobs]
+    result.update((path, c) for (_, path), c in zip(jobs, changed))
+    return result
+
+
+_plan: contextvars.ContextVar = contextvars.ContextVar('fai_files_plan',
+                                                       default=None)
+
+_CHOWN_MAX_ARGS = 1000
+
+
+class Plan:
+    """ File operations recorded in a :any:`batch`
+
+    Use :any:`str` to get a dry-run listing of the coalesced steps.
+    """
+
+    def __init__(self):
+        self._seq = 0
+        # path -> sequence number of the mkdir
+        self._mkdirs: Dict[TargetPath, int] = {}
+        # path -> (sequence number, mode, user, group) of the last change
+        self._attrs: Dict[TargetPath, Tuple[int, int, str, str]] = {}
+        # fcopy options -> {path: sequence number}
+        self._fcopies: Dict[tuple, Dict[TargetPath, int]] = {}
+
+    def _next(self) -> int:
+        self._seq += 1
+        return self._seq
+
+    def mkdir(self, path: TargetPath, *, mode: int, user: str, group: str):
+        """Record :any:`fai.files.mkdir`"""
+        path = _tp_root / path
+        seq = self._next()
+        self._mkdirs.setdefault(path, seq)
+        self._attrs[path] = (seq, mode, user, group)
+
+    def chmod(self, path: TargetPath, *, mode: int, user: str, group: str):
+        """Record :any:`fai.files.chmod`"""
+        self._attrs[_tp_root / path] = (self._next(), mode, user, group)
+
+    def fcopy(self, paths: Sequence[TargetPath], **options):
+        """Record :any:`fai.files.fcopy`"""
+        group = self._fcopies.setdefault(tuple(sorted(options.items())), {})
+        for path in paths:
+            group[_tp_root / path] = self._next()
+
+    def _last_fcopies(self) -> Tuple[dict, dict]:
+        """Get the sequence number of the last fcopy of each path
+
+        :return: for non-recursive and for recursive fcopies
+        """
+        exact: Dict[TargetPath, int] = {}
+        recursive: Dict[TargetPath, int] = {}
+        for options, paths in self._fcopies.items():
+            last = recursive if dict(options)['recursively'] else exact
+            for path, seq in paths.items():
+                last[path] = max(seq, last.get(path, 0))
+        return exact, recursive
+
+    def steps(self) -> List[Tuple[str, tuple, dict]]:
+        """Get the coalesced steps
+
+        :return: ``(operation, paths, options)`` in execution order
+
+        Directories are created first, parents before children. Then each
+        group of fcopy calls with the same options is run once. Finally,
+        owners and modes are set, parents before children, but only where
+        no later fcopy set them anyway. Owners only known to the target's
+        NSS are set with one ``chown`` per owner.
+        """
+
+        def depth_first(paths):
+            return sorted(paths, key=lambda p: (len(p.parts), p))
+
+        steps = []
+        for path in depth_first(self._mkdirs):
+            mode = self._attrs[path][1]
+            steps.append(('mkdir', (path, ), {'mode': mode}))
+        for options, paths in self._fcopies.items():
+            steps.append(('fcopy', tuple(paths), dict(options)))
+
+        exact, recursive = self._last_fcopies()
+
+        def fcopied_after(path: TargetPath, seq: int) -> bool:
+            return exact.get(path, 0) > seq or any(
+                recursive.get(p, 0) > seq for p in (path, *path.parents))
+
+        # fcopy sets mode and owner of files itself
+        attrs = {
+            path: (mode, user, group)
+            for path, (seq, mode, user, group) in self._attrs.items()
+            if path in self._mkdirs or not fcopied_after(path, seq)
+        }
+        remote_owners: Dict[Tuple[str, str], List[TargetPath]] = {}
+        for path in depth_first(attrs):
+            mode, user, group = attrs[path]
+            owner = _lookup_owner(user, group)
+            if owner is None:
+                remote_owners.setdefault((user, group), []).append(path)
+            else:
+                steps.append(('chown', (path, ), {
+                    'owner': f'{user}:{group}',
+                    'ids': owner
+                }))
+        for (user, group), paths in remote_owners.items():
+            for i in range(0, len(paths), _CHOWN_MAX_ARGS):
+                steps.append(('chown', tuple(paths[i:i + _CHOWN_MAX_ARGS]), {
+                    'owner': f'{user}:{group}',
+                    'ids': None
+                }))
+        for path in depth_first(attrs):
+            steps.append(('chmod', (path, ), {'mode': attrs[path][0]}))
+        return steps
+
+    def __str__(self) -> str:
+        lines = []
+        for operation, paths, options in self.steps():
+            paths = ' '.join(str(p) for p in paths)
+            if operation == 'mkdir':
+                lines.append(f'mkdir -p -m {options["mode"]:o} {paths}')
+            elif operation == 'fcopy':
+                flags = ' '.join(f'{k}={v:#o}' if k == 'mode' else f'{k}={v!r}'
+                                 for k, v in options.items())
+                lines.append(f'fcopy {paths} ({flags})')
+            elif operation == 'chown':
+                lines.append(f'chown {options["owner"]} {paths}')
+            else:
+                lines.append(f'chmod {options["mode"]:o} {paths}')
+        return '\n'.join(lines)
+
+    def execute(self):
+        """Execute the coalesced steps"""
+        # symlinks are followed like in the target system (see chmod)
+        for operation, paths, options in self.steps():
+            if operation == 'mkdir':
+                resolve(_realpath(paths[0])).mkdir(mode=options['mode'],
+                                                   parents=True,
+                                                   exist_ok=True)
+            elif operation == 'fcopy':
+                fcopy(*paths, **options)
+            elif operation == 'chown':
+                if options['ids'] is not None:
+                    os.chown(resolve(_realpath(paths[0])),
+                             *options['ids'],
+                             follow_symlinks=False)
+                else:
+                    # we need to run this in the target to resolve user names
+                    subprocess.run(['chown', options['owner']] +
+                                   [str(p) for p in paths])
+            else:
+                resolve(_realpath(paths[0])).chmod(options['mode'])
+
+
+@contextlib.contextmanager
+def batch(dry_run: bool = False):
+    """Record file operations and execute them in bulk
+
+    :param dry_run: only print the plan instead of executing it
+
+    Within this context, :any:`mkdir`, :any:`chmod`, and :any:`fcopy` are
+    only recorded in a :any:`Plan`. When the context is left without
+    exception, redundant steps are dropped (e.g., a chmod overridden by a
+    later one) and the remaining steps are executed in bulk (see
+    :any:`Plan.steps`). Nested batches join the outermost one.
+
+    Example::
+
+        with batch():
+            mkdir(TargetPath('/srv/app'), user='app', group='app')
+            fcopy(TargetPath('/srv/app/app.conf'), user='app', group='app')
+            chmod(TargetPath('/srv/app'), mode=0o750, user='app', group='app')
+    """
+    plan = _plan.get()
+    if plan is not None:
+        yield plan
+        return
+    plan = Plan()
+    token = _plan.set(plan)
+    try:
+        yield plan
+    finally:
+        _plan.reset(token)
+    if dry_run:
+        print(plan)
+    else:
+        plan.execute()
+
+
+class TargetFS:
+    """ Handle for fast and symlink-safe operations in the target filesystem
+
+    :param target: root of the target filesystem (default: :any:`env.target`)
+    :param cache_size: maximum number of cached directory descriptors
+
+    The target root is opened once as directory file descriptor. All
+    operations are performed with ``*at()`` system calls relative to
+    descriptors of already opened directories, so the kernel does not walk
+    the full absolute path again for each call.
+
+    Paths are resolved like in a ``chroot``: absolute symlinks and ``..`` in
+    the target are resolved relative to the target root and can never lead
+    into the installer system. Note that only symlinks present in the target
+    are handled this way; the handle does not protect against concurrent
+    modifications of the target.
+
+    Descriptors of visited directories are cached. If directories are
+    renamed or replaced by other means while the handle is open, call
+    :any:`invalidate`.
+
+    Example::
+
+        with TargetFS() as fs:
+            for path in paths:
+                fs.chmod(path, 0o644)
+    """
+
+    _MAX_SYMLINKS = 40
+
+    def __init__(self,
+                 target: Optional[InstallerPath] = None,
+                 cache_size: int = 256):
+        if target is None:
+            target = env.current().target
+        self.target = InstallerPath(target)
+        self._root = os.open(self.target,
+                             os.O_PATH | os.O_DIRECTORY | os.O_CLOEXEC)
+        self._dirs: collections.OrderedDict = collections.OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.RLock()
+
+    def close(self):
+        """Close all descriptors"""
+        with self._lock:
+            self.invalidate()
+            if self._root >= 0:
+                os.close(self._root)
+                self._root = -1
+
+    def __enter__(self) -> 'TargetFS':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def invalidate(self):
+        """Drop all cached directory descriptors"""
+        with self._lock:
+            while self._dirs:
+                os.close(self._dirs.popitem()[1])
+
+    def _dir_fd(self, parts: Tuple[str, ...]) -> int:
+        """Get descriptor of a directory known to be free of symlinks"""
+        if not parts:
+            return self._root
+        fd = self._dirs.get(parts)
+        if fd is not None:
+            self._dirs.move_to_end(parts)
+            return fd
+        parent = self._dir_fd(parts[:-1])
+        fd = os.open(parts[-1],
+                     os.O_PATH | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC,
+                     dir_fd=parent)
+        self._dirs[parts] = fd
+        while len(self._dirs) > self._cache_size:
+            os.close(self._dirs.popitem(last=False)[1])
+        return fd
+
+    def _lookup(self, path: TargetPath, follow: bool) -> Tuple[int, str]:
+        """Resolve a path within the target
+
+        :param path: path in the target system
+        :param follow: whether to follow a symlink in the last component
+        :return: descriptor of the parent directory and name of the last
+            component (``'.'`` for the root)
+        """
+        parts: List[str] = []
+        todo = collections.deque(str(path).split('/'))
+        symlinks = 0
+        while todo:
+            name = todo.popleft()
+            if name in ('', '.'):
+                continue
+            if name == '..':
+                if parts:
+                    parts.pop()
+                continue
+            dir_fd = self._dir_fd(tuple(parts))
+            is_last = not any(n not in ('', '.') for n in todo)
+            try:
+                stat = os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+            except FileNotFoundError:
+                if is_last:
+                    return dir_fd, name
+                raise
+            if S_ISLNK(stat.st_mode) and (follow or not is_last):
+                symlinks += 1
+                if symlinks > self._MAX_SYMLINKS:
+                    raise OSError(errno.ELOOP, os.strerror(errno.ELOOP),
+                                  str(path))
+                link = os.readlink(name, dir_fd=dir_fd)
+                if link.startswith('/'):
+                    parts = []
+                todo.extendleft(reversed(link.split('/')))
+                continue
+            if is_last:
+                return dir_fd, name
+            if not S_ISDIR(stat.st_mode):
+                raise NotADirectoryError(errno.ENOTDIR,
+                                         os.strerror(errno.ENOTDIR), str(path))
+            parts.append(name)
+        if parts:
+            return self._dir_fd(tuple(parts[:-1])), parts[-1]
+        return self._root, '.'
+
+    def stat(self,
+             path: TargetPath,
+             *,
+             follow_symlinks: bool = True) -> os.stat_result:
+        """Get the status of a file (see :any:`os.stat`)"""
+        with self._lock:
+            dir_fd, name = self._lookup(path, follow_symlinks)
+            return os.stat(name, dir_fd=dir_fd, follow_symlinks=False)
+
+    def exists(self, path: TargetPath) -> bool:
+        """Check if a file exists (following symlinks)"""
+        try:
+            self.stat(path)
+        except (FileNotFoundError, NotADirectoryError):
+            return False
+        return True
+
+    def open(self, path: TargetPath, flags: int, mode: int = 0o777) -> int:
+        """Open a file (see :any:`os.open`)
+
+        :return: file descriptor, to be closed by the caller
+        """
+        with self._lock:
+            dir_fd, name = self._lookup(path, True)
+            return os.open(name,
+                           flags | os.O_NOFOLLOW | os.O_CLOEXEC,
+                           mode,
+                           dir_fd=dir_fd)
+
+    def mkdir(self,
+              path: TargetPath,
+              mode: int = 0o777,
+              *,
+              parents: bool = False,
+              exist_ok: bool = False):
+        """Create a directory (see :any:`pathlib.Path.mkdir`)"""
+        with self._lock:
+            try:
+                dir_fd, name = self._lookup(path, True)
+            except FileNotFoundError:
+                if not parents:
+                    raise
+                self.mkdir(TargetPath(path).parent,
+                           parents=True,
+                           exist_ok=True)
+                dir_fd, name = self._lookup(path, True)
+            try:
+                os.mkdir(name, mode, dir_fd=dir_fd)
+            except FileExistsError:
+                if not exist_ok or not S_ISDIR(
+                        os.stat(name, dir_fd=dir_fd,
+                                follow_symlinks=False).st_mode):
+                    raise
+
+    def chmod(self, path: TargetPath, mode: int):
+        """Change the mode of a file (following symlinks)"""
+        with self._lock:
+            dir_fd, name = self._lookup(path, True)
+            os.chmod(name, mode, dir_fd=dir_fd)
+
+    def chown(self,
+              path: TargetPath,
+              uid: int,
+              gid: int,
+              *,
+              follow_symlinks: bool = True):
+        """Change the owner of a file (see :any:`os.chown`)"""
+        with self._lock:
+            dir_fd, name = self._lookup(path, follow_symlinks)
+            os.chown(name, uid, gid, dir_fd=dir_fd, follow_symlinks=False)
+
+    def unlink(self, path: TargetPath):
+        """Remove a file (not following a symlink in the last component)"""
+        with self._lock:
+            dir_fd, name = self._lookup(path, False)
+            os.unlink(name, dir_fd=dir_fd)
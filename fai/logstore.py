@@ -0,0 +1,241 @@
+""" Command Log Store
+    =================
+
+    With ``log=True``, :any:`fai.subprocess.run` and
+    :any:`fai.subprocess.run_installer` keep the output of a command in a
+    compressed, append-only store in :any:`env.LOGDIR` instead of leaving it
+    to the script to dump it into a flat log file::
+
+        run(['apt-get', 'update'], log=True)
+
+        store = logstore.store()
+        for record, line in store.grep(r'^(Err|W):'):
+            print(' '.join(record.argv), line.decode())
+
+    The output of each command is compressed separately (with zstd if the
+    optional :py:mod:`zstandard` module is installed, with gzip otherwise)
+    and appended to :any:`DATA_FILE`. A line per command with its arguments,
+    exit code, timestamps, and the location of its output is appended to
+    :any:`INDEX_FILE`, so the output of a single command can be read without
+    decompressing anything else. Several processes and threads can append to
+    the same store.
+"""
+from __future__ import annotations
+from typing import (Any, Callable, Dict, Iterator, List, NamedTuple, Optional,
+                    Sequence, Tuple, Union)
+import fcntl
+import io
+import json
+import os
+import pathlib
+import re
+import subprocess
+import time
+
+from . import env
+
+DATA_FILE = 'pyfai-commands.dat'
+"""Name of the file with the compressed output in :any:`env.LOGDIR`"""
+
+INDEX_FILE = 'pyfai-commands.idx'
+"""Name of the index file in :any:`env.LOGDIR`"""
+
+_GZIP_LEVEL = 6
+
+
+class Record(NamedTuple):
+    """Index entry of a command"""
+    argv: List[str]
+    """command line"""
+    returncode: int
+    start: float
+    """start time (seconds since the epoch)"""
+    end: float
+    """end time (seconds since the epoch)"""
+    offset: int
+    """offset of the compressed output in the data file"""
+    length: int
+    """length of the compressed output"""
+    size: int
+    """length of the output"""
+    codec: str
+    """compression of the output (``zstd`` or ``gzip``)"""
+
+
+def _compress(data: bytes) -> Tuple[str, bytes]:
+    try:
+        # pylint: disable-next=import-outside-toplevel,import-error; optional
+        import zstandard
+    except ImportError:
+        import gzip  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        return 'gzip', gzip.compress(data, _GZIP_LEVEL)
+    return 'zstd', zstandard.ZstdCompressor().compress(data)
+
+
+def _reader(codec: str, blob: bytes) -> io.BufferedIOBase:
+    """Open a stream of decompressed output"""
+    if codec == 'zstd':
+        # pylint: disable-next=import-outside-toplevel,import-error; optional
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(
+            io.BytesIO(blob)))
+    if codec == 'gzip':
+        import gzip  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        return gzip.GzipFile(fileobj=io.BytesIO(blob))
+    raise ValueError(f'unknown compression: {codec}')
+
+
+class LogStore:
+    """Store of command output in a directory
+
+    :param directory: directory of :any:`DATA_FILE` and :any:`INDEX_FILE`
+    """
+
+    def __init__(self, directory: pathlib.Path):
+        self.data_path = directory / DATA_FILE
+        self.index_path = directory / INDEX_FILE
+
+    def append(self, argv: Sequence[str], output: bytes, returncode: int,
+               start: float, end: float) -> Record:
+        """Store the output of a command
+
+        :param argv: command line
+        :param output: output of the command
+        :param returncode: exit code of the command
+        :param start: start time (seconds since the epoch)
+        :param end: end time (seconds since the epoch)
+        :return: index entry of the stored output
+        """
+        codec, blob = _compress(output)
+        index_fd = os.open(
+            self.index_path,
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+        try:
+            fcntl.flock(index_fd, fcntl.LOCK_EX)
+            data_fd = os.open(
+                self.data_path,
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC, 0o644)
+            try:
+                offset = os.fstat(data_fd).st_size
+                view = memoryview(blob)
+                while view:
+                    view = view[os.write(data_fd, view):]
+            finally:
+                os.close(data_fd)
+            record = Record([str(a) for a in argv], returncode, start, end,
+                            offset, len(blob), len(output), codec)
+            line = json.dumps(record._asdict()) + '\n'
+            os.write(index_fd, line.encode())
+        finally:
+            os.close(index_fd)
+        return record
+
+    def records(self) -> List[Record]:
+        """Read the index
+
+        :return: entries of all stored commands in the order they were stored
+        """
+        try:
+            with open(self.index_path, encoding='utf-8') as f:
+                return [Record(**json.loads(line)) for line in f]
+        except FileNotFoundError:
+            return []
+
+    def _blob(self, record: Record) -> bytes:
+        with open(self.data_path, 'rb') as f:
+            return os.pread(f.fileno(), record.length, record.offset)
+
+    def open(self, record: Record) -> io.BufferedIOBase:
+        """Stream the output of a command
+
+        :param record: index entry of the command
+        :return: binary stream of the decompressed output
+        """
+        return _reader(record.codec, self._blob(record))
+
+    def read(self, record: Record) -> bytes:
+        """Read the output of a command
+
+        :param record: index entry of the command
+        :return: the complete output
+        """
+        with self.open(record) as f:
+            return f.read()
+
+    def grep(
+        self,
+        pattern: Union[str, bytes],
+        *,
+        where: Optional[Callable[[Record], bool]] = None
+    ) -> Iterator[Tuple[Record, bytes]]:
+        """Search the output of all commands
+
+        :param pattern: regular expression (a ``str`` pattern is encoded as
+            UTF-8)
+        :param where: select commands to search by their index entry, e.g.,
+            ``lambda r: r.returncode != 0``
+        :return: matching lines (without line breaks) and their commands
+
+        The output of each command is decompressed on the fly line by line,
+        so memory usage is bounded by the largest compressed output.
+        """
+        if isinstance(pattern, str):
+            pattern = pattern.encode()
+        regex = re.compile(pattern)
+        for record in self.records():
+            if where is not None and not where(record):
+                continue
+            with self.open(record) as f:
+                for line in f:
+                    line = line.rstrip(b'\n')
+                    if regex.search(line):
+                        yield record, line
+
+
+def store() -> LogStore:
+    """Get the log store in :any:`env.LOGDIR`
+
+    :raise ValueError: if :any:`env.LOGDIR` is not set
+    """
+    logdir = env.current().LOGDIR
+    if logdir is None:
+        raise ValueError('cannot store command output without LOGDIR')
+    return LogStore(logdir)
+
+
+def _to_bytes(output: Union[str, bytes, None]) -> bytes:
+    if output is None:
+        return b''
+    if isinstance(output, str):
+        return output.encode('utf-8', 'surrogateescape')
+    return output
+
+
+def run(argv: Sequence[str], kwargs: Dict[str, Any],
+        runner) -> subprocess.CompletedProcess:
+    """Run a command and store its output
+
+    :param argv: complete command line
+    :param kwargs: arguments like for :any:`python:subprocess.run`, including
+        ``check``; ``stderr`` defaults to ``PIPE``
+    :param runner: function to run the command with the given arguments
+        (with ``check`` disabled)
+    :return: process result
+    :raise subprocess.CalledProcessError: when command is ``check``\\ ed and
+        exits with error (after storing the output)
+
+    ``stdout`` and ``stderr`` of the result are captured separately like
+    without logging. Only the stored output combines them: the captured
+    ``stderr`` is stored after ``stdout``.
+    """
+    log_store = store()
+    kwargs.setdefault('stderr', subprocess.PIPE)
+    start = time.time()
+    result = runner(dict(kwargs, check=False))
+    end = time.time()
+    log_store.append(argv,
+                     _to_bytes(result.stdout) + _to_bytes(result.stderr),
+                     result.returncode, start, end)
+    if kwargs.get('check'):
+        result.check_returncode()
+    return result
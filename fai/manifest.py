@@ -0,0 +1,236 @@
+""" Installation Manifest
+    =====================
+
+    The manifest records the state of all files installed by
+    :any:`fai.files.install` (and thus the native :any:`fai.files.fcopy`):
+    size, mtime, inode, content hash, mode, and owner. It is stored in the
+    target at :any:`MANIFEST_PATH`, so it survives until the next
+    softupdate.
+
+    Before a file is installed, the manifest is consulted: If the
+    destination still matches its record and was copied from the same,
+    unchanged source file, nothing is read or written at all. Files are only
+    hashed if the destination has the size of the source but the manifest
+    cannot tell whether it has the same content. The digests of source files
+    are recorded as well, so an unchanged source is not even read again.
+"""
+from __future__ import annotations
+from typing import Dict, List, NamedTuple, Optional, Union
+import atexit
+import hashlib
+import json
+import os
+import pathlib
+import threading
+
+from . import env
+
+MANIFEST_PATH = pathlib.PurePosixPath('/var/lib/pyfai/manifest.json')
+"""Location of the manifest in the target system"""
+
+_BLOCK_SIZE = 1 << 20
+
+
+class Entry(NamedTuple):
+    """Manifest entry of a file"""
+    size: int
+    mtime_ns: int
+    ino: int
+    digest: Optional[str]
+    """SHA-256 hex digest of the content or :any:`None` if not hashed"""
+    mode: int
+    """permission bits"""
+    uid: int
+    gid: int
+    source: Optional[List[Union[str, int]]] = None
+    """identity of the source file the file was copied from (see
+    :any:`source_id`)"""
+
+    def matches(self, stat: os.stat_result) -> bool:
+        """Check if a file still has the recorded content
+
+        :param stat: current status of the file
+        """
+        return (self.size, self.mtime_ns,
+                self.ino) == (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+
+def source_id(path: pathlib.Path,
+              stat: os.stat_result) -> List[Union[str, int]]:
+    """Identify a version of a source file without reading it
+
+    :param path: file in the installer system
+    :param stat: status of the file
+    :return: absolute path, size, mtime, and inode of the file
+    """
+    return [os.path.abspath(path), stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+
+def file_digest(path: pathlib.Path) -> str:
+    """Hash a file
+
+    :param path: file to hash
+    :return: SHA-256 hex digest of the file's content
+    """
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(_BLOCK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Manifest:
+    """Manifest of installed files
+
+    :param path: manifest file in the installer system; loaded if it exists
+    """
+
+    def __init__(self, path: pathlib.Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._dirty = set()
+        self._files, self._sources = self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            return ({
+                p: Entry(*e)
+                for p, e in data['files'].items()
+            }, {
+                p: Entry(*e)
+                for p, e in data['sources'].items()
+            })
+        except (OSError, ValueError, KeyError, TypeError):
+            # a broken manifest only means that files are compared again
+            return {}, {}
+
+    def lookup(self, target_path: pathlib.PurePosixPath) -> Optional[Entry]:
+        """Get the entry of an installed file
+
+        :param target_path: absolute path in the target system
+        """
+        return self._files.get(str(target_path))
+
+    def __iter__(self):
+        return iter(pathlib.PurePosixPath(p) for p in self._files)
+
+    def record(self,
+               target_path: pathlib.PurePosixPath,
+               stat: os.stat_result,
+               digest: Optional[str],
+               source: Optional[List[Union[str, int]]] = None):
+        """Record an installed file
+
+        :param target_path: absolute path in the target system
+        :param stat: status of the installed file
+        :param digest: content hash of the installed file or :any:`None` if
+            not known
+        :param source: :any:`source_id` of the file it was copied from
+        """
+        entry = Entry(stat.st_size, stat.st_mtime_ns, stat.st_ino, digest,
+                      stat.st_mode & 0o7777, stat.st_uid, stat.st_gid, source)
+        with self._lock:
+            if self._files.get(str(target_path)) != entry:
+                self._files[str(target_path)] = entry
+                self._dirty.add(str(target_path))
+
+    def forget(self, target_path: pathlib.PurePosixPath):
+        """Remove a file from the manifest
+
+        :param target_path: absolute path in the target system
+        """
+        with self._lock:
+            if self._files.pop(str(target_path), None) is not None:
+                self._dirty.add(str(target_path))
+
+    def cached_source_digest(self, path: pathlib.Path,
+                             stat: os.stat_result) -> Optional[str]:
+        """Get the content hash of a source file if known
+
+        :param path: file in the installer system
+        :param stat: current status of the file
+        :return: the recorded hash or :any:`None` if the file was not hashed
+            in this version
+
+        The file is never read.
+        """
+        entry = self._sources.get(os.path.abspath(path))
+        if entry is not None and entry.matches(stat):
+            return entry.digest
+        return None
+
+    def source_digest(self, path: pathlib.Path) -> str:
+        """Get the content hash of a source file
+
+        :param path: file in the installer system
+
+        The file is only hashed if it changed since it was hashed last.
+        """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        digest = self.cached_source_digest(path, stat)
+        if digest is not None:
+            return digest
+        digest = file_digest(path)
+        with self._lock:
+            self._sources[key] = Entry(stat.st_size, stat.st_mtime_ns,
+                                       stat.st_ino, digest,
+                                       stat.st_mode & 0o7777, stat.st_uid,
+                                       stat.st_gid)
+            self._dirty.add(None)
+        return digest
+
+    def save(self):
+        """Save the manifest atomically if it changed
+
+        Entries changed by other processes in the meantime are kept unless
+        changed here as well.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            files, sources = self._load()
+            for path in self._dirty:
+                if path is None:
+                    continue
+                if path in self._files:
+                    files[path] = self._files[path]
+                else:
+                    files.pop(path, None)
+            sources.update(self._sources)
+            self._files, self._sources = files, sources
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = self.path.with_name(f'.{self.path.name}.{os.getpid()}')
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump({'files': files, 'sources': sources}, f)
+            os.replace(tmp, self.path)
+            self._dirty.clear()
+
+
+_manifests: Dict[pathlib.Path, Manifest] = {}
+_manifests_lock = threading.Lock()
+
+
+def for_target() -> Manifest:
+    """Get the manifest of the current target
+
+    The manifest is loaded once per target and saved when the process exits.
+    """
+    target = env.current().target
+    with _manifests_lock:
+        manifest = _manifests.get(target)
+        if manifest is None:
+            manifest = Manifest(target / MANIFEST_PATH.relative_to('/'))
+            _manifests[target] = manifest
+        return manifest
+
+
+@atexit.register
+def _save_all():
+    for manifest in list(_manifests.values()):
+        try:
+            manifest.save()
+        except OSError:
+            pass  # the manifest is just an optimization
@@ -0,0 +1,223 @@
+""" Package Database
+    ================
+
+    Fast queries of the packages installed in the target system.
+
+    Instead of running ``dpkg-query`` in the target for every question, the
+    dpkg status database (:any:`STATUS_PATH`) is read directly in a single
+    pass and indexed in memory. The index is cached per target and only
+    rebuilt if the status file changed (by mtime, size or inode), so
+    repeated queries are just dictionary lookups::
+
+        from fai import packages
+
+        if packages.is_installed('openssh-server'):
+            ...
+        missing = set(wanted) - packages.installed(wanted)
+
+    Package names can be qualified with an architecture (``libc6:amd64``).
+    Unqualified names match packages of any architecture.
+"""
+from __future__ import annotations
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set
+import os
+import pathlib
+import threading
+
+from . import files
+
+STATUS_PATH = files.TargetPath('/var/lib/dpkg/status')
+"""Location of the dpkg status database in the target system"""
+
+
+class Package(NamedTuple):
+    """Entry of a package in the status database"""
+    name: str
+    arch: str
+    version: str
+    status: str
+    """``Status`` field, e.g. ``install ok installed``"""
+    provides: tuple
+    """names of virtual packages provided by the package"""
+
+    @property
+    def state(self) -> str:
+        """Package state, e.g. ``installed`` or ``config-files``"""
+        return self.status.rsplit(' ', 1)[-1]
+
+    @property
+    def is_installed(self) -> bool:
+        """Whether the package is completely installed"""
+        return self.state == 'installed'
+
+
+def _parse_provides(value: str) -> tuple:
+    # e.g. "mail-transport-agent, default-mta (= 4.94), libfoo:any"
+    return tuple(
+        item.split('(', 1)[0].split(':', 1)[0].strip()
+        for item in value.split(','))
+
+
+class Status:
+    """Index of a dpkg status database
+
+    :param packages: all packages of the database
+    """
+
+    def __init__(self, packages: Iterable[Package]):
+        self._packages: Dict[str, List[Package]] = {}
+        self._provided: Dict[str, List[Package]] = {}
+        for package in packages:
+            self._packages.setdefault(package.name, []).append(package)
+            for name in package.provides:
+                self._provided.setdefault(name, []).append(package)
+
+    @classmethod
+    def parse(cls, path: pathlib.Path) -> Status:
+        """Read a status database
+
+        :param path: status file in the installer system
+        """
+        return cls(_parse(path))
+
+    def __iter__(self) -> Iterator[Package]:
+        for packages in self._packages.values():
+            yield from packages
+
+    def lookup(self, name: str) -> List[Package]:
+        """Find the packages of a name
+
+        :param name: package name, optionally qualified with ``:arch``
+        :return: matching packages of all architectures (or the given one)
+        """
+        name, _, arch = name.partition(':')
+        packages = self._packages.get(name, [])
+        if arch and arch != 'any':
+            packages = [p for p in packages if p.arch == arch]
+        return packages
+
+    def get(self, name: str) -> Optional[Package]:
+        """Get the package of a name
+
+        :param name: package name, optionally qualified with ``:arch``
+        :return: the installed package of the name if any, otherwise any
+            other package of the name, or :any:`None` if unknown
+        """
+        packages = self.lookup(name)
+        for package in packages:
+            if package.is_installed:
+                return package
+        return packages[0] if packages else None
+
+    def version(self, name: str) -> Optional[str]:
+        """Get the installed version of a package
+
+        :param name: package name, optionally qualified with ``:arch``
+        :return: version or :any:`None` if the package is not installed
+        """
+        package = self.get(name)
+        if package is None or not package.is_installed:
+            return None
+        return package.version
+
+    def is_installed(self, name: str, provides: bool = False) -> bool:
+        """Check if a package is installed
+
+        :param name: package name, optionally qualified with ``:arch``
+        :param provides: also accept installed packages providing
+            :any:`name <Status.is_installed.params.name>`
+        """
+        if any(p.is_installed for p in self.lookup(name)):
+            return True
+        return provides and any(p.is_installed
+                                for p in self._provided.get(name, ()))
+
+    def installed(self,
+                  names: Iterable[str],
+                  provides: bool = False) -> Set[str]:
+        """Check which of several packages are installed
+
+        :param names: package names, optionally qualified with ``:arch``
+        :param provides: also accept installed packages providing a name
+        :return: the subset of :any:`names <Status.installed.params.names>`
+            that is installed
+        """
+        return {n for n in names if self.is_installed(n, provides)}
+
+
+_FIELDS = frozenset(
+    ['Package', 'Architecture', 'Version', 'Status', 'Provides'])
+
+
+def _parse(path: pathlib.Path) -> Iterator[Package]:
+    """Parse a status database in one streaming pass"""
+    fields: Dict[str, str] = {}
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        for line in f:
+            if line[0] in ' \t':
+                continue  # continuation of a field we do not need
+            if line == '\n':
+                if 'Package' in fields:
+                    yield _package(fields)
+                fields = {}
+                continue
+            key, _, value = line.partition(':')
+            if key in _FIELDS:
+                fields[key] = value.strip()
+    if 'Package' in fields:
+        yield _package(fields)
+
+
+def _package(fields: Dict[str, str]) -> Package:
+    provides = fields.get('Provides')
+    return Package(fields['Package'], fields.get('Architecture', ''),
+                   fields.get('Version', ''), fields.get('Status', ''),
+                   _parse_provides(provides) if provides else ())
+
+
+_lock = threading.Lock()
+_cache: Dict[pathlib.Path, tuple] = {}
+
+
+def status() -> Status:
+    """Get the index of the target's status database
+
+    The database is parsed once per target and re-parsed only if it changed
+    (by mtime, size or inode). A missing database yields an empty index.
+    """
+    path = files.resolve(STATUS_PATH)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return Status(())
+    key = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+    with _lock:
+        cached_key, index = _cache.get(path, (None, None))
+        if key != cached_key:
+            index = Status.parse(path)
+            _cache[path] = (key, index)
+        return index
+
+
+def is_installed(name: str, provides: bool = False) -> bool:
+    """Check if a package is installed in the target
+
+    See :any:`Status.is_installed`.
+    """
+    return status().is_installed(name, provides)
+
+
+def installed(names: Iterable[str], provides: bool = False) -> Set[str]:
+    """Check which of several packages are installed in the target
+
+    See :any:`Status.installed`.
+    """
+    return status().installed(names, provides)
+
+
+def version(name: str) -> Optional[str]:
+    """Get the installed version of a package in the target
+
+    See :any:`Status.version`.
+    """
+    return status().version(name)
@@ -0,0 +1,361 @@
+""" Services
+    ========
+
+    Enable, disable, mask, and unmask systemd units in the target system.
+
+    During an installation (i.e., not :any:`env.is_online`), ``systemctl``
+    is not run at all. Instead, the ``[Install]`` sections of all unit files
+    in the target are read once into an index (:any:`UnitIndex`), and the
+    symlinks below :any:`CONFIG_DIR` are created and removed directly, like
+    ``systemctl`` would do. Enabling many units thus only costs one pass over
+    the unit files and a few symlinks instead of one chroot and ``systemctl``
+    run per unit.
+
+    When online, all given units are passed to a single ``systemctl`` call,
+    so that the running systemd is notified of the changes.
+
+    Example::
+
+        services.enable(['ssh', 'chrony', 'getty@tty2'])
+        services.mask(['apt-daily.timer'])
+
+    Unit names without suffix are taken as ``.service`` units. Specifiers
+    such as ``%i`` in ``[Install]`` sections are not supported.
+"""
+from __future__ import annotations
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+import os
+import threading
+
+from . import env, files, subprocess
+
+CONFIG_DIR = files.TargetPath('/etc/systemd/system')
+"""Directory with the enablement symlinks in the target system"""
+
+UNIT_PATHS = (
+    CONFIG_DIR,
+    files.TargetPath('/usr/local/lib/systemd/system'),
+    files.TargetPath('/usr/lib/systemd/system'),
+    files.TargetPath('/lib/systemd/system'),
+)
+"""Directories searched for unit files, in order of precedence"""
+
+_INSTALL_KEYS = frozenset(
+    ['WantedBy', 'RequiredBy', 'Alias', 'Also', 'DefaultInstance'])
+
+_MASK_TARGET = '/dev/null'
+
+
+class Unit(NamedTuple):
+    """``[Install]`` section of a unit file"""
+    path: files.TargetPath
+    """location of the unit file"""
+    wanted_by: Tuple[str, ...]
+    required_by: Tuple[str, ...]
+    alias: Tuple[str, ...]
+    also: Tuple[str, ...]
+    default_instance: Optional[str]
+
+
+def _parse_install(path: files.InstallerPath) -> Dict[str, List[str]]:
+    """Read the ``[Install]`` section of a unit file"""
+    values: Dict[str, List[str]] = {}
+    section = None
+    with open(path, encoding='utf-8', errors='surrogateescape') as f:
+        lines = iter(f)
+        for line in lines:
+            line = line.strip()
+            while line.endswith('\\'):
+                line = line[:-1] + ' ' + next(lines, '').strip()
+            if not line or line[0] in '#;':
+                continue
+            if line[0] == '[':
+                section = line.strip('[]')
+                continue
+            if section != 'Install':
+                continue
+            key, _, value = line.partition('=')
+            key = key.strip()
+            if key not in _INSTALL_KEYS:
+                continue
+            value = value.split()
+            if value:
+                values.setdefault(key, []).extend(value)
+            else:
+                values.pop(key, None)  # empty assignment resets the list
+    return values
+
+
+class UnitIndex:
+    """Index of the unit files in the target system
+
+    :param units: unit files by unit name
+    :param aliases: unit names by name of a symlink to their unit file
+
+    Only the unit file of highest precedence (see :any:`UNIT_PATHS`) is
+    indexed for each name.
+    """
+
+    def __init__(self, units: Dict[str, Unit], aliases: Dict[str, str]):
+        self.units = units
+        self.aliases = aliases
+
+    @classmethod
+    def scan(cls, dirs: Iterable[files.TargetPath] = UNIT_PATHS) -> UnitIndex:
+        """Build the index by reading all unit files once
+
+        :param dirs: directories to search in order of precedence
+        """
+        units: Dict[str, Unit] = {}
+        aliases: Dict[str, str] = {}
+        seen: Set[str] = set()
+        for directory in dirs:
+            installer_dir = files.resolve(directory)
+            # /lib and /usr/lib are the same with merged /usr
+            real = os.path.realpath(installer_dir)
+            if real in seen:
+                continue
+            seen.add(real)
+            try:
+                entries = list(os.scandir(installer_dir))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.name in units or entry.name in aliases or \
+                        '.' not in entry.name:
+                    continue
+                try:
+                    if entry.is_symlink():
+                        # absolute links point into the target, so only
+                        # remember the name (masks are no units at all)
+                        link = os.readlink(entry.path)
+                        if link != _MASK_TARGET:
+                            aliases[entry.name] = os.path.basename(link)
+                        continue
+                    if not entry.is_file():
+                        continue
+                    values = _parse_install(entry.path)
+                except OSError:
+                    continue
+                units[entry.name] = Unit(
+                    directory / entry.name,
+                    tuple(values.get('WantedBy', ())),
+                    tuple(values.get('RequiredBy', ())),
+                    tuple(values.get('Alias', ())),
+                    tuple(values.get('Also', ())),
+                    (values.get('DefaultInstance') or [None])[-1],
+                )
+        return cls(units, aliases)
+
+    def find(self, name: str) -> Tuple[str, Unit]:
+        """Find the unit file of a unit
+
+        :param name: unit name or alias; template instances are looked up by
+            their template unless a unit file of the instance exists
+        :return: unit name and unit file
+        :raise FileNotFoundError: if there is no unit file
+        """
+        name = _unit_name(name)
+        name = self.aliases.get(name, name)
+        prefix, at, rest = name.partition('@')
+        unit = self.units.get(name)
+        if unit is None and at:
+            unit = self.units.get(f'{prefix}@{rest[rest.rfind("."):]}')
+        if unit is None:
+            raise FileNotFoundError(f'unit file {name} does not exist')
+        return name, unit
+
+
+def _unit_name(name: str) -> str:
+    return name if '.' in name.rsplit('@', 1)[-1] else name + '.service'
+
+
+_lock = threading.Lock()
+_indexes: Dict[str, Tuple[tuple, UnitIndex]] = {}
+
+
+def _dirs_key() -> tuple:
+    """mtimes of the unit directories (changes when units are added)"""
+    key = []
+    for directory in UNIT_PATHS:
+        try:
+            key.append(os.stat(files.resolve(directory)).st_mtime_ns)
+        except OSError:
+            key.append(None)
+    return tuple(key)
+
+
+def index() -> UnitIndex:
+    """Get the unit index of the target system
+
+    The index is built once per target and rebuilt only if units were added
+    to or removed from one of the :any:`UNIT_PATHS`.
+    """
+    target = str(env.current().target)
+    key = _dirs_key()
+    with _lock:
+        cached_key, unit_index = _indexes.get(target, (None, None))
+        if key != cached_key:
+            unit_index = UnitIndex.scan()
+            _indexes[target] = (key, unit_index)
+        return unit_index
+
+
+def _symlink(link: files.TargetPath, target: str) -> bool:
+    """Create or replace a symlink
+
+    :return: whether the link was changed
+    """
+    path = files.resolve(link)
+    try:
+        if os.readlink(path) == target:
+            return False
+    except FileNotFoundError:
+        path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+    except OSError:
+        pass  # not a symlink, replace it
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+    os.symlink(target, tmp)
+    os.replace(tmp, path)
+    return True
+
+
+def _expand(names: Iterable[str], unit_index: UnitIndex) -> Dict[str, Unit]:
+    """Find units including the ones in ``Also=``"""
+    result: Dict[str, Unit] = {}
+    todo = list(names)
+    while todo:
+        name, unit = unit_index.find(todo.pop(0))
+        if name not in result:
+            result[name] = unit
+            todo.extend(unit.also)
+    return result
+
+
+def enable(units: Iterable[str]):
+    """Enable units
+
+    :param units: unit names
+    :raise FileNotFoundError: if a unit file does not exist (offline)
+    :raise subprocess.CalledProcessError: if ``systemctl`` fails (online)
+
+    Creates the symlinks for ``WantedBy=``, ``RequiredBy=``, and ``Alias=``
+    and enables the units in ``Also=``.
+    """
+    units = list(units)
+    if not units:
+        return
+    if env.is_online():
+        subprocess.run(['systemctl', 'enable', '--'] + units)
+        return
+    for name, unit in _expand(units, index()).items():
+        target = str(unit.path)
+        prefix, at, rest = name.partition('@')
+        if at and rest.startswith('.'):
+            if not unit.default_instance:
+                continue  # template without instance
+            name = f'{prefix}@{unit.default_instance}{rest}'
+        for suffix, dependents in (('.wants', unit.wanted_by),
+                                   ('.requires', unit.required_by)):
+            for dependent in dependents:
+                _symlink(CONFIG_DIR / (dependent + suffix) / name, target)
+        for alias in unit.alias:
+            if '@' not in name:
+                _symlink(CONFIG_DIR / alias, target)
+
+
+def _links() -> Iterable[Tuple[files.InstallerPath, str]]:
+    """All symlinks in :any:`CONFIG_DIR` and its dependency directories"""
+    config_dir = files.resolve(CONFIG_DIR)
+    try:
+        entries = list(os.scandir(config_dir))
+    except FileNotFoundError:
+        return
+    for entry in entries:
+        if entry.is_symlink():
+            yield files.InstallerPath(entry.path), os.readlink(entry.path)
+        elif entry.is_dir(follow_symlinks=False) and entry.name.endswith(
+            ('.wants', '.requires')):
+            for link in os.scandir(entry.path):
+                if link.is_symlink():
+                    yield files.InstallerPath(link.path), os.readlink(
+                        link.path)
+
+
+def disable(units: Iterable[str]):
+    """Disable units
+
+    :param units: unit names
+    :raise FileNotFoundError: if a unit file does not exist (offline)
+    :raise subprocess.CalledProcessError: if ``systemctl`` fails (online)
+
+    Removes all enablement symlinks of the units and of the units in
+    ``Also=``, i.e., like ``systemctl``, all symlinks to their unit files
+    (only the ones of the given instance for template instances). Links of
+    other units with the same name (e.g., a shared ``Alias=``) and masks
+    are kept.
+    """
+    units = list(units)
+    if not units:
+        return
+    if env.is_online():
+        subprocess.run(['systemctl', 'disable', '--'] + units)
+        return
+    # instances to disable by unit file name (None: all links to the file)
+    unit_files: Dict[str, Optional[Set[str]]] = {}
+    for name, unit in _expand(units, index()).items():
+        file_name = unit.path.name
+        if file_name == name or name.split('@', 1)[-1].startswith('.'):
+            unit_files[file_name] = None
+        elif unit_files.get(file_name, set()) is not None:
+            unit_files.setdefault(file_name, set()).add(name)
+    for link, target in list(_links()):
+        file_name = os.path.basename(target)
+        if file_name not in unit_files:
+            continue  # also keeps masks
+        instances = unit_files[file_name]
+        if instances is None or link.name in instances:
+            link.unlink()
+
+
+def mask(units: Iterable[str]):
+    """Mask units
+
+    :param units: unit names
+    :raise FileExistsError: if a unit file in :any:`CONFIG_DIR` is in the way
+        (offline)
+    :raise subprocess.CalledProcessError: if ``systemctl`` fails (online)
+    """
+    units = [_unit_name(u) for u in units]
+    if not units:
+        return
+    if env.is_online():
+        subprocess.run(['systemctl', 'mask', '--'] + units)
+        return
+    for name in units:
+        link = CONFIG_DIR / name
+        path = files.resolve(link)
+        if path.exists() and not path.is_symlink():
+            raise FileExistsError(f'unit file {link} exists')
+        _symlink(link, _MASK_TARGET)
+
+
+def unmask(units: Iterable[str]):
+    """Unmask units
+
+    :param units: unit names
+    :raise subprocess.CalledProcessError: if ``systemctl`` fails (online)
+    """
+    units = [_unit_name(u) for u in units]
+    if not units:
+        return
+    if env.is_online():
+        subprocess.run(['systemctl', 'unmask', '--'] + units)
+        return
+    for name in units:
+        path = files.resolve(CONFIG_DIR / name)
+        try:
+            if os.readlink(path) == _MASK_TARGET:
+                path.unlink()
+        except OSError:
+            pass  # not masked
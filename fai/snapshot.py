@@ -0,0 +1,371 @@
+""" Target Snapshots
+    ================
+
+    Record the state of the target's filesystem tree and find out what
+    changed in between, e.g., to audit a customization script or to decide
+    which services must be reloaded::
+
+        before = snapshot.take()
+        run_customization()
+        changes = snapshot.diff(before, snapshot.take(previous=before))
+        if any(p.parts[:3] == ('/', 'etc', 'ssh') for p in changes.modified):
+            services_to_restart.add('ssh')
+
+    The tree is scanned with parallel ``os.scandir`` workers. A
+    :any:`Snapshot` keeps only the paths and a few :any:`array.array` columns
+    of metadata (size, mtime, inode, mode, owner) instead of one object per
+    file, and can be stored on disk in the same compact form.
+
+    File contents are only hashed where the metadata does not tell: when
+    size and type are unchanged but mtime or inode changed, and the older
+    snapshot has a digest of the file to compare with. Digests are kept in
+    the newer snapshot, so a file is hashed at most once per change.
+"""
+from __future__ import annotations
+from typing import Iterable, List, NamedTuple, Optional, Sequence, Tuple
+import array
+import bisect
+import json
+import os
+import pathlib
+import sys
+from stat import S_IFMT, S_ISDIR, S_ISREG
+
+from . import env, files, manifest
+
+DEFAULT_EXCLUDE = ('/proc', '/sys', '/dev', '/run', '/tmp')
+"""Directories in the target that are not scanned by default"""
+
+_MAGIC = b'PYFAI-SNAPSHOT 1\n'
+_COLUMNS = (
+    ('size', 'q'),
+    ('mtime_ns', 'q'),
+    ('ino', 'Q'),
+    ('mode', 'I'),
+    ('uid', 'I'),
+    ('gid', 'I'),
+)
+_DIGEST_SIZE = 32
+_NO_DIGEST = bytes(_DIGEST_SIZE)
+
+
+class Record(NamedTuple):
+    """Metadata of a path in a snapshot"""
+    size: int
+    mtime_ns: int
+    ino: int
+    mode: int
+    """``st_mode`` including the file type"""
+    uid: int
+    gid: int
+    digest: Optional[bytes]
+    """SHA-256 digest of a regular file if it was hashed"""
+
+
+class Diff(NamedTuple):
+    """Differences between two snapshots"""
+    added: List[files.TargetPath]
+    removed: List[files.TargetPath]
+    modified: List[files.TargetPath]
+    """paths with changed content or type"""
+    attributes: List[files.TargetPath]
+    """paths with only changed mode or owner"""
+
+
+class Snapshot:
+    """ State of a filesystem tree
+
+    :param root: scanned directory in the installer system
+    :param paths: sorted paths relative to
+        :any:`root <Snapshot.params.root>`
+    :param columns: metadata arrays by column name (parallel to ``paths``)
+    :param digests: concatenated SHA-256 digests (zero bytes for files that
+        were not hashed)
+
+    Use :any:`take` or :any:`load` to create a snapshot.
+    """
+
+    def __init__(self, root: files.InstallerPath, paths: List[str],
+                 columns: dict, digests: bytearray):
+        self.root = root
+        self.paths = paths
+        self.columns = columns
+        self.digests = digests
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+    def _index(self, target_path: files.TargetPath) -> Optional[int]:
+        rel = str(target_path).lstrip('/')
+        i = bisect.bisect_left(self.paths, rel)
+        if i < len(self.paths) and self.paths[i] == rel:
+            return i
+        return None
+
+    def _record(self, i: int) -> Record:
+        digest = self.digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE]
+        return Record(*(self.columns[name][i] for name, _ in _COLUMNS),
+                      bytes(digest) if digest != _NO_DIGEST else None)
+
+    def lookup(self, target_path: files.TargetPath) -> Optional[Record]:
+        """Get the metadata of a path
+
+        :param target_path: absolute path in the target system
+        :return: metadata or :any:`None` if the path was not found
+        """
+        i = self._index(target_path)
+        return self._record(i) if i is not None else None
+
+    def __contains__(self, target_path: files.TargetPath) -> bool:
+        return self._index(target_path) is not None
+
+    def save(self, path: pathlib.Path):
+        """Store the snapshot atomically in a file
+
+        :param path: file in the installer system
+        """
+        blob = '\0'.join(self.paths).encode('utf-8', 'surrogateescape')
+        header = {
+            'root': str(self.root),
+            'count': len(self.paths),
+            'paths': len(blob),
+            'byteorder': sys.byteorder,
+        }
+        tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+        with open(tmp, 'wb') as f:
+            f.write(_MAGIC)
+            f.write(json.dumps(header).encode() + b'\n')
+            f.write(blob)
+            for name, _ in _COLUMNS:
+                self.columns[name].tofile(f)
+            f.write(self.digests)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path: pathlib.Path) -> Snapshot:
+        """Load a snapshot stored by :any:`save`
+
+        :param path: file in the installer system
+        :raise ValueError: if the file is not a valid snapshot
+        """
+        with open(path, 'rb') as f:
+            if f.readline() != _MAGIC:
+                raise ValueError(f'{path} is no snapshot file')
+            header = json.loads(f.readline())
+            count = header['count']
+            blob = f.read(header['paths'])
+            paths = blob.decode('utf-8', 'surrogateescape').split('\0') \
+                if count else []
+            columns = {}
+            for name, typecode in _COLUMNS:
+                column = array.array(typecode)
+                column.fromfile(f, count)
+                if header['byteorder'] != sys.byteorder:
+                    column.byteswap()
+                columns[name] = column
+            digests = bytearray(f.read(count * _DIGEST_SIZE))
+        if len(paths) != count or len(digests) != count * _DIGEST_SIZE:
+            raise ValueError(f'{path} is truncated')
+        return cls(files.InstallerPath(header['root']), paths, columns,
+                   digests)
+
+
+def _scan_dir(root: str, rel: str) -> Tuple[list, List[str]]:
+    """Scan a single directory
+
+    :return: rows of all entries and relative paths of subdirectories
+    """
+    rows = []
+    subdirs = []
+    try:
+        it = os.scandir(os.path.join(root, rel))
+    except OSError:
+        return rows, subdirs  # vanished or unreadable
+    with it:
+        for entry in it:
+            try:
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            path = f'{rel}/{entry.name}' if rel else entry.name
+            rows.append((path, st.st_size, st.st_mtime_ns, st.st_ino,
+                         st.st_mode, st.st_uid, st.st_gid))
+            if S_ISDIR(st.st_mode):
+                subdirs.append(path)
+    return rows, subdirs
+
+
+def _hash(root: str, rel: str) -> bytes:
+    try:
+        return bytes.fromhex(manifest.file_digest(os.path.join(root, rel)))
+    except OSError:
+        return _NO_DIGEST
+
+
+def take(root: Optional[files.InstallerPath] = None,
+         *,
+         exclude: Iterable[str] = DEFAULT_EXCLUDE,
+         previous: Optional[Snapshot] = None,
+         hash_files: bool = False,
+         workers: Optional[int] = None) -> Snapshot:
+    """Scan a filesystem tree
+
+    :param root: directory to scan (default: :any:`env.target`)
+    :param exclude: absolute paths below
+        :any:`root <take.params.root>` not to descend into
+    :param previous: earlier snapshot of the same tree; digests of files
+        unchanged since are taken over
+    :param hash_files: hash all regular files not hashed in
+        :any:`previous <take.params.previous>` yet
+    :param workers: number of parallel scanners (default: like
+        :any:`concurrent.futures.ThreadPoolExecutor`)
+    :return: new snapshot
+    """
+    import concurrent.futures  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    if root is None:
+        root = env.current().target
+    root_str = str(root)
+    excluded = {str(e).strip('/') for e in exclude}
+    rows = []
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = {pool.submit(_scan_dir, root_str, '')}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                dir_rows, subdirs = future.result()
+                rows.extend(dir_rows)
+                pending.update(
+                    pool.submit(_scan_dir, root_str, d) for d in subdirs
+                    if d not in excluded)
+        rows.sort()
+        paths = [row[0] for row in rows]
+        columns = {
+            name: array.array(typecode, (row[i + 1] for row in rows))
+            for i, (name, typecode) in enumerate(_COLUMNS)
+        }
+        del rows
+        digests = bytearray(len(paths) * _DIGEST_SIZE)
+        snap = Snapshot(files.InstallerPath(root_str), paths, columns, digests)
+        if previous is not None:
+            _take_over_digests(previous, snap)
+        if hash_files:
+            todo = [
+                i for i in range(len(paths)) if S_ISREG(columns['mode'][i]) and
+                digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE] == _NO_DIGEST
+            ]
+            _hash_into(pool, snap, todo)
+    return snap
+
+
+def _same_content_key(snap: Snapshot, i: int) -> tuple:
+    c = snap.columns
+    return (S_IFMT(c['mode'][i]), c['size'][i], c['mtime_ns'][i], c['ino'][i])
+
+
+def _take_over_digests(old: Snapshot, new: Snapshot):
+    """Copy digests of unchanged files from an older snapshot"""
+    for i, j in _common(old.paths, new.paths):
+        if _same_content_key(old, i) == _same_content_key(new, j):
+            new.digests[j * _DIGEST_SIZE:(j + 1) * _DIGEST_SIZE] = \
+                old.digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE]
+
+
+def _hash_into(pool, snap: Snapshot, indexes: Sequence[int]):
+    """Hash files in parallel and store their digests in the snapshot"""
+    root = str(snap.root)
+    digests = pool.map(lambda i: _hash(root, snap.paths[i]), indexes)
+    for i, digest in zip(indexes, digests):
+        snap.digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE] = digest
+
+
+def _common(a: List[str], b: List[str]) -> Iterable[Tuple[int, int]]:
+    """Indexes of paths in both sorted lists"""
+    i = j = 0
+    while i < len(a) and j < len(b):
+        if a[i] == b[j]:
+            yield i, j
+            i += 1
+            j += 1
+        elif a[i] < b[j]:
+            i += 1
+        else:
+            j += 1
+
+
+def diff(old: Snapshot,
+         new: Snapshot,
+         *,
+         workers: Optional[int] = None) -> Diff:
+    """Compare two snapshots of the same tree
+
+    :param old: earlier snapshot
+    :param new: later snapshot; digests computed for the comparison are
+        stored in it
+    :param workers: number of parallel hashers
+    :return: changed paths, sorted (absolute paths relative to the
+        snapshots' root, i.e., in the target system for snapshots of
+        :any:`env.target`)
+
+    Regular files with unchanged type and size but changed mtime or inode
+    are hashed if ``old`` has a digest of the file (see
+    :any:`hash_files <take.params.hash_files>`). They only count as modified
+    if the content differs from that digest. Without a digest in ``old``,
+    they count as modified if their mtime changed. Changes of directory
+    mtimes are ignored as they are caused by added or removed entries.
+    """
+    import concurrent.futures  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    old_c, new_c = old.columns, new.columns
+    common = list(_common(old.paths, new.paths))
+    in_old = bytearray(len(old.paths))
+    in_new = bytearray(len(new.paths))
+    modified = []
+    to_hash = []
+    for i, j in common:
+        in_old[i] = in_new[j] = 1
+        old_key = _same_content_key(old, i)
+        new_key = _same_content_key(new, j)
+        if old_key == new_key or S_ISDIR(new_c['mode'][j]) and \
+                old_key[0] == new_key[0]:
+            continue
+        if old_key[:2] != new_key[:2] or not S_ISREG(new_c['mode'][j]):
+            modified.append(j)  # changed type, size, or link
+        elif old.digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE] != \
+                _NO_DIGEST:
+            to_hash.append((i, j))
+        elif old_key[2] != new_key[2]:
+            modified.append(j)  # nothing to compare the content with
+
+    missing = [
+        j for i, j in to_hash
+        if new.digests[j * _DIGEST_SIZE:(j + 1) * _DIGEST_SIZE] == _NO_DIGEST
+    ]
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        _hash_into(pool, new, missing)
+    for i, j in to_hash:
+        old_digest = old.digests[i * _DIGEST_SIZE:(i + 1) * _DIGEST_SIZE]
+        new_digest = new.digests[j * _DIGEST_SIZE:(j + 1) * _DIGEST_SIZE]
+        if old_digest != new_digest:
+            modified.append(j)
+
+    modified_set = set(modified)
+    attributes = [
+        j for i, j in common
+        if j not in modified_set and (old_c['mode'][i], old_c['uid'][i],
+                                      old_c['gid'][i]) != (new_c['mode'][j],
+                                                           new_c['uid'][j],
+                                                           new_c['gid'][j])
+    ]
+
+    def target_paths(snap: Snapshot, indexes: Iterable[int]):
+        return [files.TargetPath('/' + snap.paths[k]) for k in sorted(indexes)]
+
+    return Diff(
+        added=target_paths(new,
+                           (j
+                            for j in range(len(new.paths)) if not in_new[j])),
+        removed=target_paths(
+            old, (i for i in range(len(old.paths)) if not in_old[i])),
+        modified=target_paths(new, modified),
+        attributes=target_paths(new, attributes),
+    )
@@ -3,22 +3,69 @@
 
     This module provides a simple wrapper around :any:`python:subprocess.run`
     to run commands in the installer or in the target system.
+
+    Commands in the target system can optionally be sent to a persistent
+    :any:`Worker` instead of starting a new :any:`env.ROOTCMD` for each
+    command.
+
+    Results of pure queries can be cached across all scripts of a FAI run with
+    ``cache=True`` (see :py:mod:`fai.cmdcache`). The output of commands can be
+    kept in a compressed store in :any:`env.LOGDIR` with ``log=True`` (see
+    :py:mod:`fai.logstore`).
+
+    Independent commands can be run concurrently with the :py:mod:`asyncio`
+    variants :any:`run_installer_async` and :any:`run_async`, optionally
+    bounded by :any:`gather`::
+
+        results = asyncio.run(gather(
+            *(run_installer_async(['smartctl', '-j', '-a', d]) for d in disks),
+            limit=8,
+        ))
 """
-from typing import Sequence
+from __future__ import annotations
+from typing import (Any, Awaitable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence, Tuple, Union)
+import collections
+import itertools
+import locale
+import os
+import pathlib
 import subprocess
+import sys
+import threading
+import time
 
-from . import env
+from . import env, trace
+
+
+def _set_defaults(kwargs: dict):
+    kwargs.setdefault('check', True)
+    kwargs.setdefault('universal_newlines', True)
+    kwargs.setdefault('stdout', subprocess.PIPE)
 
 
 def run_installer(args: Sequence[str],
+                  *,
+                  cache: bool = False,
+                  watch: Iterable[pathlib.Path] = (),
+                  log: bool = False,
                   **kwargs) -> subprocess.CompletedProcess:
     """ Run command in installer system
 
     :param args: command and its arguments
+    :param cache: return the cached result of an earlier call if available
+        (see :py:mod:`fai.cmdcache`)
+    :param watch: files in the installer system whose change invalidates the
+        cached result
+    :param log: store the output in :any:`env.LOGDIR` (see
+        :py:mod:`fai.logstore`); ``stderr`` is captured as well unless
+        given
     :param kwargs: additional arguments for :any:`python:subprocess.run`
     :return: process result
     :raise subprocess.CalledProcessError: when command is ``check``\\ ed and
         exits with error
+    :raise ValueError: if ``cache`` is set and the command's arguments cannot
+        be cached (e.g., a file object as ``stdout``)
 
     By default, commands are ``check``\\ ed (i.e., ``raise`` when exiting with
     error) and ``stdout`` is captured in ``text`` mode.
@@ -32,24 +79,52 @@ def run_installer(args: Sequence[str],
 
         r = run_installer(['systemd-detect-virt'], check=False)
         is_virt = r.returncode == 0
+
+    Example with cache::
+
+        r = run_installer(['lsblk', '--json', '-O'], cache=True)
     """
-    kwargs.setdefault('check', True)
-    kwargs.setdefault('universal_newlines', True)
-    kwargs.setdefault('stdout', subprocess.PIPE)
+    _set_defaults(kwargs)
+    if log:
+        from . import logstore  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        return logstore.run(
+            args, kwargs,
+            lambda kw: run_installer(args, cache=cache, watch=watch, **kw))
+    if cache:
+        from . import cmdcache  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        return cmdcache.run(args,
+                            kwargs,
+                            lambda kw: run_installer(args, **kw),
+                            watch=watch)
+    if trace.is_enabled():
+        return trace.run(args, op='run_installer', **kwargs)
     # pylint: disable=subprocess-run-check; check is always set in kwargs
     return subprocess.run(args, **kwargs)
 
 
-def run(args: Sequence[str], **kwargs) -> subprocess.CompletedProcess:
+def run(args: Sequence[str],
+        *,
+        cache: bool = False,
+        watch: Iterable[pathlib.PurePosixPath] = (),
+        log: bool = False,
+        **kwargs) -> subprocess.CompletedProcess:
     """ Run command in target system
 
     :param args: command and its arguments
+    :param cache: return the cached result of an earlier call if available
+        (see :py:mod:`fai.cmdcache`)
+    :param watch: files in the target system whose change invalidates the
+        cached result
+    :param log: store the output in :any:`env.LOGDIR` (see
+        :py:mod:`fai.logstore`)
     :param kwargs: additional arguments for :any:`python:subprocess.run`
     :return: process result
     :raise subprocess.CalledProcessError: when command is ``check``\\ ed and
         exits with error
 
     The command in :any:`args <fai.subprocess.run.params.args>` is prefixed with :any:`env.ROOTCMD`.
+    If a :any:`Worker` is running for :any:`env.ROOTCMD`, the command is
+    sent to the worker instead.
 
     Behaves like :any:`run_installer` otherwise.
 
@@ -57,7 +132,509 @@ def run(args: Sequence[str], **kwargs) -> subprocess.CompletedProcess:
 
         r = run(['getent', 'group', 'audio'])
         audio_group_members = r.stdout.split(':')[3].split(',')
+
+    Example with cache::
+
+        r = run(['getent', 'group', 'audio'],
+                cache=True,
+                watch=[TargetPath('/etc/group')])
     """
-    if env.ROOTCMD:
-        args = env.ROOTCMD + args
+    rootcmd = env.current().ROOTCMD
+    if log:
+        from . import logstore  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        _set_defaults(kwargs)
+        return logstore.run(
+            list(rootcmd) + list(args), kwargs,
+            lambda kw: run(args, cache=cache, watch=watch, **kw))
+    if cache:
+        from . import cmdcache  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        # pylint: disable=import-outside-toplevel; fai.files imports this module
+        from .files import resolve_many
+        _set_defaults(kwargs)
+        return cmdcache.run(list(rootcmd) + list(args),
+                            kwargs,
+                            lambda kw: run(args, **kw),
+                            command=args,
+                            watch=resolve_many(watch))
+    worker = _workers.get(tuple(rootcmd))
+    if worker is not None and worker.supports(kwargs):
+        return worker.run(args, **kwargs)
+    if trace.is_enabled():
+        _set_defaults(kwargs)
+        return trace.run(list(rootcmd) + list(args),
+                         op='run',
+                         command=args,
+                         **kwargs)
+    if rootcmd:
+        args = list(rootcmd) + args
     return run_installer(args, **kwargs)
+
+
+_CHUNK_SIZE = 64 * 1024
+_log_counter = itertools.count(1)
+
+
+class Stream:
+    """ Output stream of a running command
+
+    Created by :any:`run_installer_stream` and :any:`run_stream`.
+
+    Iterating over the stream yields the output of the command while it is
+    running, either as lines (``str``) or as chunks (``bytes``). When the
+    output ends, the stream waits for the command to exit.
+
+    Use as context manager to make sure the command is killed when the
+    iteration is aborted early.
+    """
+
+    def __init__(self, proc: subprocess.Popen, *, binary: bool,
+                 log: Optional[pathlib.Path], tail: int, check: bool):
+        self.args: List[str] = proc.args
+        """command and its arguments"""
+        self.returncode: Optional[int] = None
+        """exit code of the command (after iteration)"""
+        self.log = log
+        """file the output is copied to (if any)"""
+        self._proc = proc
+        self._binary = binary
+        self._tail = collections.deque(maxlen=tail)
+        self._check = check
+        self._done = False
+
+    def __iter__(self) -> Iterator[Union[str, bytes]]:
+        if self._binary:
+            chunks = iter(lambda: self._proc.stdout.read1(_CHUNK_SIZE), b'')
+        else:
+            chunks = iter(self._proc.stdout)
+        log = None
+        if self.log is not None:
+            log = open(  # pylint: disable=consider-using-with; closed in finally
+                self.log,
+                'ab' if self._binary else 'a',
+                encoding=None if self._binary else 'utf-8',
+                errors=None if self._binary else 'surrogateescape')
+        try:
+            for chunk in chunks:
+                self._tail.append(chunk)
+                if log is not None:
+                    log.write(chunk)
+                yield chunk
+            self._done = True
+        finally:
+            if log is not None:
+                log.close()
+            self.close()
+        if self._check and self.returncode:
+            raise subprocess.CalledProcessError(self.returncode, self.args,
+                                                self.tail)
+
+    @property
+    def tail(self) -> Union[str, bytes]:
+        """the last output of the command"""
+        return (b'' if self._binary else '').join(self._tail)
+
+    def close(self):
+        """Wait for the command to exit, kill it if the output was not read"""
+        if not self._done and self._proc.poll() is None:
+            self._proc.kill()
+        self._proc.stdout.close()
+        self.returncode = self._proc.wait()
+
+    def __enter__(self) -> 'Stream':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def run_installer_stream(args: Sequence[str],
+                         *,
+                         binary: bool = False,
+                         tee: Union[bool, str] = False,
+                         tail: int = 100,
+                         check: bool = True,
+                         **kwargs) -> Stream:
+    """ Run command in installer system and stream its output
+
+    :param args: command and its arguments
+    :param binary: stream ``bytes`` chunks instead of ``str`` lines
+    :param tee: copy output to a file in :any:`env.LOGDIR`: a file name or
+        :any:`True` for a name derived from the command
+    :param tail: number of last lines/chunks kept for error reporting
+    :param check: raise after the iteration if the command exits with error
+    :param kwargs: additional arguments for :any:`python:subprocess.Popen`
+    :return: iterable output stream
+    :raise subprocess.CalledProcessError: when command is ``check``\\ ed and
+        exits with error; its ``output`` is the
+        :any:`tail <run_installer_stream.params.tail>` of the output
+    :raise ValueError: if :any:`tee <run_installer_stream.params.tee>` is
+        given and :any:`env.LOGDIR` is not set
+
+    In contrast to :any:`run_installer`, the output is never held in memory
+    as a whole. Use ``stderr=subprocess.STDOUT`` to include errors in the
+    stream.
+
+    Example::
+
+        for line in run_installer_stream(['apt-get', 'update'], tee=True):
+            progress(line)
+    """
+    log = None
+    if tee:
+        logdir = env.current().LOGDIR
+        if logdir is None:
+            raise ValueError('cannot tee command output without LOGDIR')
+        log = logdir / (_log_name(args) if tee is True else tee)
+    kwargs['stdout'] = subprocess.PIPE
+    kwargs.setdefault('universal_newlines', not binary)
+    proc = subprocess.Popen(args, **kwargs)  # pylint: disable=consider-using-with; closed by Stream
+    return Stream(proc, binary=binary, log=log, tail=tail, check=check)
+
+
+def run_stream(args: Sequence[str], **kwargs) -> Stream:
+    """ Run command in target system and stream its output
+
+    :param args: command and its arguments
+    :param kwargs: additional arguments like for :any:`run_installer_stream`
+    :return: iterable output stream
+
+    The command in :any:`args <fai.subprocess.run_stream.params.args>` is
+    prefixed with :any:`env.ROOTCMD`.
+
+    Behaves like :any:`run_installer_stream` otherwise.
+    """
+    if kwargs.get('tee') is True:
+        kwargs['tee'] = _log_name(args)
+    rootcmd = env.current().ROOTCMD
+    if rootcmd:
+        args = list(rootcmd) + list(args)
+    return run_installer_stream(args, **kwargs)
+
+
+def _log_name(args: Sequence[str]) -> str:
+    """Derive a unique log file name from a command"""
+    return (f'{os.path.basename(args[0])}.{os.getpid()}.'
+            f'{next(_log_counter)}.log')
+
+
+async def run_installer_async(args: Sequence[str],
+                              **kwargs) -> subprocess.CompletedProcess:
+    """ Run command in installer system as coroutine
+
+    :param args: command and its arguments
+    :param kwargs: additional arguments for
+        :any:`python:asyncio.create_subprocess_exec` and ``check``,
+        ``input``, ``timeout``, ``universal_newlines``/``text``,
+        ``encoding``, and ``errors`` like for :any:`python:subprocess.run`
+    :return: process result
+    :raise subprocess.CalledProcessError: when command is ``check``\\ ed and
+        exits with error
+    :raise subprocess.TimeoutExpired: when ``timeout`` expired
+
+    Same defaults as :any:`run_installer`.
+    """
+    _set_defaults(kwargs)
+    check = kwargs.pop('check')
+    text = any([
+        kwargs.pop('universal_newlines'),
+        kwargs.pop('text', False),
+        kwargs.get('encoding'),
+        kwargs.get('errors'),
+    ])
+    encoding = kwargs.pop('encoding',
+                          None) or locale.getpreferredencoding(False)
+    errors = kwargs.pop('errors', None) or 'strict'
+    timeout = kwargs.pop('timeout', None)
+    stdin = kwargs.pop('input', None)
+    if stdin is not None:
+        kwargs['stdin'] = subprocess.PIPE
+        if text:
+            stdin = stdin.encode(encoding, errors)
+
+    import asyncio  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+    args = list(args)
+    proc = await asyncio.create_subprocess_exec(*args, **kwargs)
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(stdin),
+                                                timeout)
+    except asyncio.TimeoutError:
+        proc.kill()
+        await proc.wait()
+        raise subprocess.TimeoutExpired(args, timeout) from None
+    except BaseException:
+        proc.kill()
+        await proc.wait()
+        raise
+
+    def decode(data: Optional[bytes]):
+        if data is None or not text:
+            return data
+        data = data.decode(encoding, errors)
+        return data.replace('\r\n', '\n').replace('\r', '\n')
+
+    result = subprocess.CompletedProcess(args, proc.returncode, decode(stdout),
+                                         decode(stderr))
+    if check:
+        result.check_returncode()
+    return result
+
+
+async def run_async(args: Sequence[str],
+                    **kwargs) -> subprocess.CompletedProcess:
+    """ Run command in target system as coroutine
+
+    :param args: command and its arguments
+    :param kwargs: additional arguments like for :any:`run_installer_async`
+    :return: process result
+    :raise subprocess.CalledProcessError: when command is ``check``\\ ed and
+        exits with error
+
+    The command in :any:`args <fai.subprocess.run_async.params.args>` is
+    prefixed with :any:`env.ROOTCMD`.
+
+    Behaves like :any:`run_installer_async` otherwise.
+    """
+    rootcmd = env.current().ROOTCMD
+    if rootcmd:
+        args = list(rootcmd) + list(args)
+    return await run_installer_async(args, **kwargs)
+
+
+class GatherError(Exception):
+    """ One or more awaitables passed to :any:`gather` failed
+
+    :param results: results of all awaitables in order; failed ones are
+        represented by their exception
+    """
+
+    def __init__(self, results: List[Any]):
+        self.results = results
+        self.errors: List[BaseException] = [
+            r for r in results if isinstance(r, BaseException)
+        ]
+        super().__init__(
+            f'{len(self.errors)} of {len(results)} tasks failed: ' +
+            '; '.join(str(e) for e in self.errors))
+
+
+async def gather(*aws: Awaitable, limit: Optional[int] = None) -> List[Any]:
+    """ Await multiple awaitables with bounded concurrency
+
+    :param aws: awaitables (e.g., :any:`run_async` coroutines)
+    :param limit: maximum number of awaitables awaited concurrently (default:
+        unbounded)
+    :return: results in the order of :any:`aws <fai.subprocess.gather.params.aws>`
+    :raise GatherError: if any awaitable failed, after all have finished
+
+    Coroutines are only started when a slot is free, so ``limit`` also bounds
+    the number of concurrently running processes.
+    """
+    import asyncio  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+    semaphore = asyncio.Semaphore(limit) if limit else None
+
+    async def bounded(aw: Awaitable):
+        if semaphore is None:
+            return await aw
+        async with semaphore:
+            return await aw
+
+    results = await asyncio.gather(*(bounded(aw) for aw in aws),
+                                   return_exceptions=True)
+    if any(isinstance(r, BaseException) for r in results):
+        raise GatherError(results)
+    return results
+
+
+_workers: Dict[Tuple[str, ...], 'Worker'] = {}
+
+_WORKER_KWARGS = frozenset([
+    'check',
+    'universal_newlines',
+    'text',
+    'encoding',
+    'errors',
+    'stdout',
+    'stderr',
+    'input',
+    'env',
+    'timeout',
+])
+
+_WORKER_STREAMS = {
+    subprocess.PIPE: 'pipe',
+    subprocess.DEVNULL: 'devnull',
+    subprocess.STDOUT: 'stdout',
+    None: 'inherit',
+}
+
+
+class Worker:
+    """ Persistent command worker in the target system
+
+    :param rootcmd: chroot command to start the worker with (default:
+        :any:`env.ROOTCMD`)
+    :param python: Python interpreter in the target system
+
+    The worker is a small Python program started once via ``rootcmd``. It
+    receives commands over a pipe, runs them, and sends back their exit code
+    and output. This saves the cost of a new chroot for every command.
+
+    While used as context manager, :any:`run` sends all commands for
+    ``rootcmd`` to the worker and returns the same results and raises the
+    same exceptions as without worker. Commands needing unsupported arguments
+    (e.g., ``cwd``, custom file objects for ``stdout``) silently bypass the
+    worker. The ``stdin`` of commands run by the worker is ``/dev/null``
+    unless ``input`` is given.
+
+    Example::
+
+        with Worker():
+            for unit in units:
+                run(['systemctl', 'enable', unit])
+    """
+
+    def __init__(self,
+                 rootcmd: Optional[Sequence[str]] = None,
+                 python: str = 'python3'):
+        if rootcmd is None:
+            rootcmd = env.current().ROOTCMD
+        self.rootcmd = list(rootcmd)
+        self.python = python
+        self._proc: Optional[subprocess.Popen] = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the worker process"""
+        if self._proc is not None:
+            return
+        source = pathlib.Path(__file__).with_name('_worker.py').read_text(
+            encoding='utf-8')
+        self._proc = subprocess.Popen(  # pylint: disable=consider-using-with; closed in close()
+            self.rootcmd + [self.python, '-c', source],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+        )
+
+    def close(self):
+        """Stop the worker process"""
+        if self._proc is None:
+            return
+        self._proc.stdin.close()
+        self._proc.wait()
+        self._proc.stdout.close()
+        self._proc = None
+
+    def __enter__(self) -> 'Worker':
+        self.start()
+        _workers[tuple(self.rootcmd)] = self
+        return self
+
+    def __exit__(self, *exc_info):
+        if _workers.get(tuple(self.rootcmd)) is self:
+            del _workers[tuple(self.rootcmd)]
+        self.close()
+
+    @staticmethod
+    def supports(kwargs: dict) -> bool:
+        """Check if a command with these arguments can be run by the worker
+
+        :param kwargs: arguments as passed to :any:`run`
+        """
+        if not _WORKER_KWARGS.issuperset(kwargs):
+            return False
+        return (kwargs.get('stdout', subprocess.PIPE) in _WORKER_STREAMS
+                and kwargs.get('stdout') != subprocess.STDOUT
+                and kwargs.get('stderr') in _WORKER_STREAMS)
+
+    def run(self, args: Sequence[str],
+            **kwargs) -> subprocess.CompletedProcess:
+        """Run command in the worker
+
+        :param args: command and its arguments
+        :param kwargs: additional arguments like for :any:`run`
+        :return: process result
+        :raise subprocess.CalledProcessError: when command is ``check``\\ ed
+            and exits with error
+        :raise subprocess.TimeoutExpired: when ``timeout`` expired
+        """
+        import base64  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+        _set_defaults(kwargs)
+        full_args = self.rootcmd + list(args)
+        text = bool(
+            kwargs.get('universal_newlines') or kwargs.get('text')
+            or kwargs.get('encoding') or kwargs.get('errors'))
+        encoding = kwargs.get('encoding') or locale.getpreferredencoding(False)
+        errors = kwargs.get('errors') or 'strict'
+        stdin = kwargs.get('input')
+        if stdin is not None and text:
+            stdin = stdin.encode(encoding, errors)
+        stdout = kwargs['stdout']
+        request = {
+            'args': [str(a) for a in args],
+            'input': _b64encode(stdin),
+            # the worker captures "inherited" stdout as its own is the pipe
+            'stdout': 'pipe' if stdout is None else _WORKER_STREAMS[stdout],
+            'stderr': _WORKER_STREAMS[kwargs.get('stderr')],
+            'env': kwargs.get('env'),
+            'timeout': kwargs.get('timeout'),
+        }
+        start = time.perf_counter()
+        response = self._request(request)
+        if trace.is_enabled():
+            trace.record('worker',
+                         argv=full_args,
+                         command=os.path.basename(str(args[0])),
+                         wall=time.perf_counter() - start,
+                         returncode=response.get('returncode'))
+
+        def decode(data: Optional[str]):
+            if data is None:
+                return None
+            data = base64.b64decode(data)
+            if not text:
+                return data
+            data = data.decode(encoding, errors)
+            return data.replace('\r\n', '\n').replace('\r', '\n')
+
+        output = decode(response['stdout'])
+        stderr = decode(response['stderr'])
+        if stdout is None:
+            if output:
+                sys.stdout.buffer.write(base64.b64decode(response['stdout']))
+                sys.stdout.buffer.flush()
+            output = None
+        if response.get('timeout'):
+            raise subprocess.TimeoutExpired(full_args, kwargs['timeout'],
+                                            output, stderr)
+        result = subprocess.CompletedProcess(full_args, response['returncode'],
+                                             output, stderr)
+        if kwargs['check']:
+            result.check_returncode()
+        return result
+
+    def _request(self, request: dict) -> dict:
+        import json  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+        with self._lock:
+            if self._proc is None:
+                raise RuntimeError('worker not started')
+            try:
+                self._proc.stdin.write(json.dumps(request).encode() + b'\n')
+                self._proc.stdin.flush()
+                line = self._proc.stdout.readline()
+            except BrokenPipeError:
+                line = b''
+        if not line:
+            raise RuntimeError(
+                f'worker {self.rootcmd + [self.python]} exited unexpectedly')
+        return json.loads(line.decode())
+
+
+def _b64encode(data: Optional[bytes]) -> Optional[str]:
+    if data is None:
+        return None
+    import base64  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    return base64.b64encode(data).decode('ascii')
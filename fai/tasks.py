@@ -0,0 +1,291 @@
+""" Task Runner
+    ===========
+
+    Run independent customization steps of one script in parallel. Tasks are
+    functions registered with the :any:`task` decorator, which names the
+    FAI classes a task applies to and the tasks it depends on::
+
+        from fai import tasks
+
+        @tasks.task(classes=['DEFAULT'])
+        def network():
+            ...
+
+        @tasks.task(classes=['WEBSERVER'], requires=['network'])
+        def nginx():
+            ...
+
+        @tasks.task()
+        def users():
+            ...
+
+        if __name__ == '__main__':
+            tasks.run(workers=4)
+
+    :any:`run` executes the tasks on a thread pool as soon as their
+    dependencies are done, so the wall time approaches the longest chain of
+    dependencies instead of the sum of all tasks. After the first failure,
+    no further tasks are started. A timing report of all tasks is written to
+    :any:`env.LOGDIR`, one file per run (see :any:`REPORT_FILE`).
+"""
+from __future__ import annotations
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+import functools
+import itertools
+import json
+import os
+import sys
+import time
+
+from . import env
+
+REPORT_FILE = 'pyfai-tasks.{script}.{pid}.{run}.json'
+"""Name of the timing report in :any:`env.LOGDIR`
+
+``{script}`` is replaced by the name of the running script, ``{pid}`` by
+the process ID, and ``{run}`` by the number of the run within the process,
+so the reports of all scripts and runs are kept.
+"""
+
+_runs = itertools.count(1)
+
+
+class Task(NamedTuple):
+    """Registered task"""
+    name: str
+    func: Callable[[], None]
+    classes: tuple
+    """classes of which one must be defined for the task to run (if any)"""
+    requires: tuple
+    """names of tasks that must be done before"""
+
+
+class Result(NamedTuple):
+    """Outcome of a task"""
+    name: str
+    status: str
+    """``ok``, ``failed``, ``skipped`` (no class applies), or ``cancelled``
+    (not started after a failure)"""
+    start: Optional[float] = None
+    """start time in seconds since the start of :any:`run`"""
+    duration: Optional[float] = None
+    """wall time in seconds"""
+    error: Optional[BaseException] = None
+
+
+class TaskError(Exception):
+    """ One or more tasks failed
+
+    :param results: results of all tasks by name
+    """
+
+    def __init__(self, results: Dict[str, Result]):
+        self.results = results
+        self.errors: Dict[str, BaseException] = {
+            r.name: r.error
+            for r in results.values() if r.error is not None
+        }
+        super().__init__(
+            f'{len(self.errors)} of {len(results)} tasks failed: ' +
+            '; '.join(f'{n}: {e}' for n, e in self.errors.items()))
+
+
+class Registry:
+    """ Set of tasks
+
+    The module functions :any:`task` and :any:`run` use a default registry.
+    """
+
+    def __init__(self):
+        self.tasks: Dict[str, Task] = {}
+
+    def task(
+        self,
+        *,
+        name: Optional[str] = None,
+        classes: Iterable[str] = (),
+        requires: Iterable[str] = ()
+    ) -> Callable:
+        """Decorator to register a task
+
+        :param name: task name (default: name of the function)
+        :param classes: classes of which one must be defined for the task to
+            run (default: always run)
+        :param requires: names of tasks that must be done before; tasks
+            skipped for their classes count as done
+        :raise ValueError: if a task of the name is already registered
+        """
+
+        def decorator(func: Callable[[], None]) -> Callable[[], None]:
+            task_name = name if name is not None else func.__name__
+            if task_name in self.tasks:
+                raise ValueError(f'task {task_name} already registered')
+            self.tasks[task_name] = Task(task_name, func, tuple(classes),
+                                         tuple(requires))
+            return func
+
+        return decorator
+
+    def _check(self) -> List[str]:
+        """Validate the dependencies
+
+        :return: task names in a topological order
+        :raise ValueError: on unknown or cyclic dependencies
+        """
+        order: List[str] = []
+        state: Dict[str, bool] = {}  # False: visiting, True: done
+
+        def visit(name: str, path: tuple):
+            if state.get(name) is True:
+                return
+            if name in state:
+                raise ValueError('cyclic task dependency: ' +
+                                 ' -> '.join(path + (name, )))
+            state[name] = False
+            for dep in self.tasks[name].requires:
+                if dep not in self.tasks:
+                    raise ValueError(
+                        f'task {name} requires unknown task {dep}')
+                visit(dep, path + (name, ))
+            state[name] = True
+            order.append(name)
+
+        for name in self.tasks:
+            visit(name, ())
+        return order
+
+    def run(self,
+            *,
+            workers: Optional[int] = None,
+            report: Optional[str] = REPORT_FILE) -> Dict[str, Result]:
+        """Run all tasks
+
+        :param workers: maximum number of tasks run in parallel (default:
+            like :any:`concurrent.futures.ThreadPoolExecutor`)
+        :param report: name of the timing report in :any:`env.LOGDIR`
+            (with the fields of :any:`REPORT_FILE`) or :any:`None` for no
+            report
+        :return: results by task name
+        :raise ValueError: on unknown or cyclic dependencies (before any task
+            is run)
+        :raise TaskError: if any task failed, after all running tasks have
+            finished
+
+        Tasks run in the current :any:`FaiContext <fai.env.FaiContext>`.
+        """
+        import concurrent.futures  # pylint: disable=import-outside-toplevel; deferred for faster startup
+        order = self._check()
+        ctx = env.current()
+        results: Dict[str, Result] = {}
+        waiting = {}
+        for name in order:
+            registered = self.tasks[name]
+            if registered.classes and not any(c in ctx.classes
+                                              for c in registered.classes):
+                results[name] = Result(name, 'skipped')
+            else:
+                waiting[name] = set(registered.requires)
+        dependents: Dict[str, List[str]] = {}
+        for name, deps in waiting.items():
+            for dep in list(deps):
+                if dep in results:
+                    deps.discard(dep)  # skipped
+                else:
+                    dependents.setdefault(dep, []).append(name)
+
+        origin = time.perf_counter()
+
+        def timed(job: Task) -> Result:
+            start = time.perf_counter()
+            try:
+                job.func()
+                error = None
+            except Exception as e:  # pylint: disable=broad-except; reported in TaskError
+                error = e
+            return Result(job.name, 'ok' if error is None else 'failed',
+                          start - origin,
+                          time.perf_counter() - start, error)
+
+        failed = False
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            running = set()
+
+            def submit_ready():
+                for name in [n for n, deps in waiting.items() if not deps]:
+                    del waiting[name]
+                    running.add(
+                        pool.submit(functools.partial(ctx.run, timed),
+                                    self.tasks[name]))
+
+            submit_ready()
+            while running:
+                done, running = concurrent.futures.wait(
+                    running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    result = future.result()
+                    results[result.name] = result
+                    if result.error is not None:
+                        failed = True
+                    for name in dependents.get(result.name, ()):
+                        waiting[name].discard(result.name)
+                if not failed:
+                    submit_ready()
+        for name in waiting:
+            results[name] = Result(name, 'cancelled')
+        results = {name: results[name] for name in order}
+
+        if report is not None and ctx.LOGDIR is not None:
+            script = os.path.basename(sys.argv[0]) if sys.argv else ''
+            name = report.format(script=script or 'python',
+                                 pid=os.getpid(),
+                                 run=next(_runs))
+            _write_report(ctx.LOGDIR / name, results,
+                          time.perf_counter() - origin)
+        if failed:
+            raise TaskError(results)
+        return results
+
+
+def _write_report(path, results: Dict[str, Result], wall: float):
+    data = {
+        'wall':
+        wall,
+        'tasks': [{
+            'name': r.name,
+            'status': r.status,
+            'start': r.start,
+            'duration': r.duration,
+            'error': repr(r.error) if r.error is not None else None,
+        } for r in sorted(results.values(),
+                          key=lambda r: (r.start is None, r.start or 0))],
+    }
+    tmp = path.with_name(f'.{path.name}.{os.getpid()}')
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+_registry = Registry()
+
+
+def task(
+    *,
+    name: Optional[str] = None,
+    classes: Iterable[str] = (),
+    requires: Iterable[str] = ()
+) -> Callable:
+    """Decorator to register a task in the default registry
+
+    See :any:`Registry.task`.
+    """
+    return _registry.task(name=name, classes=classes, requires=requires)
+
+
+def run(*,
+        workers: Optional[int] = None,
+        report: Optional[str] = REPORT_FILE) -> Dict[str, Result]:
+    """Run all tasks of the default registry
+
+    See :any:`Registry.run`.
+    """
+    return _registry.run(workers=workers, report=report)
@@ -0,0 +1,368 @@
+""" Tracing
+    =======
+
+    This module provides opt-in instrumentation of pyfai's hot paths to find
+    out where a customization script spends its time.
+
+    While tracing is enabled, every call of :any:`fai.subprocess.run`,
+    :any:`fai.subprocess.run_installer`, :any:`fai.files.resolve`,
+    :any:`fai.files.chmod`, :any:`fai.files.mkdir`, and
+    :any:`fai.files.fcopy` is recorded as one JSON line in a trace file
+    (default: :any:`TRACE_FILE` in :any:`env.LOGDIR`). Each record contains
+    the wall time, the CPU time of child processes and, for commands, the
+    maximum resident set size of the command.
+
+    Tracing is enabled with :any:`enable` or, without changing any script, by
+    setting ``$PYFAI_TRACE`` to a non-empty value. All scripts of a FAI run
+    append to the same trace file, which can be summarized with::
+
+        python3 -m fai.trace [TRACE_FILE ...]
+"""
+from __future__ import annotations
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Sequence)
+import collections
+import functools
+import os
+import pathlib
+import signal
+import subprocess
+import threading
+import time
+
+from . import env
+
+TRACE_FILE = 'pyfai-trace.jsonl'
+"""Name of the default trace file in :any:`env.LOGDIR`"""
+
+_FD: Optional[int] = None
+"""file descriptor of the trace file while tracing is enabled"""
+_lock = threading.Lock()
+
+
+def enable(path: Optional[pathlib.Path] = None):
+    """Enable tracing
+
+    :param path: trace file to append to (default: :any:`TRACE_FILE` in
+        :any:`env.LOGDIR`)
+    :raise ValueError: if no path is given and :any:`env.LOGDIR` is not set
+    """
+    global _FD  # pylint: disable=global-statement; module-level trace state
+    if path is None:
+        logdir = env.current().LOGDIR
+        if logdir is None:
+            raise ValueError('no trace file given and $LOGDIR not set')
+        path = logdir / TRACE_FILE
+    fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,
+                 0o644)
+    with _lock:
+        if _FD is not None:
+            os.close(_FD)
+        _FD = fd
+
+
+def disable():
+    """Disable tracing"""
+    global _FD  # pylint: disable=global-statement; module-level trace state
+    with _lock:
+        if _FD is not None:
+            os.close(_FD)
+        _FD = None
+
+
+def is_enabled() -> bool:
+    """Check if tracing is enabled"""
+    return _FD is not None
+
+
+def record(op: str, **fields):
+    """Append a record to the trace file
+
+    :param op: name of the traced operation
+    :param fields: additional fields of the record
+    """
+    import json  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+    fields['op'] = op
+    fields.setdefault('time', time.time())
+    fields.setdefault('pid', os.getpid())
+    # one write per record: appends of concurrent processes do not interleave
+    line = json.dumps(fields, default=str).encode() + b'\n'
+    with _lock:
+        if _FD is not None:
+            os.write(_FD, line)
+
+
+def _children_cpu() -> float:
+    import resource  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+def traced(op: str) -> Callable:
+    """Decorator to trace a function operating on target paths
+
+    The first positional arguments are recorded as ``path``. The CPU time of
+    child processes is taken from :any:`resource.getrusage` and thus includes
+    children of concurrent threads.
+    """
+
+    def decorator(func: Callable) -> Callable:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _FD is None:
+                return func(*args, **kwargs)
+            error = None
+            cpu = _children_cpu()
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = repr(e)
+                raise
+            finally:
+                wall = time.perf_counter() - start
+                record(op,
+                       path=[str(a) for a in args],
+                       wall=wall,
+                       cpu=_children_cpu() - cpu,
+                       error=error)
+
+        return wrapper
+
+    return decorator
+
+
+def _exit_code(status: int) -> int:
+    """Convert a wait status like :any:`subprocess.Popen.returncode`"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def _wait4(pid: int, deadline: Optional[float]) -> Optional[tuple]:
+    """Reap a child process with :any:`os.wait4`
+
+    :param pid: process ID of the child
+    :param deadline: :any:`time.monotonic` time to give up at (default:
+        wait forever)
+    :return: result of :any:`os.wait4` or :any:`None` on timeout
+    """
+    if deadline is None:
+        return os.wait4(pid, 0)
+    delay = 0.0005
+    while True:
+        result = os.wait4(pid, os.WNOHANG)
+        if result[0] == pid:
+            return result
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return None
+        delay = min(delay * 2, remaining, 0.05)
+        time.sleep(delay)
+
+
+def _communicate(proc: subprocess.Popen, stdin, timeout: Optional[float]):
+    """Exchange data with a process and reap it
+
+    Like :any:`subprocess.Popen.communicate`, but the process is reaped with
+    :any:`os.wait4` to get its resource usage. ``proc.returncode`` is set,
+    so ``proc`` never waits for the process itself.
+
+    :return: ``stdout``, ``stderr``, and the resource usage
+    :raise subprocess.TimeoutExpired: if the process did not exit in time
+        (after killing it)
+    """
+    deadline = None if timeout is None else time.monotonic() + timeout
+    output: Dict[str, Any] = {'stdout': None, 'stderr': None}
+
+    def write(stream):
+        try:
+            if stdin is not None:
+                stream.write(stdin)
+            stream.close()
+        except BrokenPipeError:
+            pass  # the process does not read all its input
+
+    def read(name, stream):
+        output[name] = stream.read()
+
+    threads = []
+    if proc.stdin is not None:
+        threads.append(threading.Thread(target=write, args=(proc.stdin, )))
+    for name in ('stdout', 'stderr'):
+        if getattr(proc, name) is not None:
+            threads.append(
+                threading.Thread(target=read, args=(name, getattr(proc,
+                                                                  name))))
+    result = None
+    try:
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join(None if deadline is
+                        None else max(0.0, deadline - time.monotonic()))
+        if not any(thread.is_alive() for thread in threads):
+            result = _wait4(proc.pid, deadline)
+    finally:
+        timed_out = result is None
+        if timed_out:
+            # timed out or interrupted: do not leave the process behind
+            os.kill(proc.pid, signal.SIGKILL)
+            result = os.wait4(proc.pid, 0)
+        proc.returncode = _exit_code(result[1])
+    if timed_out:
+        raise subprocess.TimeoutExpired(proc.args, timeout)
+    return output['stdout'], output['stderr'], result[2]
+
+
+def run(args: Sequence[str],
+        *,
+        op: str,
+        command: Optional[Sequence[str]] = None,
+        **kwargs) -> subprocess.CompletedProcess:
+    """Trace a command
+
+    :param args: command and its arguments
+    :param op: name of the traced operation
+    :param command: command as passed by the caller (e.g., without
+        :any:`env.ROOTCMD`)
+    :param kwargs: arguments like for :any:`python:subprocess.run`
+    :return: process result
+    """
+    stdin = kwargs.pop('input', None)
+    if stdin is not None:
+        kwargs['stdin'] = subprocess.PIPE
+    timeout = kwargs.pop('timeout', None)
+    check = kwargs.pop('check', False)
+    fields: Dict[str, Any] = {
+        'argv': [str(a) for a in args],
+        'command': os.path.basename(str((command or args)[0])),
+    }
+    start = time.perf_counter()
+    rusage = None
+    try:
+        with subprocess.Popen(args, **kwargs) as proc:
+            stdout, stderr, rusage = _communicate(proc, stdin, timeout)
+            returncode = proc.returncode
+        fields['returncode'] = returncode
+    except Exception as e:
+        fields['error'] = repr(e)
+        raise
+    finally:
+        fields['wall'] = time.perf_counter() - start
+        if rusage is not None:
+            fields['cpu'] = rusage.ru_utime + rusage.ru_stime
+            fields['maxrss'] = rusage.ru_maxrss
+        record(op, **fields)
+    if check and returncode:
+        raise subprocess.CalledProcessError(returncode, proc.args, stdout,
+                                            stderr)
+    return subprocess.CompletedProcess(proc.args, returncode, stdout, stderr)
+
+
+def load(paths: Iterable[pathlib.Path]) -> Iterator[dict]:
+    """Read records from trace files
+
+    :param paths: trace files
+    :return: records; lines that cannot be parsed are skipped
+    """
+    import json  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def summary(records: Iterable[dict], top: int = 10) -> Dict[str, List[dict]]:
+    """Aggregate trace records
+
+    :param records: trace records (see :any:`load`)
+    :param top: number of entries per list
+    :return: lists of the ``top`` entries, sorted by total wall time:
+
+        * ``commands``: commands aggregated by command name
+        * ``operations``: file operations aggregated by operation
+        * ``slowest_commands``: single slowest commands
+        * ``slowest_paths``: single slowest file operations
+    """
+    groups: Dict[tuple, dict] = collections.defaultdict(lambda: {
+        'count': 0,
+        'wall': 0.0,
+        'cpu': 0.0,
+        'maxrss': 0,
+    })
+    commands = []
+    paths = []
+    for rec in records:
+        is_command = 'argv' in rec
+        key = ('commands', rec.get('command')) if is_command else \
+            ('operations', rec.get('op'))
+        group = groups[key]
+        group['count'] += 1
+        group['wall'] += rec.get('wall', 0.0)
+        group['cpu'] += rec.get('cpu', 0.0)
+        group['maxrss'] = max(group['maxrss'], rec.get('maxrss', 0))
+        (commands if is_command else paths).append(rec)
+
+    def by_wall(entries):
+        return sorted(entries, key=lambda e: e.get('wall', 0.0),
+                      reverse=True)[:top]
+
+    result = {'commands': [], 'operations': []}
+    for (kind, name), group in groups.items():
+        result[kind].append(dict(name=name, **group))
+    result['commands'] = by_wall(result['commands'])
+    result['operations'] = by_wall(result['operations'])
+    result['slowest_commands'] = by_wall(commands)
+    result['slowest_paths'] = by_wall(paths)
+    return result
+
+
+def main(argv: Optional[Sequence[str]] = None):
+    """Print a summary of trace files (``python3 -m fai.trace``)"""
+    import argparse  # pylint: disable=import-outside-toplevel; deferred for faster startup
+
+    parser = argparse.ArgumentParser(prog='python3 -m fai.trace',
+                                     description=main.__doc__)
+    parser.add_argument('files',
+                        nargs='*',
+                        type=pathlib.Path,
+                        help='trace files (default: $LOGDIR/' + TRACE_FILE +
+                        ')')
+    parser.add_argument('--top',
+                        type=int,
+                        default=10,
+                        help='number of entries per list')
+    args = parser.parse_args(argv)
+    files = args.files
+    if not files:
+        logdir = env.current().LOGDIR
+        if logdir is None:
+            parser.error('no trace file given and $LOGDIR not set')
+        files = [logdir / TRACE_FILE]
+    result = summary(load(files), top=args.top)
+
+    for kind in ('commands', 'operations'):
+        print(f'{kind} by total wall time:')
+        for e in result[kind]:
+            print(f'  {e["wall"]:9.3f}s {e["count"]:6d}x '
+                  f'cpu {e["cpu"]:8.3f}s rss {e["maxrss"]:8d}k  {e["name"]}')
+    print('slowest commands:')
+    for e in result['slowest_commands']:
+        print(f'  {e["wall"]:9.3f}s  {" ".join(e["argv"])}')
+    print('slowest paths:')
+    for e in result['slowest_paths']:
+        print(f'  {e["wall"]:9.3f}s  {e["op"]} {" ".join(e["path"])}')
+
+
+if os.environ.get('PYFAI_TRACE') and env.LOGDIR is not None:
+    enable()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,192 @@
+""" Verifying Target Files
+    ======================
+
+    Check that files in the target system have the expected content, e.g.,
+    after an installation::
+
+        expected = verify.dpkg_md5sums()
+        expected.update(verify.manifest_digests())
+        for mismatch in verify.verify(expected, max_bytes_per_second=200e6):
+            print(f'{mismatch.path} differs', file=sys.stderr)
+
+    Files are hashed on a thread pool (:py:mod:`hashlib` releases the GIL
+    while hashing large buffers) with large sequential reads, so that
+    verification is bound by the disk instead of a single core, and no
+    ``debsums`` process is forked in the target.
+"""
+from __future__ import annotations
+from typing import (Dict, Iterable, Iterator, Mapping, NamedTuple, Optional,
+                    Tuple, Union)
+import hashlib
+import os
+import threading
+import time
+
+from . import env, files, manifest
+
+DPKG_INFO_DIR = files.TargetPath('/var/lib/dpkg/info')
+"""Directory of dpkg's package metadata in the target system"""
+
+_BLOCK_SIZE = 1 << 20
+
+_ALGORITHMS = {32: 'md5', 40: 'sha1', 64: 'sha256', 128: 'sha512'}
+
+
+class Mismatch(NamedTuple):
+    """File without the expected content"""
+    path: files.TargetPath
+    expected: str
+    """expected hex digest"""
+    actual: Optional[str]
+    """actual hex digest or :any:`None` if the file cannot be read"""
+    error: Optional[OSError] = None
+    """error reading the file"""
+
+
+class _Throttle:
+    """Limit the combined read rate of several threads"""
+
+    def __init__(self, bytes_per_second: float):
+        self.bytes_per_second = bytes_per_second
+        self._lock = threading.Lock()
+        self._next = time.monotonic()
+
+    def consume(self, size: int):
+        """Account for read bytes and wait until reading more is allowed"""
+        with self._lock:
+            now = time.monotonic()
+            self._next = max(self._next, now) + size / self.bytes_per_second
+            delay = self._next - now
+        if delay > 0:
+            time.sleep(delay)
+
+
+def _algorithm(digest: str) -> str:
+    try:
+        return _ALGORITHMS[len(digest)]
+    except KeyError:
+        raise ValueError(f'unknown digest algorithm: {digest}') from None
+
+
+def _hash(path: files.InstallerPath, algorithm: str,
+          throttle: Optional[_Throttle]) -> str:
+    h = hashlib.new(algorithm)
+    buf = bytearray(_BLOCK_SIZE)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            h.update(view[:size])
+            if throttle is not None:
+                throttle.consume(size)
+    return h.hexdigest()
+
+
+def _check(path: files.TargetPath, installer_path: files.InstallerPath,
+           expected: str, throttle: Optional[_Throttle]) -> Optional[Mismatch]:
+    try:
+        actual = _hash(installer_path, _algorithm(expected), throttle)
+    except OSError as e:
+        return Mismatch(path, expected, None, e)
+    if actual != expected.lower():
+        return Mismatch(path, expected, actual)
+    return None
+
+
+def verify(expected: Union[Mapping[files.TargetPath, str],
+                           Iterable[Tuple[files.TargetPath, str]]],
+           *,
+           workers: Optional[int] = None,
+           max_bytes_per_second: Optional[float] = None) -> Iterator[Mismatch]:
+    """Compare files in the target system with expected digests
+
+    :param expected: hex digests by path in the target system; the hash
+        algorithm is derived from the length of the digest (MD5, SHA-1,
+        SHA-256, or SHA-512)
+    :param workers: number of files hashed in parallel (default: like
+        :any:`concurrent.futures.ThreadPoolExecutor` in Python 3.8+)
+    :param max_bytes_per_second: limit of the combined read rate (default:
+        unlimited)
+    :return: generator of mismatches in the order they are found
+    :raise ValueError: if a digest has an unknown length
+
+    Files are only read while the returned generator is consumed, and only
+    a few more files than ``workers`` are in flight at a time.
+    """
+    import concurrent.futures  # pylint: disable=import-outside-toplevel; deferred for faster startup
+    if isinstance(expected, Mapping):
+        expected = expected.items()
+    throttle = _Throttle(max_bytes_per_second) \
+        if max_bytes_per_second else None
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+    window = 4 * workers
+    ctx = env.current()
+    with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        pending = set()
+        for path, digest in expected:
+            _algorithm(digest)
+            installer_path = ctx.run(files.resolve, path)
+            pending.add(
+                pool.submit(_check, path, installer_path, digest, throttle))
+            if len(pending) >= window:
+                done, pending = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                yield from (f.result() for f in done if f.result() is not None)
+        for future in concurrent.futures.as_completed(pending):
+            if future.result() is not None:
+                yield future.result()
+
+
+def dpkg_md5sums(
+        packages: Optional[Iterable[str]] = None
+) -> Dict[files.TargetPath, str]:
+    """Read the MD5 sums of files installed by dpkg
+
+    :param packages: names of packages to include (default: all)
+    :return: MD5 hex digests by path in the target system
+
+    Conffiles are not listed in dpkg's ``*.md5sums`` files and thus not
+    included.
+    """
+    info_dir = files.resolve(DPKG_INFO_DIR)
+    if packages is None:
+        names = [n for n in os.listdir(info_dir) if n.endswith('.md5sums')]
+    else:
+        wanted = set(packages)
+        names = [
+            n for n in os.listdir(info_dir) if n.endswith('.md5sums')
+            and n[:-len('.md5sums')].split(':')[0] in wanted
+        ]
+    result = {}
+    for name in sorted(names):
+        with open(info_dir / name, 'rb') as f:
+            for line in f:
+                digest, _, path = line.rstrip(b'\n').partition(b'  ')
+                if path:
+                    result[files.TargetPath(
+                        '/' + path.decode('utf-8', 'surrogateescape'))] = \
+                        digest.decode('ascii')
+    return result
+
+
+def manifest_digests() -> Dict[files.TargetPath, str]:
+    """Get the SHA-256 digests of files recorded in the manifest
+
+    :return: hex digests of all files installed by
+        :any:`fai.files.install` by path in the target system (files
+        installed without being hashed are left out)
+
+    See :py:mod:`fai.manifest`.
+    """
+    target_manifest = manifest.for_target()
+    entries = ((path, target_manifest.lookup(path))
+               for path in target_manifest)
+    return {
+        files.TargetPath(path): entry.digest
+        for path, entry in entries if entry.digest is not None
+    }
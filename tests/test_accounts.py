@@ -0,0 +1,127 @@
+import pytest
+
+import os
+
+from fai import accounts, env
+
+
+@pytest.fixture
+def faienv_accounts(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'target', tmp_path)
+    etc = tmp_path / 'etc'
+    etc.mkdir()
+    (etc / 'passwd').write_text('root:x:0:0:root:/root:/bin/bash\n'
+                                'daemon:x:1:1::/usr/sbin:/usr/sbin/nologin\n'
+                                'admin:x:1000:1000::/home/admin:/bin/bash\n')
+    (etc / 'shadow').write_text('root:*:19000:0:99999:7:::\n'
+                                'daemon:*:19000:0:99999:7:::\n'
+                                'admin:!:19000:0:99999:7:::\n')
+    (etc / 'group').write_text('root:x:0:\n'
+                               'daemon:x:1:\n'
+                               'sudo:x:27:admin\n'
+                               'admin:x:1000:\n'
+                               'shadow:x:42:\n')
+    (etc / 'gshadow').write_text('root:*::\n'
+                                 'sudo:*::admin\n'
+                                 'admin:!::\n')
+    (etc / 'login.defs').write_text('# ranges\nSYS_UID_MAX   990\n')
+    os.chmod(etc / 'shadow', 0o640)
+    return etc
+
+
+def test_provision(faienv_accounts, mocker):
+    replace_spy = mocker.spy(os, 'replace')
+    changed = accounts.provision(
+        groups=[
+            accounts.Group('developers', members=('admin', )),
+            accounts.Group('sudo', gid=27),
+        ],
+        users=[
+            accounts.User('alice',
+                          groups=('developers', 'sudo'),
+                          password='$6$hash'),
+            accounts.User('prometheus', system=True),
+            accounts.User('admin', shell='/bin/zsh', groups=('sudo', )),
+        ],
+    )
+    assert [str(p) for p in changed
+            ] == ['/etc/passwd', '/etc/shadow', '/etc/group', '/etc/gshadow']
+    assert replace_spy.call_count == 4
+    etc = faienv_accounts
+    assert (etc / 'passwd').read_text().splitlines()[2:] == [
+        'admin:x:1000:1000::/home/admin:/bin/zsh',
+        'alice:x:1001:1002::/home/alice:/bin/sh',
+        'prometheus:x:990:990::/nonexistent:/usr/sbin/nologin',
+    ]
+    shadow = (etc / 'shadow').read_text().splitlines()
+    assert shadow[3].startswith('alice:$6$hash:')
+    assert shadow[4].startswith('prometheus:!:')
+    assert (etc / 'shadow').stat().st_mode & 0o7777 == 0o640
+    assert (etc / 'group').read_text().splitlines() == [
+        'root:x:0:',
+        'daemon:x:1:',
+        'sudo:x:27:admin,alice',
+        'admin:x:1000:',
+        'shadow:x:42:',
+        'developers:x:1001:alice,admin',
+        'alice:x:1002:',
+        'prometheus:x:990:',
+    ]
+    assert (etc / 'gshadow').read_text().splitlines() == [
+        'root:*::',
+        'sudo:*::admin,alice',
+        'admin:!::',
+        'developers:!::alice,admin',
+        'alice:!::',
+        'prometheus:!::',
+    ]
+
+    # provisioning again changes nothing
+    assert accounts.provision(users=[accounts.User('alice')]) == []
+
+
+def test_provision_conflicts(faienv_accounts):
+    passwd = (faienv_accounts / 'passwd').read_text()
+    with pytest.raises(ValueError):
+        accounts.provision(users=[accounts.User('bob', uid=1000)])
+    with pytest.raises(ValueError):
+        accounts.provision(users=[accounts.User('admin', uid=1001)])
+    with pytest.raises(ValueError):
+        accounts.provision(groups=[accounts.Group('sudo', gid=28)])
+    with pytest.raises(ValueError):
+        accounts.provision(users=[
+            accounts.User('bob'),
+            accounts.User('carol', groups=('missing', )),
+        ])
+    with pytest.raises(ValueError):
+        accounts.provision(
+            users=[accounts.User('bob')],
+            groups=[accounts.Group('developers', members=('bob', 'dave'))])
+    assert (faienv_accounts / 'passwd').read_text() == passwd
+
+
+def test_provision_missing_database(faienv_accounts):
+    (faienv_accounts / 'group').unlink()
+    with pytest.raises(FileNotFoundError):
+        accounts.provision(users=[accounts.User('bob')])
+    assert 'bob' not in (faienv_accounts / 'passwd').read_text()
+
+
+def test_provision_invalid_fields(faienv_accounts):
+    passwd = (faienv_accounts / 'passwd').read_text()
+    for user in (
+            accounts.User('eve', gecos='x:0:0:pwn\ntoor::0:0::/root:/bin/sh'),
+            accounts.User('eve', home='/home/eve\n'),
+            accounts.User('eve', shell='/bin/sh:'),
+            accounts.User('eve', password='x\nroot::19000'),
+            accounts.User('eve:x'),
+            accounts.User('Eve'),
+            accounts.User('-eve'),
+            accounts.User('eve', groups=('sudo\n', )),
+    ):
+        with pytest.raises(ValueError):
+            accounts.provision(users=[user])
+    with pytest.raises(ValueError):
+        accounts.provision(groups=[accounts.Group('a:b')])
+    assert (faienv_accounts / 'passwd').read_text() == passwd
+    assert not (faienv_accounts / '.pwd.lock').exists()
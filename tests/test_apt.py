@@ -0,0 +1,101 @@
+import pytest
+
+import subprocess
+
+from fai import apt, env
+
+STATUS = """\
+Package: nano
+Status: install ok installed
+Architecture: amd64
+Version: 7.2-1
+
+Package: vim
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 9.0-1
+
+Package: linux-image-amd64
+Status: hold ok installed
+Architecture: amd64
+Version: 6.1
+"""
+
+
+@pytest.fixture
+def faienv_apt(monkeypatch, tmp_path, mocker):
+    monkeypatch.setattr(env, 'target', tmp_path)
+    monkeypatch.setattr(env, 'LOGDIR', tmp_path)
+    status = tmp_path / 'var/lib/dpkg/status'
+    status.parent.mkdir(parents=True)
+    status.write_text(STATUS)
+    return (mocker.patch('fai.subprocess.run', autospec=True, spec_set=True),
+            mocker.patch('fai.subprocess.run_stream',
+                         autospec=True,
+                         spec_set=True))
+
+
+def test_transaction(faienv_apt, mocker):
+    run, run_stream = faienv_apt
+    with apt.Transaction() as t:
+        t.preseed('tzdata', 'tzdata/Areas', 'select', 'Europe')
+        t.preseed('tzdata', 'tzdata/Zones/Europe', 'select', 'Berlin')
+        t.preseed('tzdata', 'tzdata/Areas', 'select', 'Europe')
+        t.install('openssh-server', 'nano', 'chrony=4.3-2')
+        t.install('openssh-server')
+        t.remove('vim', 'nano-tiny', 'mc')
+        t.purge('mc', 'vim')
+        t.hold('nano', 'linux-image-amd64')
+        t.unhold('chrony')
+    assert run.call_args_list == [
+        mocker.call(['debconf-set-selections'],
+                    input=('tzdata tzdata/Areas select Europe\n'
+                           'tzdata tzdata/Zones/Europe select Berlin\n'),
+                    universal_newlines=True,
+                    check=True),
+        mocker.call(['apt-mark', 'hold', '--', 'nano'], check=True),
+    ]
+    args = run_stream.call_args[0][0]
+    assert args[:len(apt.APT_GET)] == list(apt.APT_GET)
+    assert args[len(apt.APT_GET):] == [
+        'install', '--', 'openssh-server', 'chrony=4.3-2', 'vim_'
+    ]
+    kwargs = run_stream.call_args[1]
+    assert kwargs['tee'] is True
+    assert kwargs['stderr'] == subprocess.STDOUT
+    assert kwargs['env']['DEBIAN_FRONTEND'] == 'noninteractive'
+
+
+def test_no_logdir(faienv_apt, monkeypatch):
+    run, run_stream = faienv_apt
+    monkeypatch.setattr(env, 'LOGDIR', None)
+    with apt.Transaction() as t:
+        t.install('openssh-server')
+    assert run_stream.call_args[1]['tee'] is False
+
+
+def test_nothing_to_do(faienv_apt):
+    run, run_stream = faienv_apt
+    t = apt.Transaction()
+    t.install('nano')
+    t.remove('vim')
+    t.hold('linux-image-amd64')
+    assert not t.commit()
+    run.assert_not_called()
+    run_stream.assert_not_called()
+
+
+def test_conflicts(faienv_apt):
+    t = apt.Transaction()
+    t.install('nano')
+    with pytest.raises(ValueError):
+        t.remove('nano')
+    t.install('vim=9.0-1')
+    with pytest.raises(ValueError):
+        t.install('vim=9.0-2')
+    t.hold('mc')
+    with pytest.raises(ValueError):
+        t.unhold('mc')
+    t.preseed('tzdata', 'tzdata/Areas', 'select', 'Europe')
+    with pytest.raises(ValueError):
+        t.preseed('tzdata', 'tzdata/Areas', 'select', 'Asia')
@@ -0,0 +1,79 @@
+import pytest
+
+from fai import config, env
+
+DEFAULT_VAR = """\
+# default settings
+export TIMEZONE=UTC
+KEYMAP='us'
+MAXPACKAGES=800 # comment
+if [ -n "$foo" ]; then
+    FOO=bar
+fi
+"""
+
+WEB_VAR = """\
+TIMEZONE="Europe/Berlin"
+"""
+
+DEFAULT_PACKAGES = """\
+PACKAGES install
+openssh-server
+chrony # time sync
+
+PACKAGES install-norec WEB DB
+nginx
+PACKAGES remove DB
+nano
+"""
+
+
+@pytest.fixture
+def faienv_config(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'CONFIG_SPACE', tmp_path)
+    monkeypatch.setattr(env, 'classes', ['DEFAULT', 'WEB', 'LAST'])
+    (tmp_path / 'class').mkdir()
+    (tmp_path / 'class/DEFAULT.var').write_text(DEFAULT_VAR)
+    (tmp_path / 'class/WEB.var').write_text(WEB_VAR)
+    (tmp_path / 'class/DB.var').write_text('TIMEZONE=Asia/Tokyo\n')
+    (tmp_path / 'package_config').mkdir()
+    (tmp_path / 'package_config/DEFAULT').write_text(DEFAULT_PACKAGES)
+    (tmp_path / 'package_config/LAST').write_text('PACKAGES install\nvim\n')
+    (tmp_path / 'package_config/LAST.asc').write_text('')
+    return tmp_path
+
+
+def test_class_files(faienv_config):
+    assert config.class_files('class', '.var') == [
+        faienv_config / 'class/DEFAULT.var',
+        faienv_config / 'class/WEB.var',
+    ]
+    assert config.class_files('missing') == []
+
+
+def test_variables(faienv_config):
+    assert config.variables() == {
+        'TIMEZONE': 'Europe/Berlin',
+        'KEYMAP': 'us',
+        'MAXPACKAGES': '800',
+        'FOO': 'bar',
+    }
+
+
+def test_package_config(faienv_config):
+    assert config.package_config() == [
+        config.PackageList('install', (), ('openssh-server', 'chrony')),
+        config.PackageList('install-norec', ('WEB', 'DB'), ('nginx', )),
+        config.PackageList('install', (), ('vim', )),
+    ]
+
+
+def test_load_cached(faienv_config, mocker):
+    parser = mocker.Mock(return_value={})
+    path = faienv_config / 'class/DEFAULT.var'
+    config.load(path, parser)
+    config.load(path, parser)
+    parser.assert_called_once_with(path)
+    path.write_text('CHANGED=1\n')
+    config.load(path, parser)
+    assert parser.call_count == 2
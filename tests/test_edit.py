@@ -0,0 +1,88 @@
+import pytest
+
+import os
+
+from fai import edit, env, files
+
+GRUB = """\
+# If you change this file, run 'update-grub' afterwards
+GRUB_DEFAULT=0
+GRUB_TIMEOUT=5
+GRUB_TIMEOUT_STYLE=menu
+GRUB_CMDLINE_LINUX_DEFAULT="quiet"
+GRUB_TIMEOUT=10
+#GRUB_GFXMODE=640x480
+# BEGIN PYFAI MANAGED BLOCK serial
+GRUB_TERMINAL=console
+# END PYFAI MANAGED BLOCK serial
+"""
+
+
+@pytest.fixture
+def faienv_grub(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'target', tmp_path)
+    path = tmp_path / 'etc/default/grub'
+    path.parent.mkdir(parents=True)
+    path.write_text(GRUB)
+    os.chmod(path, 0o600)
+    return path
+
+
+def test_edit(faienv_grub):
+    with edit.Editor(files.TargetPath('/etc/default/grub')) as e:
+        e.set('GRUB_TIMEOUT', '1')
+        e.set('GRUB_DISABLE_OS_PROBER', 'true')
+        e.set('GRUB_DEFAULT', None)
+        e.replace(r'"quiet"', '"quiet splash"')
+        e.ensure_line('GRUB_TERMINAL=serial')
+        e.ensure_line('#GRUB_GFXMODE=640x480', present=False)
+        e.block('serial', 'GRUB_SERIAL_COMMAND="serial --unit=0"')
+    assert faienv_grub.read_text() == """\
+# If you change this file, run 'update-grub' afterwards
+GRUB_TIMEOUT=1
+GRUB_TIMEOUT_STYLE=menu
+GRUB_CMDLINE_LINUX_DEFAULT="quiet splash"
+# BEGIN PYFAI MANAGED BLOCK serial
+GRUB_SERIAL_COMMAND="serial --unit=0"
+# END PYFAI MANAGED BLOCK serial
+GRUB_DISABLE_OS_PROBER=true
+GRUB_TERMINAL=serial
+"""
+    assert faienv_grub.stat().st_mode & 0o7777 == 0o600
+
+
+def test_edit_unchanged(faienv_grub, mocker):
+    replace_spy = mocker.spy(os, 'replace')
+    e = edit.Editor(files.TargetPath('/etc/default/grub'))
+    e.set('GRUB_DEFAULT', '0').ensure_line('GRUB_TIMEOUT_STYLE=menu')
+    e.block('serial', ['GRUB_TERMINAL=console'])
+    assert not e.apply()
+    replace_spy.assert_not_called()
+    assert sorted(os.listdir(faienv_grub.parent)) == ['grub']
+
+    # a removed duplicate is a change
+    assert e.set('GRUB_TIMEOUT', '5').apply()
+    assert faienv_grub.read_text().count('GRUB_TIMEOUT=') == 1
+
+
+def test_edit_missing(faienv_grub):
+    e = edit.Editor(files.TargetPath('/etc/sysctl.conf'))
+    with pytest.raises(FileNotFoundError):
+        e.set('vm.swappiness', '10', separator=' = ').apply()
+    e = edit.Editor(files.TargetPath('/etc/sysctl.conf'), create=True)
+    assert e.set('vm.swappiness', '10', separator=' = ').apply()
+    path = faienv_grub.parent.parent / 'sysctl.conf'
+    assert path.read_text() == 'vm.swappiness = 10\n'
+    assert not e.set('vm.swappiness', '10', separator=' = ').apply()
+
+
+def test_edit_unterminated_block(faienv_grub):
+    faienv_grub.write_text(
+        GRUB.replace('# END PYFAI MANAGED BLOCK serial\n', ''))
+    e = edit.Editor(files.TargetPath('/etc/default/grub'))
+    e.block('serial', 'GRUB_TERMINAL=serial')
+    with pytest.raises(ValueError):
+        e.apply()
+    assert faienv_grub.read_text() == GRUB.replace(
+        '# END PYFAI MANAGED BLOCK serial\n', '')
+    assert sorted(os.listdir(faienv_grub.parent)) == ['grub']
@@ -1,8 +1,9 @@
 import pytest
 
+import concurrent.futures
 import pathlib
 
-from fai import env
+from fai import env, files
 
 
 @pytest.fixture
@@ -62,3 +63,78 @@ def test_softupdate(faienv_softupdate):
     assert env.ACTION == env.Action.softupdate
     assert env.target == pathlib.Path('/')
     assert env.is_online() == True
+
+
+def test_context_from_environ(faienv_default):
+    ctx = env.FaiContext.from_environ()
+    assert ctx.classes == [
+        'DEFAULT', 'LINUX', 'DEBIAN', 'GRUB', 'host', 'LAST'
+    ]
+    assert ctx.CONFIG_SPACE == pathlib.Path('/var/lib/fai/config')
+    assert ctx.target == pathlib.Path('/target')
+    assert ctx.ROOTCMD == ['chroot', '/target']
+    assert ctx.ACTION == env.Action.install
+    assert ctx.LOGDIR == pathlib.Path('/var/log/fai')
+    assert ctx.is_online() == False
+
+
+def test_current_reflects_globals(monkeypatch):
+    monkeypatch.setattr(env, 'target', pathlib.Path('/target1'))
+    assert env.current().target == pathlib.Path('/target1')
+    assert env.current() is env.current()
+    monkeypatch.setattr(env, 'target', pathlib.Path('/'))
+    assert env.current().target == pathlib.Path('/')
+    assert env.is_online() == True
+
+
+def test_use_context(monkeypatch):
+    monkeypatch.setattr(env, 'target', pathlib.Path('/target1'))
+    ctx = env.FaiContext(target=pathlib.Path('/'))
+    with env.use(ctx):
+        assert env.current() is ctx
+        assert env.is_online() == True
+    assert env.current().target == pathlib.Path('/target1')
+    assert ctx.run(env.is_online) == True
+
+
+def test_contexts_in_threads():
+    targets = [pathlib.Path(f'/target{i}') for i in range(8)]
+    with concurrent.futures.ThreadPoolExecutor(4) as pool:
+        results = pool.map(
+            lambda t: env.FaiContext(target=t).run(
+                files.resolve, files.TargetPath('/etc/fstab')), targets)
+        assert list(results) == [t / 'etc/fstab' for t in targets]
+
+
+def test_class_set():
+    classes = env.ClassSet(['DEFAULT', 'LINUX', 'WEB', 'LINUX', 'LAST'])
+    assert classes == ['DEFAULT', 'LINUX', 'WEB', 'LINUX', 'LAST']
+    assert len(classes) == 5 and classes[-1] == 'LAST'
+    assert 'WEB' in classes and 'DB' not in classes
+    assert classes.rank('DEFAULT') == 0
+    assert classes.rank('LINUX') == 3
+    assert classes.rank('DB') is None
+    assert classes.select(['WEB', 'DB', 'DEFAULT']) == 'WEB'
+    assert classes.select(['LINUX', 'WEB']) == 'LINUX'
+    assert classes.select(['DB']) is None
+    assert classes.ordered(['LAST', 'DB', 'DEFAULT', 'LINUX',
+                            'WEB']) == ['DEFAULT', 'WEB', 'LINUX', 'LAST']
+
+
+def test_context_class_set():
+    ctx = env.FaiContext(classes=['DEFAULT', 'LAST'])
+    assert isinstance(ctx.classes, env.ClassSet)
+    assert ctx.classes.select(['DEFAULT', 'LAST']) == 'LAST'
+
+
+def test_context_replace():
+    ctx = env.FaiContext(target=pathlib.Path('/target1'), ROOTCMD=['chroot'])
+    other = ctx.replace(target=pathlib.Path('/target2'), classes=['LAST'])
+    assert other.target == pathlib.Path('/target2')
+    assert other.ROOTCMD == ['chroot'] and other.classes == ['LAST']
+    assert ctx.replace() == ctx
+    assert ctx.target == pathlib.Path('/target1')
+    with pytest.raises(AttributeError):
+        ctx.target = pathlib.Path('/')
+    with pytest.raises(TypeError):
+        ctx.replace(missing=None)
@@ -1,8 +1,10 @@
 import pytest
 
+import errno
+import os
 import pathlib
 
-from fai import files, env
+from fai import _fcopy, files, env
 
 
 @pytest.fixture
@@ -47,7 +49,12 @@ def subprocess_patch(mocker):
     return mocker.patch('fai.subprocess.run', autospec=True, spec_set=True)
 
 
-def test_chmod_defaults(resolve_patch, subprocess_patch):
+@pytest.fixture
+def faienv_no_ids(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'target', tmp_path)
+
+
+def test_chmod_defaults(faienv_no_ids, resolve_patch, subprocess_patch):
     p = files.TargetPath('/etc/fstab')
     files.chmod(p)
 
@@ -56,7 +63,7 @@ def test_chmod_defaults(resolve_patch, subprocess_patch):
     subprocess_patch.assert_called_once_with(['chown', 'root:root', str(p)])
 
 
-def test_chmod_overrides(resolve_patch, subprocess_patch):
+def test_chmod_overrides(faienv_no_ids, resolve_patch, subprocess_patch):
     p = files.TargetPath('/usr/local/bin/myscript')
     files.chmod(p, user='root', group='staff', mode=0o755)
 
@@ -65,6 +72,88 @@ def test_chmod_overrides(resolve_patch, subprocess_patch):
     subprocess_patch.assert_called_once_with(['chown', 'root:staff', str(p)])
 
 
+@pytest.fixture
+def faienv_ids(monkeypatch, tmp_path):
+    etc = tmp_path / 'etc'
+    etc.mkdir()
+    (etc / 'passwd').write_text('root:x:0:0:root:/root:/bin/bash\n'
+                                'admin:x:1000:1000::/home/admin:/bin/sh\n')
+    (etc / 'group').write_text('root:x:0:\n'
+                               'staff:x:50:admin\n')
+    monkeypatch.setattr(env, 'target', tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def chown_patch(mocker):
+    return mocker.patch('os.chown', autospec=True, spec_set=True)
+
+
+def test_chmod_local_ids(faienv_ids, resolve_patch, subprocess_patch,
+                         chown_patch):
+    p = files.TargetPath('/usr/local/bin/myscript')
+    files.chmod(p, user='admin', group='staff', mode=0o755)
+
+    resolve_patch.assert_called_once_with(p)
+    resolve_patch.return_value.chmod.assert_called_once_with(0o755)
+    chown_patch.assert_called_once_with(resolve_patch.return_value,
+                                        1000,
+                                        50,
+                                        follow_symlinks=False)
+    subprocess_patch.assert_not_called()
+
+
+def test_chmod_unknown_name(faienv_ids, resolve_patch, subprocess_patch,
+                            chown_patch):
+    p = files.TargetPath('/home/ldapuser')
+    files.chmod(p, user='ldapuser', group='staff', mode=0o700)
+
+    chown_patch.assert_not_called()
+    subprocess_patch.assert_called_once_with(
+        ['chown', 'ldapuser:staff', str(p)])
+
+
+def test_chmod_ids_reloaded(faienv_ids, resolve_patch, subprocess_patch,
+                            chown_patch):
+    p = files.TargetPath('/srv/data')
+    files.chmod(p, user='admin', group='staff')
+    chown_patch.assert_called_with(resolve_patch.return_value,
+                                   1000,
+                                   50,
+                                   follow_symlinks=False)
+
+    (faienv_ids / 'etc' /
+     'passwd').write_text('admin:x:1001:1001::/home/admin:/bin/sh\n')
+    files.chmod(p, user='admin', group='staff')
+    chown_patch.assert_called_with(resolve_patch.return_value,
+                                   1001,
+                                   50,
+                                   follow_symlinks=False)
+
+
+def test_chmod_symlink_in_target(faienv_ids, subprocess_patch, chown_patch,
+                                 tmp_path_factory):
+    outside = tmp_path_factory.mktemp('outside') / 'file'
+    outside.write_text('')
+    outside.chmod(0o600)
+    real = faienv_ids / 'etc/real'
+    real.write_text('')
+    (faienv_ids / 'etc/abs').symlink_to('/etc/real')
+    # points to the file outside when resolved in the installer system
+    (faienv_ids / 'etc/up').symlink_to(
+        os.path.relpath(outside, faienv_ids / 'etc'))
+
+    # absolute links are resolved within the target
+    files.chmod(files.TargetPath('/etc/abs'), user='admin', mode=0o640)
+    chown_patch.assert_called_once_with(real, 1000, 0, follow_symlinks=False)
+    assert real.stat().st_mode & 0o7777 == 0o640
+
+    # .. stops at the target root: the file outside is never changed
+    with pytest.raises(FileNotFoundError):
+        files.chmod(files.TargetPath('/etc/up'), mode=0o666)
+    assert outside.stat().st_mode & 0o7777 == 0o600
+
+
 @pytest.fixture
 def chmod_patch(mocker):
     return mocker.patch('fai.files.chmod', autospec=True, spec_set=True)
@@ -139,3 +228,467 @@ def test_fcopy_recursive(subprocess_inst_patch):
     assert args[-1:] == [str(p1)]
     assert set(args[1:-1]) == \
             {'-v', '-m', 'admin,staff,755', '-r'}
+
+
+@pytest.fixture
+def faienv_config(monkeypatch, mocker, tmp_path):
+    config = tmp_path / 'config'
+    for path, content in {
+            'etc/motd/DEFAULT': 'default\n',
+            'etc/motd/WEB': 'web\n',
+            'etc/apt/sources.list/DEFAULT': 'deb default\n',
+            'etc/apt/apt.conf.d/10local/WEB': 'APT::Local;\n',
+            'etc/apt/apt.conf.d/20other/LAST': 'APT::Other;\n',
+            'etc/hooked/DEFAULT': 'hooked\n',
+            'etc/hooked/postinst': '#!/bin/sh\n',
+    }.items():
+        (config / 'files' / path).parent.mkdir(parents=True, exist_ok=True)
+        (config / 'files' / path).write_text(content)
+    (tmp_path / 'target/etc').mkdir(parents=True)
+    (tmp_path / 'target/etc/passwd').write_text('root:x:0:0::/root:/bin/sh\n')
+    (tmp_path / 'target/etc/group').write_text('root:x:0:\n')
+    (tmp_path / 'log').mkdir()
+    mocker.patch('os.chown', autospec=True, spec_set=True)
+    mocker.patch('os.fchown', autospec=True, spec_set=True)
+    monkeypatch.setattr(env, 'CONFIG_SPACE', config)
+    monkeypatch.setattr(env, 'target', tmp_path / 'target')
+    monkeypatch.setattr(env, 'LOGDIR', tmp_path / 'log')
+    monkeypatch.setattr(env, 'classes', ['DEFAULT', 'WEB'])
+    return tmp_path
+
+
+def test_fcopy_native(faienv_config, subprocess_inst_patch):
+    p = files.TargetPath('/etc/motd')
+    assert files.fcopy(p, native=True) == {p: True}
+
+    dst = faienv_config / 'target/etc/motd'
+    assert dst.read_text() == 'web\n'
+    assert dst.stat().st_mode & 0o7777 == 0o644
+    assert os.fchown.call_args[0][1:] == (0, 0)
+    subprocess_inst_patch.assert_not_called()
+    assert (faienv_config / 'log' / 'pyfai-fcopy-index.json').exists()
+
+
+def test_fcopy_native_backup(faienv_config):
+    dst = faienv_config / 'target/etc/motd'
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    dst.write_text('old\n')
+    files.fcopy(files.TargetPath('/etc/motd'), native=True)
+    assert not dst.with_name('motd.pre_fcopy').exists()
+
+    dst.write_text('old\n')
+    files.fcopy(files.TargetPath('/etc/motd'),
+                native=True,
+                remove_backup=False)
+    assert dst.read_text() == 'web\n'
+    assert dst.with_name('motd.pre_fcopy').read_text() == 'old\n'
+
+
+def test_fcopy_native_unchanged(faienv_config):
+    p = files.TargetPath('/etc/motd')
+    dst = faienv_config / 'target/etc/motd'
+    dst.write_text('web\n')
+    dst.chmod(0o600)
+    inode = dst.stat().st_ino
+    assert files.fcopy(p, native=True) == {p: True}
+    assert dst.stat().st_ino == inode
+    assert dst.stat().st_mode & 0o7777 == 0o644
+
+    assert files.fcopy(p, native=True) == {p: False}
+    assert dst.stat().st_ino == inode
+
+
+def test_fcopy_native_orphan(faienv_config, monkeypatch):
+    monkeypatch.setattr(env, 'classes', ['LINUX'])
+    dst = faienv_config / 'target/etc/motd'
+    dst.parent.mkdir(parents=True, exist_ok=True)
+    dst.write_text('old\n')
+
+    p = files.TargetPath('/etc/motd')
+    assert files.fcopy(p, native=True, delete_orphan=False) == {p: False}
+    assert dst.exists()
+    assert files.fcopy(p, native=True) == {p: True}
+    assert not dst.exists()
+    with pytest.raises(FileNotFoundError):
+        files.fcopy(files.TargetPath('/etc/motd'),
+                    native=True,
+                    ignore_warnings=False)
+
+
+def test_fcopy_native_recursive(faienv_config, subprocess_inst_patch,
+                                monkeypatch):
+    monkeypatch.setattr(env, 'classes', ['DEFAULT', 'WEB', 'LAST'])
+    changed = files.fcopy(files.TargetPath('/etc'),
+                          native=True,
+                          recursively=True,
+                          mode=0o600)
+
+    target = faienv_config / 'target'
+    assert (target / 'etc/motd').read_text() == 'web\n'
+    assert (target / 'etc/apt/sources.list').read_text() == 'deb default\n'
+    assert (target / 'etc/apt/apt.conf.d/10local').exists()
+    assert (target / 'etc/apt/apt.conf.d/20other').exists()
+    assert (target / 'etc/motd').stat().st_mode & 0o7777 == 0o600
+    assert len(changed) == 5
+    assert all(changed.values())
+
+    # entries with postinst are left to fcopy(8)
+    subprocess_inst_patch.assert_called_once()
+    args = subprocess_inst_patch.call_args[0][0]
+    assert args[0] == 'fcopy'
+    assert args[-1:] == ['/etc/hooked']
+    assert '-r' not in args
+
+
+def test_fcopy_native_index_cache(faienv_config, mocker):
+    files.fcopy(files.TargetPath('/etc/motd'), native=True)
+    scan_spy = mocker.spy(_fcopy.Index, 'scan')
+    files.fcopy(files.TargetPath('/etc/motd'), native=True)
+    scan_spy.assert_not_called()
+
+    (faienv_config / 'config/files/etc/issue').mkdir()
+    (faienv_config / 'config/files/etc/issue/WEB').write_text('issue\n')
+    files.fcopy(files.TargetPath('/etc/issue'), native=True)
+    scan_spy.assert_called_once()
+    assert (faienv_config / 'target/etc/issue').read_text() == 'issue\n'
+
+
+@pytest.fixture
+def fchown_patch(mocker):
+    return mocker.patch('os.fchown', autospec=True, spec_set=True)
+
+
+@pytest.fixture
+def install_src(tmp_path):
+    src = tmp_path / 'src.bin'
+    src.write_bytes(b'\0' * 100000 + b'data')
+    return src
+
+
+def test_install(faienv_ids, install_src, fchown_patch, subprocess_patch):
+    p = files.TargetPath('/lib/firmware/blob.bin')
+    files.install(install_src, p, mode=0o600, user='admin', group='staff')
+
+    dst = faienv_ids / 'lib/firmware/blob.bin'
+    assert dst.read_bytes() == install_src.read_bytes()
+    assert dst.stat().st_mode & 0o7777 == 0o600
+    assert fchown_patch.call_args[0][1:] == (1000, 50)
+    assert os.listdir(dst.parent) == ['blob.bin']
+    subprocess_patch.assert_not_called()
+
+
+def test_install_replace(faienv_ids, install_src, fchown_patch):
+    dst = faienv_ids / 'etc/motd'
+    dst.parent.mkdir(exist_ok=True)
+    dst.write_text('old\n')
+    inode = dst.stat().st_ino
+    files.install(install_src, files.TargetPath('/etc/motd'))
+    assert dst.stat().st_ino != inode
+    assert dst.stat().st_size == install_src.stat().st_size
+
+
+def test_install_unknown_owner(faienv_ids, install_src, fchown_patch,
+                               subprocess_patch):
+    files.install(install_src, files.TargetPath('/etc/ldap.conf'), user='ldap')
+    fchown_patch.assert_not_called()
+    subprocess_patch.assert_called_once()
+    args = subprocess_patch.call_args[0][0]
+    assert args[:2] == ['chown', 'ldap:root']
+    assert args[2].startswith('/etc/.ldap.conf.')
+
+
+def test_install_symlinked_parent(faienv_ids, install_src, fchown_patch,
+                                  tmp_path_factory):
+    outside = tmp_path_factory.mktemp('outside')
+    (faienv_ids / 'etc/app').symlink_to(outside)
+    files.install(install_src, files.TargetPath('/etc/app/app.conf'))
+    assert os.listdir(outside) == []
+    # the link is resolved within the target
+    inside = faienv_ids / str(outside).lstrip('/') / 'app.conf'
+    assert inside.read_bytes() == install_src.read_bytes()
+
+
+@pytest.mark.parametrize('unsupported', [
+    ['ioctl'],
+    ['ioctl', 'copy_file_range'],
+    ['ioctl', 'copy_file_range', 'sendfile'],
+])
+def test_install_copy_fallbacks(faienv_ids, install_src, fchown_patch, mocker,
+                                unsupported):
+    for name in unsupported:
+        module = 'fcntl' if name == 'ioctl' else 'os'
+        if hasattr(__import__(module), name):
+            mocker.patch(f'{module}.{name}',
+                         side_effect=OSError(errno.EXDEV, 'mocked'))
+    files.install(install_src, files.TargetPath('/srv/blob'))
+    assert (faienv_ids / 'srv/blob').read_bytes() == install_src.read_bytes()
+
+
+def test_install_deferred_sync(faienv_ids, install_src, fchown_patch):
+    with files.deferred_sync():
+        files.install(install_src, files.TargetPath('/srv/a'))
+        files.install(install_src, files.TargetPath('/srv/b'))
+        assert not (faienv_ids / 'srv/a').exists()
+    assert sorted(os.listdir(faienv_ids / 'srv')) == ['a', 'b']
+
+    with pytest.raises(RuntimeError):
+        with files.deferred_sync():
+            files.install(install_src, files.TargetPath('/srv/c'))
+            raise RuntimeError()
+    assert sorted(os.listdir(faienv_ids / 'srv')) == ['a', 'b']
+
+
+def test_resolve_many(faienv):
+    paths = [files.TargetPath('/etc/fstab'), files.TargetPath('var/log')]
+    assert files.resolve_many(paths) == [files.resolve(p) for p in paths]
+
+
+def test_unresolve_many(faienv):
+    paths = [
+        files.InstallerPath('/target/etc/fstab'),
+        files.InstallerPath('/target')
+    ]
+    assert files.unresolve_many(paths) == [
+        files.TargetPath('/etc/fstab'),
+        files.TargetPath('/')
+    ]
+    with pytest.raises(ValueError):
+        files.unresolve_many([files.InstallerPath('/targetfoo/etc')])
+
+
+def test_resolve_many_online(monkeypatch):
+    monkeypatch.setattr(env, 'target', files.InstallerPath('/'))
+    tp = files.TargetPath('/etc/fstab')
+    assert files.resolve_many([tp]) == [files.InstallerPath('/etc/fstab')]
+    assert files.unresolve_many([files.InstallerPath('/etc/fstab')]) == [tp]
+
+
+@pytest.fixture
+def targetfs(tmp_path):
+    outside = tmp_path / 'outside'
+    outside.mkdir()
+    (outside / 'secret').write_text('outside\n')
+    target = tmp_path / 'target'
+    (target / 'etc').mkdir(parents=True)
+    (target / 'etc/secret').write_text('inside\n')
+    (target / 'outside').symlink_to(outside)
+    (target / 'abs').symlink_to('/etc')
+    (target / 'rel').symlink_to('../../etc')
+    (target / 'loop').symlink_to('loop')
+    with files.TargetFS(target) as fs:
+        yield fs
+
+
+def read_fd(fd):
+    with os.fdopen(fd) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize('path', [
+    '/etc/secret',
+    'abs/secret',
+    '/rel/secret',
+    '/../../etc/secret',
+    '/etc/../abs/./secret',
+])
+def test_targetfs_symlinks_stay_in_target(targetfs, path):
+    fd = targetfs.open(files.TargetPath(path), os.O_RDONLY)
+    assert read_fd(fd) == 'inside\n'
+
+
+def test_targetfs_errors(targetfs):
+    # 'outside' is a relative symlink within the tmp dir but in the target
+    # it points to a non-existing path
+    assert not targetfs.exists(files.TargetPath('/outside/secret'))
+    with pytest.raises(OSError) as e:
+        targetfs.stat(files.TargetPath('/loop'))
+    assert e.value.errno == errno.ELOOP
+    with pytest.raises(NotADirectoryError):
+        targetfs.stat(files.TargetPath('/etc/secret/x'))
+
+
+def test_targetfs_operations(targetfs, mocker):
+    p = files.TargetPath('/abs/new/dir')
+    targetfs.mkdir(p, 0o700, parents=True)
+    targetfs.mkdir(p, exist_ok=True)
+    with pytest.raises(FileExistsError):
+        targetfs.mkdir(p)
+    assert (targetfs.target / 'etc/new/dir').is_dir()
+
+    f = files.TargetPath('/etc/new/file')
+    os.close(targetfs.open(f, os.O_WRONLY | os.O_CREAT, 0o600))
+    targetfs.chmod(f, 0o640)
+    assert targetfs.stat(f).st_mode & 0o7777 == 0o640
+
+    chown = mocker.patch('os.chown', autospec=True, spec_set=True)
+    targetfs.chown(f, 1000, 50)
+    assert chown.call_args[0][1:] == (1000, 50)
+
+    targetfs.unlink(f)
+    assert not targetfs.exists(f)
+    targetfs.unlink(files.TargetPath('/abs'))
+    assert (targetfs.target / 'etc').is_dir()
+    assert not os.path.lexists(targetfs.target / 'abs')
+
+
+def test_targetfs_cache_bounded(tmp_path):
+    for i in range(10):
+        (tmp_path / f'd{i}').mkdir()
+    with files.TargetFS(tmp_path, cache_size=3) as fs:
+        for i in range(10):
+            fs.mkdir(files.TargetPath(f'/d{i}/sub'))
+            assert len(fs._dirs) <= 3
+
+
+def test_batch_coalesces(faienv_ids, chown_patch, subprocess_patch,
+                         subprocess_inst_patch):
+    # files installed by the mocked fcopy
+    (faienv_ids / 'etc/motd').touch()
+    (faienv_ids / 'srv/app').mkdir(parents=True)
+    (faienv_ids / 'srv/app/app.conf').touch()
+    with files.batch() as plan:
+        files.chmod(files.TargetPath('/srv/app/app.conf'), mode=0o600)
+        files.mkdir(files.TargetPath('/srv/app/data'), user='admin')
+        files.mkdir(files.TargetPath('/srv/app'), user='admin')
+        files.chmod(files.TargetPath('/srv/app'), mode=0o750, user='admin')
+        files.fcopy(files.TargetPath('/srv/app/app.conf'), user='admin')
+        files.fcopy(files.TargetPath('/srv/app/other.conf'), user='admin')
+        files.fcopy(files.TargetPath('/etc/motd'))
+        files.chmod(files.TargetPath('/etc/motd'), mode=0o600)
+        files.chmod(files.TargetPath('/srv/app/data'),
+                    mode=0o755,
+                    user='ldapuser',
+                    group='ldapgroup')
+        files.chmod(files.TargetPath('/srv/app/app.conf'),
+                    user='ldapuser',
+                    group='ldapgroup')
+        # nothing executed yet
+        assert not (faienv_ids / 'srv/app/data').exists()
+        subprocess_inst_patch.assert_not_called()
+
+    assert str(plan).splitlines() == [
+        'mkdir -p -m 750 /srv/app',
+        'mkdir -p -m 755 /srv/app/data',
+        "fcopy /srv/app/app.conf /srv/app/other.conf (delete_orphan=True "
+        "group='root' ignore_warnings=True mode=0o644 native=False "
+        "recursively=False remove_backup=True user='admin')",
+        "fcopy /etc/motd (delete_orphan=True group='root' "
+        "ignore_warnings=True mode=0o644 native=False recursively=False "
+        "remove_backup=True user='root')",
+        'chown root:root /etc/motd',
+        'chown admin:root /srv/app',
+        'chown ldapuser:ldapgroup /srv/app/app.conf /srv/app/data',
+        'chmod 600 /etc/motd',
+        'chmod 750 /srv/app',
+        'chmod 644 /srv/app/app.conf',
+        'chmod 755 /srv/app/data',
+    ]
+    assert (faienv_ids / 'srv/app/data').is_dir()
+    assert (faienv_ids / 'srv/app').stat().st_mode & 0o7777 == 0o750
+    assert subprocess_inst_patch.call_count == 2
+    subprocess_patch.assert_called_once_with(
+        ['chown', 'ldapuser:ldapgroup', '/srv/app/app.conf', '/srv/app/data'])
+    assert chown_patch.call_count == 2
+
+
+def test_batch_dry_run(faienv_ids, chown_patch, capsys):
+    with files.batch(dry_run=True):
+        files.mkdir(files.TargetPath('/srv/app'))
+        with files.batch():
+            files.mkdir(files.TargetPath('/srv/app'), mode=0o700)
+    assert capsys.readouterr().out == ('mkdir -p -m 700 /srv/app\n'
+                                       'chown root:root /srv/app\n'
+                                       'chmod 700 /srv/app\n')
+    assert not (faienv_ids / 'srv').exists()
+    chown_patch.assert_not_called()
+
+
+def test_batch_symlink_in_target(faienv_ids, chown_patch, tmp_path_factory):
+    outside = tmp_path_factory.mktemp('outside') / 'file'
+    outside.write_text('')
+    outside.chmod(0o600)
+    real = faienv_ids / 'etc/real'
+    real.write_text('')
+    (faienv_ids / 'etc/abs').symlink_to('/etc/real')
+    (faienv_ids / 'etc/rel').symlink_to(
+        os.path.relpath(outside, faienv_ids / 'etc'))
+
+    with files.batch():
+        files.chmod(files.TargetPath('/etc/abs'), user='admin', mode=0o640)
+    chown_patch.assert_called_once_with(real, 1000, 0, follow_symlinks=False)
+    assert real.stat().st_mode & 0o7777 == 0o640
+
+    with pytest.raises(FileNotFoundError):
+        with files.batch():
+            files.chmod(files.TargetPath('/etc/rel'), mode=0o666)
+    assert outside.stat().st_mode & 0o7777 == 0o600
+
+
+def test_batch_exception(faienv_ids):
+    with pytest.raises(RuntimeError):
+        with files.batch():
+            files.mkdir(files.TargetPath('/srv/app'))
+            raise RuntimeError()
+    assert not (faienv_ids / 'srv').exists()
+
+
+@pytest.fixture
+def sparse_src(tmp_path):
+    src = tmp_path / 'disk.img'
+    with open(src, 'wb') as f:
+        f.truncate(64 << 20)
+        f.seek(16 << 20)
+        f.write(b'boot' * 1024)
+        f.seek((64 << 20) - 4)
+        f.write(b'tail')
+    return src
+
+
+@pytest.mark.parametrize('unsupported', [[], ['copy_file_range']])
+def test_install_sparse(faienv_ids, sparse_src, fchown_patch, mocker,
+                        unsupported):
+    mocker.patch('fcntl.ioctl', side_effect=OSError(errno.EXDEV, 'mocked'))
+    for name in unsupported:
+        if hasattr(os, name):
+            mocker.patch(f'os.{name}',
+                         side_effect=OSError(errno.EXDEV, 'mocked'))
+    progress = mocker.Mock()
+    files.install(sparse_src,
+                  files.TargetPath('/var/lib/disk.img'),
+                  progress=progress)
+    dst = faienv_ids / 'var/lib/disk.img'
+    assert dst.read_bytes() == sparse_src.read_bytes()
+    assert sum(c[0][0] for c in progress.call_args_list) == 64 << 20
+    if sparse_src.stat().st_blocks * 512 < sparse_src.stat().st_size:
+        assert dst.stat().st_blocks <= sparse_src.stat().st_blocks
+
+
+def test_install_many(faienv_ids, install_src, sparse_src, fchown_patch,
+                      mocker):
+    progress = mocker.Mock()
+    jobs = [
+        (install_src, files.TargetPath('/srv/a')),
+        (sparse_src, files.TargetPath('/srv/b.img')),
+    ]
+    assert files.install_many(jobs, workers=2, progress=progress) == {
+        files.TargetPath('/srv/a'): True,
+        files.TargetPath('/srv/b.img'): True,
+    }
+    total = install_src.stat().st_size + sparse_src.stat().st_size
+    assert progress.call_args == mocker.call(total, total)
+    assert (faienv_ids / 'srv/b.img').read_bytes() == sparse_src.read_bytes()
+
+    progress.reset_mock()
+    assert not any(files.install_many(jobs, progress=progress).values())
+    assert progress.call_args == mocker.call(total, total)
+
+
+def test_fcopy_native_no_source(faienv_config):
+    dst = faienv_config / 'target/etc/precious'
+    dst.write_text('keep\n')
+    p = files.TargetPath('/etc/precious')
+    assert files.fcopy(p, native=True) == {}
+    assert dst.read_text() == 'keep\n'
+    with pytest.raises(FileNotFoundError):
+        files.fcopy(p, native=True, ignore_warnings=False)
+    assert dst.read_text() == 'keep\n'
@@ -1,5 +1,50 @@
+import pytest
+
+import pathlib
+import subprocess
+import sys
+
 import fai
 
 
 def test_version():
     assert hasattr(fai, '__version__')
+
+
+def test_lazy_import(monkeypatch):
+    monkeypatch.setenv('target', '/target')
+    script = '\n'.join([
+        'import sys, fai',
+        'assert "fai.env" not in sys.modules',
+        'assert "fai.files" not in sys.modules',
+        'assert str(fai.target) == "/target"',
+        'assert "fai.subprocess" not in sys.modules',
+        'assert fai.resolve is fai.files.resolve',
+        'assert "run" in dir(fai)',
+        'assert "asyncio" not in sys.modules',
+    ])
+    subprocess.run([sys.executable, '-c', script],
+                   cwd=pathlib.Path(fai.__file__).parent.parent,
+                   check=True)
+
+
+def test_unknown_attribute():
+    with pytest.raises(AttributeError):
+        fai.does_not_exist  # pylint: disable=pointless-statement
+
+
+def test_assign_before_read(monkeypatch, tmp_path):
+    monkeypatch.delenv('target', raising=False)
+    script = '\n'.join([
+        'import pathlib, fai',
+        'from fai import env, files',
+        f'env.target = pathlib.Path({str(tmp_path)!r})',
+        f'assert env.current().target == pathlib.Path({str(tmp_path)!r})',
+        'p = files.resolve(files.TargetPath("/etc/motd"))',
+        f'assert p == pathlib.Path({str(tmp_path)!r}) / "etc/motd"',
+        f'assert fai.target == pathlib.Path({str(tmp_path)!r})',
+        'assert env.LOGDIR is None',
+    ])
+    subprocess.run([sys.executable, '-W', 'ignore', '-c', script],
+                   cwd=pathlib.Path(fai.__file__).parent.parent,
+                   check=True)
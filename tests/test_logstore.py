@@ -0,0 +1,76 @@
+import pytest
+
+import subprocess
+import threading
+
+from fai import env, logstore, subprocess as sp
+
+
+@pytest.fixture
+def faienv_logdir(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'LOGDIR', tmp_path)
+    monkeypatch.setattr(env, 'ROOTCMD', ['env'])
+    return tmp_path
+
+
+def test_append_read(faienv_logdir):
+    store = logstore.store()
+    output = b''.join(b'line %d\n' % i for i in range(10000))
+    first = store.append(['big'], output, 0, 1.0, 2.0)
+    second = store.append(['fail'], b'error: broken\n', 1, 2.0, 3.0)
+    assert first.size == len(output)
+    assert first.length < len(output) // 2
+    assert second.offset == first.length
+    assert store.records() == [first, second]
+    assert store.read(second) == b'error: broken\n'
+    assert store.read(first) == output
+
+
+def test_grep(faienv_logdir):
+    store = logstore.store()
+    store.append(['a'], b'ok\nerror: one\n', 0, 0, 0)
+    store.append(['b'], b'error: two\nok\n', 1, 0, 0)
+    assert [(r.argv, line) for r, line in store.grep('^error')] == [
+        (['a'], b'error: one'),
+        (['b'], b'error: two'),
+    ]
+    assert [
+        line for _, line in store.grep(b'error', where=lambda r: r.returncode)
+    ] == [b'error: two']
+
+
+def test_concurrent_append(faienv_logdir):
+    store = logstore.store()
+    threads = [
+        threading.Thread(target=store.append,
+                         args=([str(i)], b'%d\n' % i * 1000, 0, 0, 0))
+        for i in range(8)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    records = store.records()
+    assert sorted(r.argv[0] for r in records) == [str(i) for i in range(8)]
+    for r in records:
+        assert store.read(r) == b'%s\n' % r.argv[0].encode() * 1000
+
+
+def test_run_log(faienv_logdir):
+    r = sp.run(['sh', '-c', 'echo out; echo err >&2'], log=True)
+    assert r.stdout == 'out\n'
+    assert r.stderr == 'err\n'
+    with pytest.raises(subprocess.CalledProcessError):
+        sp.run_installer(['sh', '-c', 'echo failed; exit 3'], log=True)
+    first, second = logstore.store().records()
+    assert first.argv == ['env', 'sh', '-c', 'echo out; echo err >&2']
+    assert first.returncode == 0 and first.start <= first.end
+    assert logstore.store().read(first) == b'out\nerr\n'
+    assert second.returncode == 3
+    assert logstore.store().read(second) == b'failed\n'
+
+
+def test_no_logdir(monkeypatch):
+    monkeypatch.setattr(env, 'LOGDIR', None)
+    with pytest.raises(ValueError):
+        sp.run_installer(['true'], log=True)
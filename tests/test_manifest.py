@@ -0,0 +1,122 @@
+import pytest
+
+import hashlib
+import os
+
+from fai import env, files, manifest
+
+
+@pytest.fixture
+def digest_spy(mocker):
+    return mocker.spy(manifest, 'file_digest')
+
+
+def test_file_digest(tmp_path):
+    f = tmp_path / 'file'
+    f.write_bytes(b'content')
+    assert manifest.file_digest(f) == hashlib.sha256(b'content').hexdigest()
+
+
+def test_record_save_load(tmp_path):
+    f = tmp_path / 'file'
+    f.write_text('content\n')
+    p = files.TargetPath('/etc/file')
+
+    m = manifest.Manifest(tmp_path / 'manifest.json')
+    assert m.lookup(p) is None
+    m.record(p, os.stat(f), 'abc')
+    m.save()
+
+    entry = manifest.Manifest(tmp_path / 'manifest.json').lookup(p)
+    assert entry.digest == 'abc'
+    assert entry.size == 8
+    assert entry.matches(os.stat(f))
+    f.write_text('changed content\n')
+    assert not entry.matches(os.stat(f))
+
+
+def test_save_merges(tmp_path):
+    path = tmp_path / 'manifest.json'
+    stat = os.stat(tmp_path)
+    m1 = manifest.Manifest(path)
+    m2 = manifest.Manifest(path)
+    m1.record(files.TargetPath('/a'), stat, 'a')
+    m1.save()
+    m2.record(files.TargetPath('/b'), stat, 'b')
+    m2.save()
+
+    m = manifest.Manifest(path)
+    assert list(m) == [files.TargetPath('/a'), files.TargetPath('/b')]
+
+
+def test_source_digest_cached(tmp_path, digest_spy):
+    src = tmp_path / 'src'
+    src.write_text('content\n')
+    m = manifest.Manifest(tmp_path / 'manifest.json')
+    digest = m.source_digest(src)
+    assert m.source_digest(src) == digest
+    digest_spy.assert_called_once()
+
+    src.write_text('changed content\n')
+    assert m.source_digest(src) != digest
+
+
+@pytest.fixture
+def faienv_target(monkeypatch, mocker, tmp_path):
+    target = tmp_path / 'target'
+    (target / 'etc').mkdir(parents=True)
+    (target / 'etc/passwd').write_text('root:x:0:0::/root:/bin/sh\n')
+    (target / 'etc/group').write_text('root:x:0:\n')
+    monkeypatch.setattr(env, 'target', target)
+    mocker.patch('os.fchown', autospec=True, spec_set=True)
+    mocker.patch('os.chown', autospec=True, spec_set=True)
+    return target
+
+
+def test_install_skips_unchanged(faienv_target, tmp_path, digest_spy):
+    src = tmp_path / 'src'
+    src.write_text('content\n')
+    p = files.TargetPath('/etc/app.conf')
+
+    assert files.install(src, p) == True
+    assert files.install(src, p) == False
+    # the destination was copied from the unchanged source: nothing hashed
+    digest_spy.assert_not_called()
+
+    manifest.for_target().save()
+    assert (faienv_target / 'var/lib/pyfai/manifest.json').exists()
+
+    src.write_text('new content\n')
+    assert files.install(src, p) == True
+    assert (faienv_target / 'etc/app.conf').read_text() == 'new content\n'
+    digest_spy.assert_not_called()
+
+
+def test_install_hashes_same_size(faienv_target, tmp_path, digest_spy):
+    src = tmp_path / 'src'
+    src.write_text('content\n')
+    other = tmp_path / 'other'
+    other.write_text('CONTENT\n')
+    p = files.TargetPath('/etc/app.conf')
+
+    assert files.install(src, p) == True
+    # same size from another source: only a content hash can tell
+    assert files.install(other, p) == True
+    assert digest_spy.call_count == 2
+    assert (faienv_target / 'etc/app.conf').read_text() == 'CONTENT\n'
+    assert manifest.for_target().lookup(p).digest is not None
+
+
+def test_install_detects_foreign_changes(faienv_target, tmp_path):
+    src = tmp_path / 'src'
+    src.write_text('content\n')
+    p = files.TargetPath('/etc/app.conf')
+    dst = faienv_target / 'etc/app.conf'
+
+    dst.write_text('content\n')
+    dst.chmod(0o644)
+    assert files.install(src, p) == False
+
+    dst.write_text('edited\n')
+    assert files.install(src, p) == True
+    assert dst.read_text() == 'content\n'
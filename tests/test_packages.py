@@ -0,0 +1,86 @@
+import pytest
+
+import os
+
+from fai import env, packages
+
+STATUS = """\
+Package: libc6
+Status: install ok installed
+Priority: optional
+Architecture: amd64
+Multi-Arch: same
+Version: 2.36-9
+Description: GNU C Library: Shared libraries
+ Contains the standard libraries that are used by nearly all programs on
+ the system.
+
+Package: libc6
+Status: install ok installed
+Architecture: i386
+Version: 2.36-8
+
+Package: exim4-daemon-light
+Status: install ok installed
+Architecture: amd64
+Version: 4.96-15
+Provides: mail-transport-agent, exim4-localscanapi-6.0 (= 6.0)
+
+Package: nano
+Status: deinstall ok config-files
+Architecture: amd64
+Version: 7.2-1
+"""
+
+
+@pytest.fixture
+def faienv_status(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'target', tmp_path)
+    status = tmp_path / 'var/lib/dpkg/status'
+    status.parent.mkdir(parents=True)
+    status.write_text(STATUS)
+    return status
+
+
+def test_parse(faienv_status):
+    index = packages.Status.parse(faienv_status)
+    assert [(p.name, p.arch) for p in index] == [
+        ('libc6', 'amd64'),
+        ('libc6', 'i386'),
+        ('exim4-daemon-light', 'amd64'),
+        ('nano', 'amd64'),
+    ]
+    exim = index.get('exim4-daemon-light')
+    assert exim.provides == ('mail-transport-agent', 'exim4-localscanapi-6.0')
+    assert index.get('nano').state == 'config-files'
+    assert index.get('missing') is None
+
+
+def test_queries(faienv_status):
+    assert packages.version('libc6:i386') == '2.36-8'
+    assert packages.version('libc6') == '2.36-9'
+    assert packages.version('nano') is None
+    assert packages.is_installed('libc6:amd64')
+    assert not packages.is_installed('libc6:arm64')
+    assert not packages.is_installed('mail-transport-agent')
+    assert packages.is_installed('mail-transport-agent', provides=True)
+    assert packages.installed(['libc6', 'nano', 'vim', 'exim4-daemon-light'
+                               ]) == {'libc6', 'exim4-daemon-light'}
+
+
+def test_status_cached(faienv_status, mocker):
+    parse_spy = mocker.spy(packages.Status, 'parse')
+    index = packages.status()
+    assert packages.status() is index
+    assert parse_spy.call_count == 1
+
+    with open(faienv_status, 'a') as f:
+        f.write('\nPackage: vim\nStatus: install ok installed\n'
+                'Architecture: amd64\nVersion: 2:9.0\n')
+    assert packages.is_installed('vim')
+    assert parse_spy.call_count == 2
+
+
+def test_status_missing(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'target', tmp_path)
+    assert packages.installed(['libc6']) == set()
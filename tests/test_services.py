@@ -0,0 +1,121 @@
+import pytest
+
+import os
+import pathlib
+
+from fai import env, services
+
+
+def _unit(path, install):
+    path.write_text(
+        '[Unit]\nDescription=test\n\n[Service]\nExecStart=/bin/true'
+        '\n\n[Install]\n' + install)
+
+
+@pytest.fixture
+def faienv_units(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'target', tmp_path)
+    lib = tmp_path / 'lib/systemd/system'
+    lib.mkdir(parents=True)
+    (tmp_path / 'etc/systemd/system').mkdir(parents=True)
+    _unit(lib / 'ssh.service',
+          'WantedBy=multi-user.target\nAlias=sshd.service\nAlso=ssh.socket\n')
+    _unit(lib / 'ssh.socket', 'WantedBy=sockets.target\n')
+    _unit(lib / 'getty@.service',
+          'WantedBy=getty.target\nDefaultInstance=tty1\n')
+    _unit(
+        lib / 'chrony.service',
+        'WantedBy=multi-user.target\nWantedBy=\nRequiredBy=time-sync.target\n')
+    return tmp_path / 'etc/systemd/system'
+
+
+def test_index(faienv_units):
+    index = services.UnitIndex.scan()
+    assert sorted(index.units) == [
+        'chrony.service', 'getty@.service', 'ssh.service', 'ssh.socket'
+    ]
+    ssh = index.units['ssh.service']
+    assert str(ssh.path) == '/lib/systemd/system/ssh.service'
+    assert ssh.alias == ('sshd.service', )
+    assert index.units['chrony.service'].wanted_by == ()
+    assert index.find('getty@') == ('getty@.service',
+                                    index.units['getty@.service'])
+    assert index.find('getty@tty2')[0] == 'getty@tty2.service'
+    with pytest.raises(FileNotFoundError):
+        index.find('missing')
+
+
+def test_enable_disable(faienv_units, mocker):
+    run_patch = mocker.patch('fai.subprocess.run',
+                             autospec=True,
+                             spec_set=True)
+    services.enable(['ssh', 'chrony', 'getty@', 'getty@tty2.service'])
+    links = {
+        str(p.relative_to(faienv_units)): os.readlink(p)
+        for p in faienv_units.rglob('*') if p.is_symlink()
+    }
+    assert links == {
+        'multi-user.target.wants/ssh.service':
+        '/lib/systemd/system/ssh.service',
+        'sshd.service':
+        '/lib/systemd/system/ssh.service',
+        'sockets.target.wants/ssh.socket':
+        '/lib/systemd/system/ssh.socket',
+        'time-sync.target.requires/chrony.service':
+        '/lib/systemd/system/chrony.service',
+        'getty.target.wants/getty@tty1.service':
+        '/lib/systemd/system/getty@.service',
+        'getty.target.wants/getty@tty2.service':
+        '/lib/systemd/system/getty@.service',
+    }
+    # enabling again changes nothing, aliases are found
+    services.enable(['sshd'])
+    services.mask(['chrony'])
+
+    services.disable(['sshd', 'chrony', 'getty@'])
+    links = {
+        str(p.relative_to(faienv_units)): os.readlink(p)
+        for p in faienv_units.rglob('*') if p.is_symlink()
+    }
+    assert links == {'chrony.service': '/dev/null'}
+    run_patch.assert_not_called()
+
+
+def test_disable_shared_alias(faienv_units):
+    lib = faienv_units.parent.parent.parent / 'lib/systemd/system'
+    for name in ('gdm', 'lightdm'):
+        _unit(lib / f'{name}.service', 'Alias=display-manager.service\n')
+    services.enable(['lightdm', 'getty@tty2'])
+    services.disable(['gdm', 'getty@tty1'])
+    assert os.readlink(faienv_units / 'display-manager.service') == \
+        '/lib/systemd/system/lightdm.service'
+    assert (faienv_units /
+            'getty.target.wants/getty@tty2.service').is_symlink()
+    services.disable(['lightdm', 'getty@tty2'])
+    assert not (faienv_units / 'display-manager.service').is_symlink()
+    assert not (faienv_units /
+                'getty.target.wants/getty@tty2.service').is_symlink()
+
+
+def test_mask_unmask(faienv_units):
+    services.mask(['ssh', 'apt-daily.timer'])
+    assert os.readlink(faienv_units / 'ssh.service') == '/dev/null'
+    assert os.readlink(faienv_units / 'apt-daily.timer') == '/dev/null'
+    services.unmask(['ssh', 'chrony'])
+    assert not (faienv_units / 'ssh.service').is_symlink()
+    assert (faienv_units / 'apt-daily.timer').is_symlink()
+
+    (faienv_units / 'local.service').write_text('[Unit]\n')
+    with pytest.raises(FileExistsError):
+        services.mask(['local'])
+
+
+def test_online(monkeypatch, mocker):
+    monkeypatch.setattr(env, 'target', pathlib.PosixPath('/'))
+    run_patch = mocker.patch('fai.subprocess.run',
+                             autospec=True,
+                             spec_set=True)
+    services.enable(['ssh', 'chrony'])
+    services.mask([])
+    run_patch.assert_called_once_with(
+        ['systemctl', 'enable', '--', 'ssh', 'chrony'])
@@ -0,0 +1,92 @@
+import pytest
+
+import os
+
+from fai import env, files, snapshot
+
+
+@pytest.fixture
+def faienv_tree(monkeypatch, tmp_path):
+    target = tmp_path / 'target'
+    monkeypatch.setattr(env, 'target', target)
+    (target / 'etc/ssh').mkdir(parents=True)
+    (target / 'etc/hostname').write_text('old\n')
+    (target / 'etc/ssh/sshd_config').write_text('PermitRootLogin yes\n')
+    (target / 'etc/motd').write_text('hello\n')
+    (target / 'proc/1').mkdir(parents=True)
+    os.symlink('hostname', target / 'etc/name')
+    return target
+
+
+def test_take(faienv_tree):
+    snap = snapshot.take()
+    assert snap.paths == [
+        'etc', 'etc/hostname', 'etc/motd', 'etc/name', 'etc/ssh',
+        'etc/ssh/sshd_config', 'proc'
+    ]
+    record = snap.lookup(files.TargetPath('/etc/hostname'))
+    st = os.lstat(faienv_tree / 'etc/hostname')
+    assert record == snapshot.Record(st.st_size, st.st_mtime_ns, st.st_ino,
+                                     st.st_mode, st.st_uid, st.st_gid, None)
+    assert files.TargetPath('/etc/ssh') in snap
+    assert files.TargetPath('/proc/1') not in snap
+
+
+def test_save_load(faienv_tree, tmp_path):
+    snap = snapshot.take(hash_files=True)
+    path = tmp_path / 'snap'
+    snap.save(path)
+    loaded = snapshot.Snapshot.load(path)
+    assert loaded.root == snap.root
+    assert loaded.paths == snap.paths
+    assert loaded.columns == snap.columns
+    assert loaded.digests == snap.digests
+    assert loaded.lookup(files.TargetPath('/etc/motd')).digest is not None
+
+    path.write_bytes(b'garbage\n')
+    with pytest.raises(ValueError):
+        snapshot.Snapshot.load(path)
+
+
+def test_diff(faienv_tree):
+    before = snapshot.take(hash_files=True)
+    (faienv_tree / 'etc/hostname').write_text('new\n')  # same size
+    os.utime(faienv_tree / 'etc/hostname', ns=(0, 0))
+    (faienv_tree / 'etc/motd').write_text('hello\n')  # same content
+    (faienv_tree / 'etc/ssh/sshd_config').unlink()
+    (faienv_tree / 'etc/ssh/ssh_config').write_text('')
+    (faienv_tree / 'etc/name').unlink()
+    (faienv_tree / 'etc/name').mkdir()
+    os.chmod(faienv_tree / 'etc/ssh', 0o700)
+    after = snapshot.take(previous=before)
+    changes = snapshot.diff(before, after)
+    assert changes == snapshot.Diff(
+        added=[files.TargetPath('/etc/ssh/ssh_config')],
+        removed=[files.TargetPath('/etc/ssh/sshd_config')],
+        modified=[
+            files.TargetPath('/etc/hostname'),
+            files.TargetPath('/etc/name')
+        ],
+        attributes=[files.TargetPath('/etc/ssh')],
+    )
+    # digests computed for the comparison are kept
+    assert after.lookup(files.TargetPath('/etc/motd')).digest is not None
+
+
+def test_diff_without_digests(faienv_tree):
+    before = snapshot.take()
+    after = snapshot.take(previous=before)
+    assert snapshot.diff(before, after) == snapshot.Diff([], [], [], [])
+    os.utime(faienv_tree / 'etc/motd', ns=(0, 0))
+    after = snapshot.take()
+    changes = snapshot.diff(before, after)
+    assert changes.modified == [files.TargetPath('/etc/motd')]
+    # nothing to compare with: not hashed
+    assert after.lookup(files.TargetPath('/etc/motd')).digest is None
+
+
+def test_diff_other_root(faienv_tree):
+    before = snapshot.take(faienv_tree / 'etc')
+    (faienv_tree / 'etc/issue').write_text('')
+    changes = snapshot.diff(before, snapshot.take(faienv_tree / 'etc'))
+    assert changes.added == [files.TargetPath('/issue')]
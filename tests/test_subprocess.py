@@ -1,9 +1,11 @@
 import pytest
 
+import asyncio
 import pathlib
 import subprocess
+import sys
 
-from fai import env, subprocess as sp
+from fai import cmdcache, env, files, subprocess as sp
 
 
 @pytest.fixture
@@ -73,3 +75,253 @@ def test_target_overrides(faienv, subprocess_patch):
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
     )
+
+
+@pytest.fixture
+def worker(monkeypatch):
+    # 'env' as stand-in chroot command: runs the worker in the local system
+    monkeypatch.setattr(env, 'ROOTCMD', ['env'])
+    with sp.Worker(python=sys.executable) as w:
+        yield w
+
+
+@pytest.fixture
+def popen_spy(mocker):
+    return mocker.spy(subprocess, 'Popen')
+
+
+def test_worker_defaults(worker, popen_spy):
+    result = sp.run(['echo', 'hello'])
+    assert result.args == ['env', 'echo', 'hello']
+    assert result.returncode == 0
+    assert result.stdout == 'hello\n'
+    assert result.stderr is None
+    popen_spy.assert_not_called()
+
+
+def test_worker_check(worker):
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        sp.run(['sh', '-c', 'echo out; exit 3'])
+    assert e.value.returncode == 3
+    assert e.value.cmd == ['env', 'sh', '-c', 'echo out; exit 3']
+    assert e.value.output == 'out\n'
+
+
+def test_worker_overrides(worker):
+    result = sp.run(['sh', '-c', 'cat; echo err >&2; exit 1'],
+                    check=False,
+                    universal_newlines=False,
+                    input=b'in\n',
+                    stderr=subprocess.PIPE)
+    assert result.returncode == 1
+    assert result.stdout == b'in\n'
+    assert result.stderr == b'err\n'
+
+
+def test_worker_command_not_found(worker):
+    result = sp.run(['/nonexistent'], check=False, stderr=subprocess.PIPE)
+    assert result.returncode == 127
+    assert '/nonexistent' in result.stderr
+
+
+def test_worker_bypass(worker, popen_spy):
+    sp.run(['true'], cwd='/')
+    popen_spy.assert_called_once()
+
+
+def test_installer_async_defaults():
+    result = asyncio.run(sp.run_installer_async(['echo', 'hello']))
+    assert result.args == ['echo', 'hello']
+    assert result.returncode == 0
+    assert result.stdout == 'hello\n'
+    assert result.stderr is None
+
+
+def test_installer_async_check():
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        asyncio.run(sp.run_installer_async(['sh', '-c', 'echo out; exit 2']))
+    assert e.value.returncode == 2
+    assert e.value.output == 'out\n'
+
+
+def test_installer_async_overrides():
+    result = asyncio.run(
+        sp.run_installer_async(['sh', '-c', 'cat; echo err >&2; exit 1'],
+                               check=False,
+                               universal_newlines=False,
+                               input=b'in\n',
+                               stderr=subprocess.PIPE))
+    assert result.returncode == 1
+    assert result.stdout == b'in\n'
+    assert result.stderr == b'err\n'
+
+
+def test_target_async(monkeypatch):
+    monkeypatch.setattr(env, 'ROOTCMD', ['env'])
+    result = asyncio.run(sp.run_async(['echo', 'hello']))
+    assert result.args == ['env', 'echo', 'hello']
+    assert result.stdout == 'hello\n'
+
+
+def test_gather_limit():
+    running = 0
+    max_running = 0
+
+    async def job(i):
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+        return i
+
+    results = asyncio.run(sp.gather(*(job(i) for i in range(10)), limit=3))
+    assert results == list(range(10))
+    assert max_running == 3
+
+
+def test_gather_errors():
+    cmds = [['true'], ['false'], ['sh', '-c', 'exit 3']]
+    with pytest.raises(sp.GatherError) as e:
+        asyncio.run(sp.gather(*(sp.run_installer_async(c) for c in cmds)))
+    assert isinstance(e.value.results[0], subprocess.CompletedProcess)
+    assert [err.returncode for err in e.value.errors] == [1, 3]
+
+
+@pytest.fixture
+def faienv_logdir(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'LOGDIR', tmp_path)
+    monkeypatch.setattr(env, 'ROOTCMD', ['env'])
+    return tmp_path
+
+
+def test_stream_lines(faienv_logdir):
+    stream = sp.run_installer_stream(['printf', 'a\\nb\\n'])
+    assert list(stream) == ['a\n', 'b\n']
+    assert stream.returncode == 0
+    assert stream.log is None
+
+
+def test_stream_binary_tee(faienv_logdir):
+    stream = sp.run_stream(['head', '-c', '200000', '/dev/zero'],
+                           binary=True,
+                           tee=True)
+    assert stream.args[0] == 'env'
+    assert sum(len(chunk) for chunk in stream) == 200000
+    assert stream.log.parent == faienv_logdir
+    assert stream.log.name.startswith('head.')
+    assert stream.log.stat().st_size == 200000
+
+
+def test_stream_tee_no_logdir(monkeypatch):
+    monkeypatch.setattr(env, 'LOGDIR', None)
+    with pytest.raises(ValueError):
+        sp.run_installer_stream(['true'], tee=True)
+
+
+def test_stream_check_tail(faienv_logdir):
+    stream = sp.run_installer_stream(
+        ['sh', '-c', 'seq 1 10; echo failed >&2; exit 2'],
+        stderr=subprocess.STDOUT,
+        tail=3,
+        tee='failing.log')
+    with pytest.raises(subprocess.CalledProcessError) as e:
+        for _ in stream:
+            pass
+    assert e.value.returncode == 2
+    assert e.value.output == '9\n10\nfailed\n'
+    assert (faienv_logdir / 'failing.log').read_text().startswith('1\n2\n')
+
+
+def test_stream_abort(faienv_logdir):
+    with sp.run_installer_stream(['yes']) as stream:
+        assert next(iter(stream)) == 'y\n'
+    assert stream.returncode != 0
+
+
+@pytest.fixture
+def faienv_cache(faienv_logdir, monkeypatch, mocker):
+    monkeypatch.setattr(env, 'target', faienv_logdir)
+    monkeypatch.setattr(cmdcache, '_caches', {})
+    return mocker.spy(subprocess, 'run')
+
+
+def test_cache_hit(faienv_cache, faienv_logdir, monkeypatch):
+    r = sp.run(['echo', 'x'], cache=True)
+    assert (r.args, r.returncode, r.stdout) == (['env', 'echo', 'x'], 0, 'x\n')
+    assert sp.run(['echo', 'x'], cache=True).stdout == 'x\n'
+    assert faienv_cache.call_count == 1
+    assert (faienv_logdir / cmdcache.CACHE_FILE).exists()
+
+    # other script of the same run
+    monkeypatch.setattr(cmdcache, '_caches', {})
+    assert sp.run(['echo', 'x'], cache=True).stdout == 'x\n'
+    assert faienv_cache.call_count == 1
+
+    # different arguments are cached separately
+    r = sp.run_installer(['echo', 'x'], cache=True, stdout=subprocess.DEVNULL)
+    assert r.stdout is None
+    sp.run(['echo', 'x'], cache=True, universal_newlines=False)
+    assert faienv_cache.call_count == 3
+    assert sp.run(['echo', 'x'], cache=True,
+                  universal_newlines=False).stdout == b'x\n'
+    assert faienv_cache.call_count == 3
+
+
+def test_cache_inherited_output(faienv_cache, capsys):
+    for _ in range(2):
+        r = sp.run_installer(['sh', '-c', 'echo out; echo err >&2'],
+                             cache=True,
+                             stdout=None)
+        assert (r.stdout, r.stderr) == (None, None)
+        # printed on every call, not only when the command is run
+        assert capsys.readouterr() == ('out\n', 'err\n')
+    assert faienv_cache.call_count == 1
+
+
+def test_cache_check(faienv_cache):
+    with pytest.raises(subprocess.CalledProcessError):
+        sp.run(['false'], cache=True)
+    assert sp.run(['false'], cache=True, check=False).returncode == 1
+    assert faienv_cache.call_count == 1
+
+
+def test_cache_watch(faienv_cache, faienv_logdir):
+    watched = faienv_logdir / 'etc/group'
+    watched.parent.mkdir()
+    for _ in range(2):
+        sp.run(['true'], cache=True, watch=[files.TargetPath('/etc/group')])
+    assert faienv_cache.call_count == 1
+    watched.write_text('audio:x:29:\n')
+    for _ in range(2):
+        sp.run(['true'], cache=True, watch=[files.TargetPath('/etc/group')])
+    assert faienv_cache.call_count == 2
+
+
+def test_cache_clear(faienv_cache):
+    sp.run(['echo', 'a'], cache=True)
+    sp.run(['echo', 'b'], cache=True)
+    cmdcache.clear(['echo', 'a'])
+    sp.run(['echo', 'a'], cache=True)
+    sp.run(['echo', 'b'], cache=True)
+    assert faienv_cache.call_count == 3
+    cmdcache.clear()
+    sp.run(['echo', 'b'], cache=True)
+    assert faienv_cache.call_count == 4
+
+
+def test_cache_lru(faienv_cache, monkeypatch):
+    monkeypatch.setattr(cmdcache, 'MAX_ENTRIES', 2)
+    for arg in ('a', 'b', 'a', 'c', 'a', 'b'):
+        sp.run(['echo', arg], cache=True)
+    # b was evicted when c was added
+    assert faienv_cache.call_count == 4
+
+
+def test_cache_unsupported(faienv_cache, tmp_path):
+    with open(tmp_path / 'out', 'w') as f:
+        with pytest.raises(ValueError):
+            sp.run(['true'], cache=True, stdout=f)
+    with pytest.raises(ValueError):
+        sp.run(['true'], cache=True, stdin=subprocess.DEVNULL)
+    faienv_cache.assert_not_called()
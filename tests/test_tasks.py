@@ -0,0 +1,109 @@
+import pytest
+
+import json
+import threading
+
+from fai import env, tasks
+
+
+@pytest.fixture
+def faienv_tasks(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'classes', ['DEFAULT', 'WEB'])
+    monkeypatch.setattr(env, 'LOGDIR', tmp_path)
+    return tmp_path
+
+
+def read_reports(logdir):
+    return [
+        json.loads(path.read_text())
+        for path in sorted(logdir.glob('pyfai-tasks.*.json'),
+                           key=lambda p: p.stat().st_mtime_ns)
+    ]
+
+
+def test_run(faienv_tasks):
+    registry = tasks.Registry()
+    order = []
+    barrier = threading.Barrier(2, timeout=5)
+
+    @registry.task(classes=['DEFAULT'])
+    def network():
+        barrier.wait()  # runs in parallel with users
+        order.append('network')
+
+    @registry.task()
+    def users():
+        barrier.wait()
+        order.append('users')
+
+    @registry.task(classes=['DB'])
+    def database():
+        order.append('database')
+
+    @registry.task(name='web',
+                   classes=['WEB', 'DB'],
+                   requires=['network', 'database'])
+    def web_server():
+        assert env.current().LOGDIR == faienv_tasks
+        order.append('web')
+
+    results = registry.run(workers=2)
+    assert sorted(order[:2]) == ['network', 'users']
+    assert order[2:] == ['web']
+    assert {
+        n: r.status
+        for n, r in results.items()
+    } == {
+        'network': 'ok',
+        'users': 'ok',
+        'database': 'skipped',
+        'web': 'ok',
+    }
+    report, = read_reports(faienv_tasks)
+    assert [t['name'] for t in report['tasks']][-1] == 'database'
+    assert report['tasks'][-1]['duration'] is None
+    assert all(t['duration'] >= 0 for t in report['tasks'][:3])
+
+
+def test_fail_fast(faienv_tasks):
+    registry = tasks.Registry()
+
+    @registry.task()
+    def broken():
+        raise RuntimeError('broken')
+
+    @registry.task(requires=['broken'])
+    def later():
+        pass
+
+    with pytest.raises(tasks.TaskError) as e:
+        registry.run()
+    assert list(e.value.errors) == ['broken']
+    assert e.value.results['later'].status == 'cancelled'
+    report, = read_reports(faienv_tasks)
+    assert report['tasks'][0]['error'] == "RuntimeError('broken')"
+
+
+def test_reports_kept(faienv_tasks):
+    registry = tasks.Registry()
+    registry.task(name='noop')(lambda: None)
+    registry.run()
+    registry.run()
+    assert len(read_reports(faienv_tasks)) == 2
+    registry.run(report=None)
+    assert len(read_reports(faienv_tasks)) == 2
+
+
+def test_invalid_graph(faienv_tasks):
+    registry = tasks.Registry()
+    registry.task(name='a', requires=['b'])(lambda: None)
+    registry.task(name='b', requires=['a'])(lambda: None)
+    with pytest.raises(ValueError, match='cyclic'):
+        registry.run()
+    with pytest.raises(ValueError):
+        registry.task(name='a')(lambda: None)
+
+    registry = tasks.Registry()
+    registry.task(name='a', requires=['missing'])(lambda: None)
+    with pytest.raises(ValueError, match='unknown'):
+        registry.run()
@@ -0,0 +1,98 @@
+import pytest
+
+import json
+import subprocess
+import time
+
+from fai import env, files, subprocess as sp, trace
+
+
+@pytest.fixture
+def tracing(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'LOGDIR', tmp_path)
+    monkeypatch.setattr(env, 'target', tmp_path / 'target')
+    monkeypatch.setattr(env, 'ROOTCMD', ['env'])
+    trace.enable()
+    yield tmp_path / trace.TRACE_FILE
+    trace.disable()
+
+
+def read_records(path):
+    return [json.loads(line) for line in path.read_text().splitlines()]
+
+
+def test_disabled_by_default(tmp_path):
+    assert not trace.is_enabled()
+
+
+def test_trace_commands(tracing):
+    sp.run_installer(['true'])
+    sp.run(['sh', '-c', 'echo hello'])
+    with pytest.raises(subprocess.CalledProcessError):
+        sp.run(['false'])
+
+    records = read_records(tracing)
+    assert [r['op'] for r in records] == ['run_installer', 'run', 'run']
+    assert records[0]['argv'] == ['true']
+    assert records[1]['argv'] == ['env', 'sh', '-c', 'echo hello']
+    assert records[1]['command'] == 'sh'
+    assert records[2]['returncode'] == 1
+    for r in records:
+        assert r['wall'] > 0
+        assert r['cpu'] >= 0
+        assert r['maxrss'] > 0
+
+
+def test_trace_results(tracing):
+    result = sp.run_installer(['cat'], input='in\n', stderr=subprocess.PIPE)
+    assert result.args == ['cat']
+    assert result.stdout == 'in\n'
+    assert result.stderr == ''
+
+
+def test_trace_timeout(tracing):
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        sp.run_installer(['sleep', '10'], timeout=0.1)
+    assert time.monotonic() - start < 5
+    record, = read_records(tracing)
+    assert 'TimeoutExpired' in record['error']
+
+
+def test_trace_files(tracing, mocker):
+    mocker.patch('os.chown', autospec=True, spec_set=True)
+    etc = env.target / 'etc'
+    etc.mkdir(parents=True)
+    (etc / 'passwd').write_text('root:x:0:0:root:/root:/bin/bash\n')
+    (etc / 'group').write_text('root:x:0:\n')
+
+    files.resolve(files.TargetPath('/etc/fstab'))
+    with pytest.raises(FileNotFoundError):
+        files.chmod(files.TargetPath('/etc/missing'))
+
+    records = read_records(tracing)
+    assert [r['op'] for r in records] == ['resolve', 'resolve', 'chmod']
+    assert records[0]['path'] == ['/etc/fstab']
+    assert records[0]['error'] is None
+    assert records[1]['path'] == ['/etc/missing']
+    assert 'FileNotFoundError' in records[2]['error']
+
+
+def test_summary(tracing, capsys):
+    for _ in range(3):
+        sp.run(['true'])
+    sp.run(['sleep', '0.05'])
+    files.resolve(files.TargetPath('/etc/fstab'))
+
+    result = trace.summary(trace.load([tracing]), top=2)
+    assert [c['name'] for c in result['commands']] == ['sleep', 'true']
+    assert result['commands'][1]['count'] == 3
+    assert [o['name'] for o in result['operations']] == ['resolve']
+    assert len(result['slowest_commands']) == 2
+    assert result['slowest_commands'][0]['argv'][-2:] == ['sleep', '0.05']
+    assert result['slowest_paths'][0]['path'] == ['/etc/fstab']
+
+    trace.main([str(tracing)])
+    out = capsys.readouterr().out
+    assert 'sleep 0.05' in out
+    assert 'resolve /etc/fstab' in out
@@ -0,0 +1,70 @@
+import pytest
+
+import hashlib
+
+from fai import env, files, manifest, verify
+
+
+@pytest.fixture
+def faienv_files(monkeypatch, tmp_path):
+    monkeypatch.setattr(env, 'target', tmp_path)
+    (tmp_path / 'usr/bin').mkdir(parents=True)
+    (tmp_path / 'usr/bin/tool').write_bytes(b'tool')
+    (tmp_path / 'usr/bin/other tool').write_bytes(b'other')
+    info = tmp_path / 'var/lib/dpkg/info'
+    info.mkdir(parents=True)
+    (info / 'tool.md5sums').write_text(
+        f'{hashlib.md5(b"tool").hexdigest()}  usr/bin/tool\n'
+        f'{hashlib.md5(b"xxx").hexdigest()}  usr/bin/other tool\n')
+    (info / 'libgone:amd64.md5sums'
+     ).write_text(f'{hashlib.md5(b"gone").hexdigest()}  usr/lib/libgone.so\n')
+    return tmp_path
+
+
+def test_dpkg_md5sums(faienv_files):
+    assert verify.dpkg_md5sums(['libgone']) == {
+        files.TargetPath('/usr/lib/libgone.so'):
+        hashlib.md5(b'gone').hexdigest()
+    }
+    assert len(verify.dpkg_md5sums()) == 3
+
+
+def test_verify(faienv_files):
+    expected = verify.dpkg_md5sums()
+    expected[files.TargetPath('/usr/bin/tool2')] = hashlib.sha256(
+        b'tool').hexdigest()
+    (faienv_files / 'usr/bin/tool2').write_bytes(b'tool')
+    mismatches = sorted(verify.verify(expected, workers=2))
+    assert [m[:3] for m in mismatches] == [
+        (files.TargetPath('/usr/bin/other tool'),
+         hashlib.md5(b'xxx').hexdigest(), hashlib.md5(b'other').hexdigest()),
+        (files.TargetPath('/usr/lib/libgone.so'),
+         hashlib.md5(b'gone').hexdigest(), None),
+    ]
+    assert isinstance(mismatches[1].error, FileNotFoundError)
+
+
+def test_verify_unknown_algorithm(faienv_files):
+    with pytest.raises(ValueError):
+        list(verify.verify({files.TargetPath('/usr/bin/tool'): 'abc'}))
+
+
+def test_verify_throttle(faienv_files, mocker):
+    sleep = mocker.patch('fai.verify.time.sleep', autospec=True)
+    expected = {
+        files.TargetPath('/usr/bin/tool'): hashlib.md5(b'tool').hexdigest()
+    }
+    assert list(verify.verify(expected, max_bytes_per_second=1)) == []
+    sleep.assert_called_once()
+    assert sleep.call_args[0][0] == pytest.approx(4, abs=0.5)
+
+
+def test_manifest_digests(faienv_files):
+    path = files.TargetPath('/usr/bin/tool')
+    installer_path = files.resolve(path)
+    manifest.for_target().record(path, installer_path.stat(),
+                                 manifest.file_digest(installer_path))
+    assert verify.manifest_digests() == {
+        path: hashlib.sha256(b'tool').hexdigest()
+    }
+    assert list(verify.verify(verify.manifest_digests())) == []